@@ -1,6 +1,15 @@
-import requests
+import os
+import sys
 from qdrant_client import QdrantClient
-from qdrant_client.http import models
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(SCRIPT_DIR)))
+from rag_common.transport import get_transport
+from rag_common.embeddings import decode_embeddings
+from rag_common.text_store import TextStoreWriter, chunk_payload, payload_mode, open_store, hydrate
+from rag_common.quantization import vector_params, search_params, describe
+
+TEXT_STORE_DIR = os.path.join(SCRIPT_DIR, "text_store")  # RAG_PAYLOAD_TEXT=store 時輸入的文字存這裡
 
 class BatchVDBManager:
     def __init__(self, host="localhost", port=6333):
@@ -8,15 +17,15 @@ class BatchVDBManager:
         self.api_url = "https://ws-04.wade0426.me/embed"
 
     def get_embeddings(self, texts):
-        """批量獲取向量，直接對應您提供的 API 格式"""
+        """批量獲取向量，直接對應您提供的 API 格式；回傳 (n, dim) float32 陣列"""
         payload = {
             "texts": texts,
             "task_description": "檢索技術文件",
             "normalize": True
         }
-        response = requests.post(self.api_url, json=payload)
+        response = get_transport().post(self.api_url, json=payload, timeout=60)
         if response.status_code == 200:
-            return response.json()["embeddings"]
+            return decode_embeddings(response.content)
         else:
             raise Exception(f"API 請求失敗: {response.text}")
 
@@ -41,33 +50,40 @@ class BatchVDBManager:
             content = input(f"📝 第 {i+1} 筆資料：")
             documents.append({"id": i + 1, "text": content})
 
+        # store 模式下所有輸入依序接成一份來源，payload 只記 offset
+        payloads = documents
+        if payload_mode() == "store":
+            with TextStoreWriter(TEXT_STORE_DIR) as writer:
+                payloads = [chunk_payload(doc["text"], "input", *writer.append("input", doc["text"]), id=doc["id"])
+                            for doc in documents]
+        store = open_store(TEXT_STORE_DIR)
+
         # 2. 批量處理 (一次將所有 texts 送出)
         print("\n正在進行批量向量化處理")
         all_texts = [doc["text"] for doc in documents]
         all_embeddings = self.get_embeddings(all_texts)
 
         # 3. 自動適應維度並建立 Collection
-        detected_size = len(all_embeddings[0])
-        print(f"📏 偵測到向量維度為: {detected_size}")
+        detected_size = all_embeddings.shape[1]
+        print(f"📏 偵測到向量維度為: {detected_size}，量化: {describe()}")
 
         if self.client.collection_exists(c_name):
             self.client.delete_collection(c_name)
         
         self.client.create_collection(
             collection_name=c_name,
-            vectors_config=models.VectorParams(
-                size=detected_size, # 動態設定
-                distance=models.Distance.COSINE
-            ),
+            vectors_config=vector_params(detected_size),  # 維度動態設定，量化依 RAG_QUANTIZATION
         )
 
-        # 4. 批量寫入資料庫
-        points = [
-            models.PointStruct(id=doc["id"], vector=emb, payload=doc)
-            for doc, emb in zip(documents, all_embeddings)
-        ]
-        self.client.upsert(collection_name=c_name, points=points)
-        print(f"成功導入 {len(points)} 筆資料。")
+        # 4. 批量寫入資料庫 (直接傳入 numpy 陣列，由 client 逐批序列化)
+        self.client.upload_collection(
+            collection_name=c_name,
+            vectors=all_embeddings,
+            payload=payloads,
+            ids=[doc["id"] for doc in documents],
+            wait=True
+        )
+        print(f"成功導入 {len(documents)} 筆資料。")
 
         # 5. 輸入比較項目
         while True:
@@ -78,8 +94,10 @@ class BatchVDBManager:
             hits = self.client.query_points(
                 collection_name=c_name,
                 query=query_vector,
-                limit=3
+                limit=3,
+                search_params=search_params()
             ).points
+            hydrate(hits, store)
 
             print("\n[ 檢索結果 ]")
             for hit in hits:
@@ -1,83 +1,134 @@
 import os
-import requests
-import re
-from bs4 import BeautifulSoup
-from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, VectorParams, PointStruct
+import sys
+from contextlib import nullcontext
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(SCRIPT_DIR)))
+from rag_common.transport import get_transport
+from rag_common.embeddings import decode_embeddings
+from rag_common.chunking import TextSource, fixed_spans, sliding_spans, chunk_texts
+from rag_common.dedupe import dedupe
+from rag_common.html_tables import iter_html_table_rows, row_chunk
+from rag_common.quantization import vector_params, describe
+from rag_common.text_store import TextStoreWriter, chunk_payload, payload_mode
 
 # ================= 1. 設定與初始化 =================
 API_EMBED_URL = "https://ws-04.wade0426.me/embed"
 API_SIMILARITY_URL = "https://ws-04.wade0426.me/similarity"
 QDRANT_URL = "http://localhost:6333"
-
-# 初始化 Qdrant 客戶端
-try:
-    q_client = QdrantClient(url=QDRANT_URL)
-    print("已成功連接至 Qdrant VDB")
-except Exception as e:
-    print(f"無法連接 Qdrant: {e}")
+TABLE_EMBED_BATCH = 64  # 表格逐列串流嵌入的批次大小
+TEXT_STORE_DIR = "text_store"  # RAG_PAYLOAD_TEXT=store 時 chunk 文字存這裡
+
+def connect_qdrant():
+    """建立 Qdrant 客戶端 (延遲載入，切塊 / 表格函數可在沒有 qdrant_client 的環境單獨使用)"""
+    from qdrant_client import QdrantClient
+    try:
+        client = QdrantClient(url=QDRANT_URL)
+        print("已成功連接至 Qdrant VDB")
+        return client
+    except Exception as e:
+        print(f"無法連接 Qdrant: {e}")
 
 # ================= 2. 工具函數封裝 =================
 
 def get_embeddings(texts):
-    """取得向量"""
-    response = requests.post(API_EMBED_URL, json={
+    """取得向量，回傳 (n, dim) float32 陣列 (直接由回應 bytes 解碼)"""
+    response = get_transport().post(API_EMBED_URL, json={
         "texts": texts, "task_description": "檢索技術文件", "normalize": True
-    })
-    return response.json().get("embeddings", [])
+    }, timeout=60)
+    return decode_embeddings(response.content)
 
 def get_similarity(query, documents):
     """計算相似度分數"""
-    response = requests.post(API_SIMILARITY_URL, json={
+    response = get_transport().post(API_SIMILARITY_URL, json={
         "queries": [query], "documents": documents
-    })
+    }, timeout=60)
     return response.json().get("similarity", [[]])[0]
 
-# --- 切塊邏輯 ---
+# --- 切塊邏輯 (offset 由 rag_common.chunking 產生) ---
 def fixed_size_chunking(text, size=300):
-    return [text[i:i+size] for i in range(0, len(text), size)]
+    src = TextSource(text)
+    return chunk_texts(src, fixed_spans(src, size))
 
 def sliding_window_chunking(text, size=300, overlap=100):
-    chunks = []
-    step = size - overlap
-    for i in range(0, len(text) - overlap, step):
-        chunks.append(text[i:i+size])
-    return chunks
+    src = TextSource(text)
+    return chunk_texts(src, sliding_spans(src, size, overlap))
 
 # --- 表格處理 ---
+def iter_table_chunks(file_path):
+    """HTML 表格逐列串流，每列一個 chunk (附表頭與段落標題)"""
+    for row in iter_html_table_rows(file_path):
+        yield row_chunk(row)
+
 def process_table(file_path):
     if not os.path.exists(file_path): return ""
     if file_path.endswith('.html'):
-        with open(file_path, 'r', encoding='utf-8') as f:
-            soup = BeautifulSoup(f, 'html.parser')
-            return "\n".join([" | ".join([td.get_text(strip=True) for td in tr.find_all(['td', 'th'])]) for tr in soup.find_all('tr')])
+        return "\n".join(iter_table_chunks(file_path))
     else:
         with open(file_path, 'r', encoding='utf-8') as f: return f.read()
 
+def ingest_table(q_client, file_path, col_name, start_id, writer=None):
+    """表格列分批嵌入並寫入，記憶體用量與表格大小無關；回傳寫入筆數
+    給定 writer 時各列依序接在 file_path 來源後面，payload 只記 offset"""
+    batch, count = [], 0
+    def flush():
+        spans = [writer.append(file_path, c) if writer else (None, None) for c in batch]
+        q_client.upload_collection(col_name, vectors=get_embeddings(batch), ids=range(start_id + count, start_id + count + len(batch)),
+                                   payload=[chunk_payload(c, file_path, start, end, chunk=f"table#{count + i}")
+                                            for i, (c, (start, end)) in enumerate(zip(batch, spans))])
+        return len(batch)
+    for chunk in iter_table_chunks(file_path):
+        batch.append(chunk)
+        if len(batch) >= TABLE_EMBED_BATCH:
+            count += flush()
+            batch = []
+    if batch:
+        count += flush()
+    return count
+
 # ================= 3. 主流程 =================
 
 def main():
+    q_client = connect_qdrant()
+
     # 1. 讀取與切塊
     with open("text.txt", "r", encoding="utf-8") as f:
         content = f.read()
     
-    chunks_f = fixed_size_chunking(content, 300)
-    chunks_s = sliding_window_chunking(content, 300, 100)
+    src = TextSource(content)
+    spans_f = list(fixed_spans(src, 300))
+    spans_s = list(sliding_spans(src, 300, 100))
+    chunks_f = chunk_texts(src, spans_f)
+    chunks_s = chunk_texts(src, spans_s)
 
     # 2. 嵌入與存入 Qdrant
-    print("\n--- 正在存入 Qdrant VDB ---")
-    all_chunks = chunks_f + chunks_s
+    print(f"\n--- 正在存入 Qdrant VDB (量化: {describe()}) ---")
+    # 固定切塊與滑動視窗大量重疊，近似重複的 chunk 只嵌入代表，並在 payload 記錄被合併的來源
+    items = [{"id": f"fixed#{i}", "text": c, "span": s} for i, (c, s) in enumerate(zip(chunks_f, spans_f))] + \
+            [{"id": f"sliding#{i}", "text": c, "span": s} for i, (c, s) in enumerate(zip(chunks_s, spans_s))]
+    kept, dup_map = dedupe(items)
+    merged = {}
+    for dropped, rep in dup_map.items():
+        merged.setdefault(rep, []).append(dropped)
+    print(f"🧹 去重：{len(items)} → {len(kept)} 個 chunk")
+    all_chunks = [item["text"] for item in kept]
     vectors = get_embeddings(all_chunks)
     
-    if vectors:
+    if len(vectors):
         col_name = "hw02_collection"
         q_client.recreate_collection(
             collection_name=col_name,
-            vectors_config=VectorParams(size=len(vectors[0]), distance=Distance.COSINE)
+            vectors_config=vector_params(vectors.shape[1])
         )
-        points = [PointStruct(id=i, vector=v, payload={"text": c}) for i, (v, c) in enumerate(zip(vectors, all_chunks))]
-        q_client.upsert(col_name, points)
-        print(f"✅ 成功將 {len(points)} 個 Points 存入 Dashboard")
+        # store 模式：text.txt 只存一份，重疊的切塊在 payload 中只剩 offset；表格匯入失敗時仍會寫出索引
+        with (TextStoreWriter(TEXT_STORE_DIR) if payload_mode() == "store" else nullcontext()) as writer:
+            if writer: writer.add("text.txt", content)
+            q_client.upload_collection(col_name, vectors=vectors, ids=range(len(kept)),
+                                       payload=[chunk_payload(item["text"], "text.txt", *item["span"], chunk=item["id"],
+                                                              duplicates=merged.get(item["id"], [])) for item in kept])
+            print(f"✅ 成功將 {len(kept)} 個 Points 存入 Dashboard (payload 文字: {payload_mode()})")
+            rows = ingest_table(q_client, "table_html.html", col_name, start_id=len(kept), writer=writer) if os.path.exists("table_html.html") else 0
+        print(f"✅ 表格逐列存入 {rows} 個 Points")
 
     # 3. 召回比較
     query = "Graph RAG 與傳統 RAG 的差異是什麼？"
@@ -1,12 +1,20 @@
 import os
 import csv
 import time
-import requests
+import sys
+import numpy as np
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, VectorParams, PointStruct
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(SCRIPT_DIR)))
+from rag_common.transport import get_transport
+from rag_common.embeddings import post_embeddings
+from rag_common.context_packer import pack_context
+from rag_common.tracing import span, get_tracer, text_bytes
+from rag_common.quantization import vector_params, search_params, describe
+from rag_common.text_store import TextStoreWriter, chunk_payload, payload_mode, open_store, hydrate
+
 EMBED_API_URL = "https://ws-04.wade0426.me/embed"
 LLM_API_URL = "https://ws-02.wade0426.me/v1/chat/completions"
 LLM_MODEL = "google/gemma-3-27b-it"
@@ -14,22 +22,29 @@ LLM_MODEL = "google/gemma-3-27b-it"
 COLLECTION_NAME = "CW_03" 
 CHUNK_SIZE = 300
 CHUNK_OVERLAP = 100
+CONTEXT_BUDGET = 600  # 回答 prompt 中參考資料的 token 上限
+TRACE_FILE = os.path.join(SCRIPT_DIR, "trace_cw03.json")
+TEXT_STORE_DIR = os.path.join(SCRIPT_DIR, "text_store")  # RAG_PAYLOAD_TEXT=store 時 chunk 文字存這裡
 
 def get_embedding(texts):
+    """回傳 ((n, dim) float32 陣列, 維度)；失敗時為 (None, 0)"""
     try:
-        res = requests.post(EMBED_API_URL, json={
-            "texts": texts, "task_description": "檢索文件", "normalize": True
-        }, timeout=30).json()
-        return res.get("embeddings", []), len(res.get("embeddings", [[]])[0])
+        with span("embed", items=len(texts), bytes_in=text_bytes(texts)):
+            embs = post_embeddings(EMBED_API_URL, {
+                "texts": texts, "task_description": "檢索文件", "normalize": True
+            }, timeout=30)
+        return embs, embs.shape[1]
     except: return None, 0
 
-def call_llm(system_prompt, user_prompt):
+def call_llm(system_prompt, user_prompt, name="llm"):
     try:
-        res = requests.post(LLM_API_URL, json={
-            "model": LLM_MODEL,
-            "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
-            "temperature": 0.1
-        }, timeout=60).json()
+        with span("llm", name, bytes_in=text_bytes([system_prompt, user_prompt])) as s:
+            res = get_transport().post_json(LLM_API_URL, {
+                "model": LLM_MODEL,
+                "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
+                "temperature": 0.1
+            }, timeout=60)
+            s.usage(res)
         return res["choices"][0]["message"]["content"].strip()
     except: return ""
 
@@ -40,23 +55,34 @@ def main():
     print(f"🚀 初始化 VDB: {COLLECTION_NAME}")
     _, dim = get_embedding(["測試"])
     if client.collection_exists(COLLECTION_NAME): client.delete_collection(COLLECTION_NAME)
-    client.create_collection(COLLECTION_NAME, vectors_config=VectorParams(size=dim, distance=Distance.COSINE))
+    client.create_collection(COLLECTION_NAME, vectors_config=vector_params(dim))
+    print(f"  量化: {describe()}，payload 文字: {payload_mode()}")
 
-    splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
-    all_points = []
-    p_idx = 0
+    # add_start_index 記錄每塊在原文的 offset，檢索後可合併重疊的相鄰塊
+    splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, add_start_index=True)
+    # 向量以 numpy 陣列累積，payload 另外存，寫入時才由 client 逐批序列化
+    all_vectors, all_payloads = [], []
+    writer = TextStoreWriter(TEXT_STORE_DIR) if payload_mode() == "store" else None
     for i in range(1, 6):
         path = os.path.join(SCRIPT_DIR, f"data_0{i}.txt")
         if os.path.exists(path):
             with open(path, "r", encoding="utf-8") as f:
-                chunks = splitter.split_text(f.read())
-                embs, _ = get_embedding(chunks)
-                if embs:
-                    for c, e in zip(chunks, embs):
-                        all_points.append(PointStruct(id=p_idx, vector=e, payload={"text": c, "source": f"data_0{i}.txt"}))
-                        p_idx += 1
-    client.upsert(COLLECTION_NAME, all_points)
-    print(f"已存入 {p_idx} 個語意塊")
+                content = f.read()
+                with span("parse", "split", source=f"data_0{i}.txt"):
+                    docs = splitter.create_documents([content])
+                embs, _ = get_embedding([d.page_content for d in docs])
+                if embs is not None and len(embs):
+                    if writer: writer.add(f"data_0{i}.txt", content)
+                    all_vectors.append(embs)
+                    for d in docs:
+                        start = d.metadata["start_index"]
+                        all_payloads.append(chunk_payload(d.page_content, f"data_0{i}.txt", start, start + len(d.page_content)))
+    if writer: writer.close()
+    store = open_store(TEXT_STORE_DIR)
+    if all_vectors:
+        client.upload_collection(COLLECTION_NAME, vectors=np.concatenate(all_vectors), payload=all_payloads,
+                                 ids=range(len(all_payloads)), wait=True)
+    print(f"已存入 {len(all_payloads)} 個語意塊")
 
     # 2. 處理 Re_Write_questions.csv
     print("\n執行 Query ReWrite 回答流程...")
@@ -84,18 +110,20 @@ def main():
             else:
                 rewrite_sys = "你是一個查詢重寫專家。結合歷史將新問題改寫為適合 VDB 搜尋的獨立句子，嚴禁解釋。"
                 rewrite_usr = f"歷史：{history}\n最新問題：{user_q}"
-                search_query = call_llm(rewrite_sys, rewrite_usr).split('\n')[0].replace('"', '')
+                search_query = call_llm(rewrite_sys, rewrite_usr, "rewrite").split('\n')[0].replace('"', '')
             
             print(f"  🔎 搜尋句: {search_query}")
 
             q_emb, _ = get_embedding([search_query])
-            hits = client.query_points(COLLECTION_NAME, query=q_emb[0], limit=3).points
-            context = "\n".join([h.payload["text"] for h in hits])
+            with span("search", limit=3):
+                hits = client.query_points(COLLECTION_NAME, query=q_emb[0], limit=3, search_params=search_params()).points
+            hydrate(hits, store)
+            context, _ = pack_context([dict(h.payload, score=h.score) for h in hits], CONTEXT_BUDGET)
             source = hits[0].payload["source"] if hits else "未知"
 
             ans_sys = "你是一個專業助理，請根據參考資料簡短回答問題。"
             ans_usr = f"參考資料：\n{context}\n\n問題：{user_q}"
-            answer = call_llm(ans_sys, ans_usr)
+            answer = call_llm(ans_sys, ans_usr, "answer")
 
             q.update({"answer": answer, "source": source})
             final_results.append(q)
@@ -108,6 +136,7 @@ def main():
         writer.writerows(final_results)
     
     print(f"\n結果已存至: {out_path}")
+    get_tracer().finish(TRACE_FILE)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
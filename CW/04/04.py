@@ -1,67 +1,105 @@
 import os
 import csv
+import time
 import uuid
+import argparse
 import torch
-import requests
+import sys
 from qdrant_client import QdrantClient, models
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from transformers import AutoTokenizer, AutoModelForCausalLM
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(SCRIPT_DIR)))
+from rag_common.transport import get_transport
+from rag_common.embeddings import post_embeddings
+from rag_common.context_packer import pack_context
+from rag_common.tracing import span, traced, get_tracer, text_bytes
+from rag_common.eval_runner import run_concurrent
+from rag_common.quantization import vector_params, search_params, describe
+from rag_common import matryoshka
+from rag_common.text_store import TextStoreWriter, chunk_payload, payload_mode, open_store, hydrate
+
 EMBED_API_URL = "https://ws-04.wade0426.me/embed"
 LLM_API_URL = "https://ws-02.wade0426.me/v1/chat/completions"
 LLM_MODEL = "google/gemma-3-27b-it"
 
-RERANKER_PATH = "/home/tmjh1224/AI/Models/Qwen3-Reranker-0.6B"
+RERANKER_PATH = os.environ.get("RERANKER_PATH", "/home/tmjh1224/AI/Models/Qwen3-Reranker-0.6B")
+RERANK_BATCH_SIZE = int(os.environ.get("RERANK_BATCH_SIZE", "1"))  # 顯存有限時維持 1
 
 COLLECTION_NAME = "CW_04_Hybrid_Rerank"
 CHUNK_SIZE = 400
 CHUNK_OVERLAP = 100
+UPSERT_BATCH = 64
+CONTEXT_BUDGET = 800  # 回答 prompt 中參考資料的 token 上限
+TRACE_FILE = os.path.join(SCRIPT_DIR, "trace_cw04.json")
+TEXT_STORE_DIR = os.path.join(SCRIPT_DIR, "text_store")  # RAG_PAYLOAD_TEXT=store 時 chunk 文字存這裡
+
+# 批次模式 (--bulk) 參數
+EMBED_BATCH = 64          # 每次嵌入請求的問題數
+SEARCH_BATCH = 32         # 每次 query_batch_points 的查詢數
+RERANK_BULK_BATCH = int(os.environ.get("RERANK_BULK_BATCH", "16"))  # 跨問題共用的 rerank 批次大小
+LLM_CONCURRENCY = 8
+SEARCH_LIMIT = 15
+RERANK_INSTRUCT = "根據查詢檢索相關文件"
 
-print("⌛ 正在載入 Reranker 模型 (開啟 FP16 半精度模式)...")
-reranker_tokenizer = AutoTokenizer.from_pretrained(RERANKER_PATH, trust_remote_code=True)
-reranker_model = AutoModelForCausalLM.from_pretrained(
-    RERANKER_PATH, 
-    trust_remote_code=True,
-    dtype=torch.float16
-).eval()
+# Reranker 於第一次 rerank 時才載入，匯入本模組 (例如 benchmark) 不必等模型
+_reranker = None
 
-if torch.cuda.is_available():
-    reranker_model.to("cuda")
+def set_reranker(tokenizer, model):
+    """指定 reranker (tokenizer 需為左側 padding，才能取最後一個位置的 logits)"""
+    global _reranker
+    _reranker = (tokenizer, model, tokenizer.convert_tokens_to_ids("no"), tokenizer.convert_tokens_to_ids("yes"))
+    return _reranker
 
-token_false_id = reranker_tokenizer.convert_tokens_to_ids("no")
-token_true_id = reranker_tokenizer.convert_tokens_to_ids("yes")
+def get_reranker():
+    if _reranker is None:
+        print("⌛ 正在載入 Reranker 模型 (開啟 FP16 半精度模式)...")
+        tokenizer = AutoTokenizer.from_pretrained(RERANKER_PATH, trust_remote_code=True, padding_side="left")
+        model = AutoModelForCausalLM.from_pretrained(
+            RERANKER_PATH,
+            trust_remote_code=True,
+            dtype=torch.float16
+        ).eval()
+        if torch.cuda.is_available():
+            model.to("cuda")
+        set_reranker(tokenizer, model)
+    return _reranker
 
 def get_embeddings(texts, task="檢索文件"):
+    """回傳 (n, dim) float32 陣列；失敗時為 None"""
     try:
-        res = requests.post(EMBED_API_URL, json={
-            "texts": texts, "task_description": task, "normalize": True
-        }, timeout=30).json()
-        return res.get("embeddings", [])
+        with span("embed", task, items=len(texts), bytes_in=text_bytes(texts)):
+            return post_embeddings(EMBED_API_URL, {
+                "texts": texts, "task_description": task, "normalize": True
+            }, timeout=30)
     except: return None
 
 def call_llm(system_prompt, user_prompt):
     try:
-        res = requests.post(LLM_API_URL, json={
-            "model": LLM_MODEL,
-            "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
-            "temperature": 0.1
-        }, timeout=60).json()
+        with span("llm", "answer", bytes_in=text_bytes([system_prompt, user_prompt])) as s:
+            res = get_transport().post_json(LLM_API_URL, {
+                "model": LLM_MODEL,
+                "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
+                "temperature": 0.1
+            }, timeout=60)
+            s.usage(res)
         return res["choices"][0]["message"]["content"].strip()
     except: return "無法產生答案"
 
+def rerank_pair(query, doc):
+    return f"<Instruct>: {RERANK_INSTRUCT}\n<Query>: {query}\n<Document>: {doc}"
+
 @torch.no_grad()
-def rerank_docs(query, candidates, initial_points, limit=3):
-    """ 使用 Batching (分批處理) 解決 6GB 顯存 OOM 問題 """
-    if not candidates: return []
-    
-    pairs = [f"<Instruct>: 根據查詢檢索相關文件\n<Query>: {query}\n<Document>: {doc}" for doc in candidates]
-    
-    all_scores = []
-    batch_size = 1 # 顯存有限，強制一批一筆
+def score_pairs(pairs, batch_size=RERANK_BATCH_SIZE):
+    """計算每個 (查詢, 文件) 組合的相關分數；先依長度排序再分批，同批 padding 最少"""
+    reranker_tokenizer, reranker_model, token_false_id, token_true_id = get_reranker()
+    order = sorted(range(len(pairs)), key=lambda i: len(pairs[i]))
+    all_scores = [0.0] * len(pairs)
     
-    for i in range(0, len(pairs), batch_size):
-        batch_pairs = pairs[i : i + batch_size]
+    for i in range(0, len(order), batch_size):
+        idx = order[i : i + batch_size]
+        batch_pairs = [pairs[j] for j in idx]
         inputs = reranker_tokenizer(
             batch_pairs, padding=True, truncation=True, return_tensors="pt", max_length=2048
         )
@@ -70,53 +108,166 @@ def rerank_docs(query, candidates, initial_points, limit=3):
         logits = reranker_model(**inputs).logits[:, -1, :]
         batch_scores = torch.stack([logits[:, token_false_id], logits[:, token_true_id]], dim=1)
         batch_scores = torch.nn.functional.softmax(batch_scores, dim=1)[:, 1].tolist()
-        all_scores.extend(batch_scores)
+        for j, score in zip(idx, batch_scores):
+            all_scores[j] = score
         
         del inputs, logits
-        torch.cuda.empty_cache()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    return all_scores
 
+def top_reranked(candidates, scores, initial_points, limit):
     combined = []
     for i in range(len(candidates)):
+        payload = initial_points[i].payload
         combined.append({
             "text": candidates[i],
-            "score": all_scores[i],
-            "source": initial_points[i].payload.get("source", "未知")
+            "score": scores[i],
+            "source": payload.get("source", "未知"),
+            "start": payload.get("start"),
+            "end": payload.get("end"),
         })
     combined.sort(key=lambda x: x["score"], reverse=True)
     return combined[:limit]
 
-def main():
+@traced("rerank")
+def rerank_docs(query, candidates, initial_points, limit=3, batch_size=RERANK_BATCH_SIZE):
+    """ 使用 Batching (分批處理) 解決 6GB 顯存 OOM 問題 """
+    if not candidates: return []
+    scores = score_pairs([rerank_pair(query, doc) for doc in candidates], batch_size)
+    return top_reranked(candidates, scores, initial_points, limit)
+
+def rerank_many(queries, point_lists, limit=3, batch_size=RERANK_BULK_BATCH):
+    """多個問題的候選攤平成一串 pair 共用批次計算，再依問題切回各自的前 limit 名"""
+    pairs = [rerank_pair(q, p.payload["text"]) for q, points in zip(queries, point_lists) for p in points]
+    with span("rerank", "bulk", items=len(pairs), questions=len(queries)):
+        scores = score_pairs(pairs, batch_size) if pairs else []
+    out, pos = [], 0
+    for points in point_lists:
+        n = len(points)
+        out.append(top_reranked([p.payload["text"] for p in points], scores[pos:pos + n], points, limit))
+        pos += n
+    return out
+
+def hybrid_prefetch(question, q_emb):
+    return [
+        models.Prefetch(query=models.Document(text=question, model="Qdrant/bm25"), using="sparse", limit=SEARCH_LIMIT),
+        matryoshka.dense_prefetch(q_emb, SEARCH_LIMIT, search_params()),
+    ]
+
+def search_many(client, questions, q_embs, store=None):
+    """以 query_batch_points 一次送出多個 Hybrid RRF 查詢"""
+    results = []
+    for i in range(0, len(questions), SEARCH_BATCH):
+        requests = [
+            models.QueryRequest(prefetch=hybrid_prefetch(q, e), query=models.FusionQuery(fusion=models.Fusion.RRF),
+                                limit=SEARCH_LIMIT, with_payload=True)
+            for q, e in zip(questions[i:i + SEARCH_BATCH], q_embs[i:i + SEARCH_BATCH])
+        ]
+        with span("search", "hybrid_batch", items=len(requests), limit=SEARCH_LIMIT):
+            results.extend(hydrate(r.points, store) for r in client.query_batch_points(COLLECTION_NAME, requests=requests))
+    return results
+
+def answer_prompt(user_q, reranked_results):
+    context, _ = pack_context(reranked_results, CONTEXT_BUDGET)
+    ans_sys = "你是一個專業助手，請根據參考資料簡短回答問題。若參考資料中沒有提到，請回答不知道。"
+    ans_usr = f"參考資料：\n{context}\n\n問題：{user_q}"
+    return ans_sys, ans_usr
+
+def answer_sequential(client, rows, store=None):
+    """逐題：嵌入 → Hybrid Search → Rerank → 回答"""
+    for r in rows:
+        user_q = r.get('題目') or r.get('questions')
+        
+        # A. Hybrid Search
+        q_emb = get_embeddings([user_q], task="查詢")[0]
+        with span("search", "hybrid", limit=SEARCH_LIMIT):
+            search_res = client.query_points(
+                collection_name=COLLECTION_NAME,
+                prefetch=hybrid_prefetch(user_q, q_emb),
+                query=models.FusionQuery(fusion=models.Fusion.RRF),
+                limit=SEARCH_LIMIT
+            ).points
+        hydrate(search_res, store)
+
+        # B. Reranking (加入分批處理以防 Timeout/OOM)
+        candidates = [p.payload["text"] for p in search_res]
+        reranked_results = rerank_docs(user_q, candidates, search_res, limit=3)
+        top_source = reranked_results[0]["source"] if reranked_results else "未知"
+        answer = call_llm(*answer_prompt(user_q, reranked_results))
+
+        # 填入老師要求的中文欄位
+        r["標準答案"] = answer
+        r["來源文件"] = top_source
+        print(f"  - 完成: {user_q[:15]}...")
+
+def answer_bulk(client, rows, llm_concurrency=LLM_CONCURRENCY, store=None):
+    """批次：問題分批嵌入 → query_batch_points → 跨問題共用 rerank 批次 → 併發呼叫 LLM"""
+    questions = [r.get('題目') or r.get('questions') for r in rows]
+    q_embs = []
+    for i in range(0, len(questions), EMBED_BATCH):
+        embs = get_embeddings(questions[i:i + EMBED_BATCH], task="查詢")
+        if embs is None:
+            raise RuntimeError("問題嵌入失敗")
+        q_embs.extend(embs)
+    print(f"  ✔ 已嵌入 {len(q_embs)} 個問題")
+
+    point_lists = search_many(client, questions, q_embs, store)
+    print(f"  ✔ 批次檢索完成")
+    reranked = rerank_many(questions, point_lists, limit=3)
+    print(f"  ✔ Rerank 完成 ({sum(len(p) for p in point_lists)} 組)")
+
+    def _answer(i):
+        rows[i]["標準答案"] = call_llm(*answer_prompt(questions[i], reranked[i]))
+        rows[i]["來源文件"] = reranked[i][0]["source"] if reranked[i] else "未知"
+        print(f"  - 完成: {questions[i][:15]}...")
+        return i
+    run_concurrent(range(len(rows)), _answer, llm_concurrency)
+
+def main(bulk=False, llm_concurrency=LLM_CONCURRENCY):
     # 增加 timeout=60 解決 Qdrant ReadTimeout 問題
     client = QdrantClient("localhost", port=6333, timeout=60)
     
     # 1. 初始化 VDB
-    print(f"🚀 初始化集合: {COLLECTION_NAME}")
+    print(f"🚀 初始化集合: {COLLECTION_NAME} (量化: {describe()})")
     sample_emb = get_embeddings(["測試維度"])
-    dim = len(sample_emb[0]) if sample_emb else 4096
+    dim = sample_emb.shape[1] if sample_emb is not None else 4096
+    print(f"  Matryoshka 兩階段檢索: {matryoshka.describe(dim)}")
     if client.collection_exists(COLLECTION_NAME): client.delete_collection(COLLECTION_NAME)
     client.create_collection(
         collection_name=COLLECTION_NAME,
-        vectors_config={"dense": models.VectorParams(size=dim, distance=models.Distance.COSINE)},
+        vectors_config=matryoshka.dense_config(dim, vector_params),
         sparse_vectors_config={"sparse": models.SparseVectorParams(modifier=models.Modifier.IDF)}
     )
 
-    splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    # add_start_index 記錄每塊在原文的 offset，rerank 後可合併重疊的相鄰塊
+    splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, add_start_index=True)
+    writer = TextStoreWriter(TEXT_STORE_DIR) if payload_mode() == "store" else None
     for i in range(1, 6):
         path = os.path.join(SCRIPT_DIR, f"data_0{i}.txt")
         if os.path.exists(path):
             with open(path, "r", encoding="utf-8") as f:
-                chunks = splitter.split_text(f.read())
+                content = f.read()
+                with span("parse", "split", source=f"data_0{i}.txt"):
+                    docs = splitter.create_documents([content])
+                chunks = [d.page_content for d in docs]
                 embs = get_embeddings(chunks)
-                if embs:
-                    points = [
-                        models.PointStruct(
-                            id=uuid.uuid4().hex,
-                            vector={"dense": emb, "sparse": models.Document(text=chunk, model="Qdrant/bm25")},
-                            payload={"text": chunk, "source": f"data_0{i}.txt"}
-                        ) for chunk, emb in zip(chunks, embs)
-                    ]
-                    client.upsert(COLLECTION_NAME, points)
-    print("知識庫索引建立完成 (Hybrid)")
+                if embs is not None:
+                    if writer: writer.add(f"data_0{i}.txt", content)
+                    # PointStruct 會把向量轉成 list，逐批建立，同時間只有一批的 Python float
+                    for s in range(0, len(chunks), UPSERT_BATCH):
+                        points = [
+                            models.PointStruct(
+                                id=uuid.uuid4().hex,
+                                vector={**matryoshka.dense_vectors(emb), "sparse": models.Document(text=chunk, model="Qdrant/bm25")},
+                                payload=chunk_payload(chunk, f"data_0{i}.txt", d.metadata["start_index"],
+                                                      d.metadata["start_index"] + len(chunk))
+                            ) for d, chunk, emb in zip(docs[s:s + UPSERT_BATCH], chunks[s:s + UPSERT_BATCH], embs[s:s + UPSERT_BATCH])
+                        ]
+                        client.upsert(COLLECTION_NAME, points)
+    if writer: writer.close()
+    store = open_store(TEXT_STORE_DIR)
+    print(f"知識庫索引建立完成 (Hybrid，payload 文字: {payload_mode()})")
 
     input_csv = os.path.join(SCRIPT_DIR, "questions.csv")
     if not os.path.exists(input_csv):
@@ -126,37 +277,14 @@ def main():
         reader = csv.DictReader(f)
         rows = list(reader)
 
-    print(f"開始處理 {len(rows)} 個問題 (Hybrid Search + Rerank)...")
-    for r in rows:
-        user_q = r.get('題目') or r.get('questions')
-        
-        # A. Hybrid Search
-        q_emb = get_embeddings([user_q], task="查詢")[0]
-        search_res = client.query_points(
-            collection_name=COLLECTION_NAME,
-            prefetch=[
-                models.Prefetch(query=models.Document(text=user_q, model="Qdrant/bm25"), using="sparse", limit=15),
-                models.Prefetch(query=q_emb, using="dense", limit=15),
-            ],
-            query=models.FusionQuery(fusion=models.Fusion.RRF),
-            limit=15
-        ).points
-
-        # B. Reranking (加入分批處理以防 Timeout/OOM)
-        candidates = [p.payload["text"] for p in search_res]
-        reranked_results = rerank_docs(user_q, candidates, search_res, limit=3)
-        
-        context = "\n".join([item["text"] for item in reranked_results])
-        top_source = reranked_results[0]["source"] if reranked_results else "未知"
-
-        ans_sys = "你是一個專業助手，請根據參考資料簡短回答問題。若參考資料中沒有提到，請回答不知道。"
-        ans_usr = f"參考資料：\n{context}\n\n問題：{user_q}"
-        answer = call_llm(ans_sys, ans_usr)
-
-        # 填入老師要求的中文欄位
-        r["標準答案"] = answer
-        r["來源文件"] = top_source
-        print(f"  - 完成: {user_q[:15]}...")
+    print(f"開始處理 {len(rows)} 個問題 (Hybrid Search + Rerank{'，批次模式' if bulk else ''})...")
+    start = time.perf_counter()
+    if bulk:
+        answer_bulk(client, rows, llm_concurrency, store)
+    else:
+        answer_sequential(client, rows, store)
+    elapsed = time.perf_counter() - start
+    print(f"⏱️ {len(rows)} 題耗時 {elapsed:.1f} 秒 ({len(rows) / elapsed * 60:.1f} 題/分鐘)")
 
     output_path = os.path.join(SCRIPT_DIR, "questions_answer_final.csv")
     with open(output_path, "w", encoding="utf-8-sig", newline="") as f:
@@ -165,6 +293,11 @@ def main():
         writer.writerows(rows)
     
     print(f"\n請檢查檔案: {output_path}")
+    get_tracer().finish(TRACE_FILE)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bulk", action="store_true", help="批次模式：問題分批嵌入、批次檢索、共用 rerank 批次、併發回答")
+    parser.add_argument("--llm-concurrency", type=int, default=LLM_CONCURRENCY)
+    args = parser.parse_args()
+    main(args.bulk, args.llm_concurrency)
\ No newline at end of file
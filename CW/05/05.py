@@ -1,52 +1,286 @@
-import pdfplumber
-from docling.document_converter import DocumentConverter
-from markitdown import MarkItDown
 import os
+import sys
+import glob
+import json
+import time
+import argparse
+import resource
+import multiprocessing as mp
 
-def run_conversion_tasks(pdf_path):
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(SCRIPT_DIR)))
+from rag_common.conversion_cache import ConversionCache, contiguous_runs
+from rag_common.conversion_pool import ConversionPool, PoolClient, DEFAULT_ADDRESS, AUTHKEY_ENV, serve
+
+# 各引擎的輸出檔名 (重量級套件改為在函數內延遲載入，避免 benchmark 子程序互相影響記憶體量測)
+OUTPUT_FILES = {
+    "pdfplumber": "result_pdfplumber.md",
+    "docling": "result_docling.md",
+    "markitdown": "result_markitdown.md",
+}
+SHARDABLE_ENGINES = ("pdfplumber", "docling")
+SHARD_SIZE = 4  # 每個 worker 任務處理的頁數
+
+def count_pages(pdf_path):
+    import pdfplumber
+    with pdfplumber.open(pdf_path) as pdf:
+        return len(pdf.pages)
+
+def write_plumber_pages(pdf, f):
+    """逐頁寫入，不在記憶體中串接整份文字"""
+    for page in pdf.pages:
+        text = page.extract_text()
+        if text:
+            f.write(text + "\n\n")
+
+def plumber_pages(pdf_path, pages):
+    """轉換指定頁 (1-based)，回傳 {頁碼: 文字}"""
+    import pdfplumber
+    with pdfplumber.open(pdf_path) as pdf:
+        return {p: pdf.pages[p - 1].extract_text() or "" for p in pages}
+
+def docling_pages(pdf_path, pages, converter=None):
+    """以 page_range 逐段轉換連續頁，回傳 {頁碼: markdown}"""
+    if converter is None:
+        from docling.document_converter import DocumentConverter
+        converter = DocumentConverter()
+    out = {}
+    for start, end in contiguous_runs(pages):
+        doc = converter.convert(pdf_path, page_range=(start, end)).document
+        out.update({p: doc.export_to_markdown(page_no=p) for p in range(start, end + 1)})
+    return out
+
+def markitdown_document(path):
+    from markitdown import MarkItDown
+    return MarkItDown().convert(path).text_content
+
+def run_conversion_tasks(pdf_path, cache=None, client=None):
     print(f"開始處理檔案: {pdf_path}\n" + "-"*30)
 
     # 1. 使用 pdfplumber 實作
     try:
-        output_md_plumber = "result_pdfplumber.md"
-        with pdfplumber.open(pdf_path) as pdf:
-            full_text = ""
-            for page in pdf.pages:
-                text = page.extract_text()
-                if text:
-                    full_text += text + "\n\n"
-        with open(output_md_plumber, "w", encoding="utf-8") as f:
-            f.write(full_text)
+        if cache:
+            pages = cache.convert_pages(pdf_path, "pdfplumber", plumber_pages)
+            with open(OUTPUT_FILES["pdfplumber"], "w", encoding="utf-8") as f:
+                f.writelines(text + "\n\n" for text in pages if text)
+        else:
+            import pdfplumber
+            with pdfplumber.open(pdf_path) as pdf, open(OUTPUT_FILES["pdfplumber"], "w", encoding="utf-8") as f:
+                write_plumber_pages(pdf, f)
         print("pdfplumber 已完成")
     except Exception as e:
         print(f"pdfplumber 執行失敗: {e}")
 
-    # 2. 使用 Docling 實作
+    # 2. 使用 Docling 實作 (快取全部命中時不必建立 converter；有常駐服務時交給已暖機的 worker)
     try:
-        output_md_docling = "result_docling.md"
-        converter = DocumentConverter()
-        result = converter.convert(pdf_path)
-        markdown_content = result.document.export_to_markdown()
-        with open(output_md_docling, "w", encoding="utf-8") as f:
+        if cache:
+            convert_fn = client.page_converter() if client else docling_pages
+            markdown_content = "\n\n".join(cache.convert_pages(pdf_path, "docling", convert_fn))
+        elif client:
+            markdown_content = client.convert(pdf_path)["markdown"]
+        else:
+            from docling.document_converter import DocumentConverter
+            converter = DocumentConverter()
+            result = converter.convert(pdf_path)
+            markdown_content = result.document.export_to_markdown()
+        with open(OUTPUT_FILES["docling"], "w", encoding="utf-8") as f:
             f.write(markdown_content)
         print("Docling 已完成")
     except Exception as e:
         print(f"Docling 執行失敗: {e}")
 
-    # 3. 使用 MarkItDown 實作
+    # 3. 使用 MarkItDown 實作 (不支援逐頁，以整份檔案為快取單位)
     try:
-        output_md_markitdown = "result_markitdown.md"
-        md = MarkItDown()
-        result = md.convert(pdf_path)
-        with open(output_md_markitdown, "w", encoding="utf-8") as f:
-            f.write(result.text_content)
+        if cache:
+            text = cache.convert_document(pdf_path, "markitdown", markitdown_document)
+        else:
+            text = markitdown_document(pdf_path)
+        with open(OUTPUT_FILES["markitdown"], "w", encoding="utf-8") as f:
+            f.write(text)
         print("MarkItDown 已完成")
     except Exception as e:
         print(f"MarkItDown 執行失敗: {e}")
 
+    if cache:
+        print(cache.summary())
+
+# ================= 分頁平行轉換 =================
+
+_converter = None  # 每個 worker 行程各自初始化一次
+
+def _init_worker(engine):
+    global _converter
+    if engine == "docling":
+        from docling.document_converter import DocumentConverter
+        _converter = DocumentConverter()
+
+def _extract_shard(job):
+    """worker：轉換 [start, end) 範圍的頁面 (0-based)，回傳每頁文字"""
+    engine, pdf_path, start, end = job
+    if engine == "pdfplumber":
+        import pdfplumber
+        with pdfplumber.open(pdf_path) as pdf:
+            return [pdf.pages[i].extract_text() or "" for i in range(start, end)]
+    # Docling 的 page_range 為 1-based 且包含結尾
+    result = _converter.convert(pdf_path, page_range=(start + 1, end))
+    return [result.document.export_to_markdown(page_no=p) for p in range(start + 1, end + 1)]
+
+def run_sharded(pdf_path, engine, output_path, workers=os.cpu_count(), shard_size=SHARD_SIZE, cache=None):
+    """將 (未命中快取的) 頁面分片交給行程池，依頁序逐頁寫出，回傳頁數"""
+    if engine not in SHARDABLE_ENGINES:
+        raise ValueError(f"{engine} 不支援分頁轉換")
+    if cache:
+        keys, cached = cache.lookup_pages(pdf_path, engine)
+    else:
+        cached = [None] * count_pages(pdf_path)
+    total = len(cached)
+    missing = [i for i, md in enumerate(cached) if md is None]  # 0-based
+    jobs = [(engine, pdf_path, s, min(s + shard_size, end + 1))
+            for start, end in contiguous_runs(missing) for s in range(start, end + 1, shard_size)]
+
+    pool = mp.Pool(processes=min(workers, len(jobs)), initializer=_init_worker, initargs=(engine,)) if jobs else None
+    try:
+        # imap 保持頁序，先完成的分片一到即可寫出
+        results = zip(jobs, pool.imap(_extract_shard, jobs)) if pool else iter(())
+        ready = {}
+        with open(output_path, "w", encoding="utf-8") as f:
+            for i in range(total):
+                text = cached[i]
+                if text is None:
+                    while i not in ready:
+                        (_, _, start, end), texts = next(results)
+                        ready.update(zip(range(start, end), texts))
+                        f.flush()
+                    text = ready.pop(i)
+                    if cache:
+                        cache.put(engine, keys[i], text)
+                if text:
+                    f.write(text + "\n\n")
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return total
+
+# ================= 常駐 worker pool 批次轉換 =================
+
+def run_pool(corpus, workers, out_dir="pool_output"):
+    """以常駐 Docling worker 轉換資料夾內所有 PDF，區分啟動與穩態耗時"""
+    pdfs = sorted(glob.glob(os.path.join(corpus, "*.pdf"))) if os.path.isdir(corpus) else [corpus]
+    if not pdfs:
+        print(f"錯誤：{corpus} 中沒有 PDF 檔案。")
+        return
+    os.makedirs(out_dir, exist_ok=True)
+    with ConversionPool(workers) as pool:
+        pool.wait_ready()
+        for res in pool.map(pdfs):
+            name = os.path.splitext(os.path.basename(res["path"]))[0]
+            if "error" in res:
+                print(f"  ⚠️ {name} 轉換失敗: {res['error']}")
+                continue
+            with open(os.path.join(out_dir, name + ".md"), "w", encoding="utf-8") as f:
+                f.write(res["markdown"])
+            print(f"  - {name}: {res['seconds']:.2f} 秒 (worker {res['worker']})")
+        pool.print_stats()
+
+# ================= 引擎 Benchmark =================
+
+def _convert_whole(engine, pdf_path, output_path):
+    if engine == "markitdown":
+        from markitdown import MarkItDown
+        text = MarkItDown().convert(pdf_path).text_content
+    else:
+        _init_worker(engine)
+        text = "\n\n".join(_extract_shard((engine, pdf_path, 0, count_pages(pdf_path))))
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+def _bench_child(engine, pdf_path, workers, conn):
+    """在獨立子行程執行單一 (引擎, PDF)，避免套件載入與快取干擾量測"""
+    out_path = os.devnull
+    try:
+        pages = count_pages(pdf_path)
+        start = time.perf_counter()
+        if workers > 1 and engine in SHARDABLE_ENGINES:
+            run_sharded(pdf_path, engine, out_path, workers)
+        else:
+            _convert_whole(engine, pdf_path, out_path)
+        wall = time.perf_counter() - start
+        # Linux 上 ru_maxrss 單位為 KB；CHILDREN 為最大的 worker 行程
+        rss_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        rss_worker = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        conn.send({"pages": pages, "wall": wall, "rss_mb": rss_self, "worker_rss_mb": rss_worker})
+    except Exception as e:
+        conn.send({"error": str(e)})
+    finally:
+        conn.close()
+
+def run_benchmark(corpus, engines, workers, report_path="bench_report.json"):
+    pdfs = sorted(glob.glob(os.path.join(corpus, "*.pdf"))) if os.path.isdir(corpus) else [corpus]
+    if not pdfs:
+        print(f"錯誤：{corpus} 中沒有 PDF 檔案。")
+        return
+    ctx = mp.get_context("spawn")
+    report = {}
+    for engine in engines:
+        stats = {"pages": 0, "wall": 0.0, "peak_rss_mb": 0.0, "peak_worker_rss_mb": 0.0, "failed": []}
+        for pdf_path in pdfs:
+            parent, child = ctx.Pipe(duplex=False)
+            p = ctx.Process(target=_bench_child, args=(engine, pdf_path, workers, child))
+            p.start()
+            p.join()
+            res = parent.recv() if parent.poll() else {"error": f"子行程異常結束 (exit code {p.exitcode})"}
+            if "error" in res:
+                print(f"  ⚠️ {engine} 轉換 {pdf_path} 失敗: {res['error']}")
+                stats["failed"].append(pdf_path)
+                continue
+            stats["pages"] += res["pages"]
+            stats["wall"] += res["wall"]
+            stats["peak_rss_mb"] = max(stats["peak_rss_mb"], res["rss_mb"])
+            stats["peak_worker_rss_mb"] = max(stats["peak_worker_rss_mb"], res["worker_rss_mb"])
+        stats["pages_per_sec"] = stats["pages"] / stats["wall"] if stats["wall"] else 0.0
+        report[engine] = stats
+
+    print(f"\n📊 Benchmark ({len(pdfs)} 份 PDF, workers={workers})")
+    print(f"{'引擎':12}{'頁數':>6}{'wall(s)':>10}{'pages/s':>10}{'RSS(MB)':>10}{'worker RSS':>12}")
+    for engine, s in report.items():
+        print(f"{engine:12}{s['pages']:>6}{s['wall']:>10.2f}{s['pages_per_sec']:>10.2f}"
+              f"{s['peak_rss_mb']:>10.1f}{s['peak_worker_rss_mb']:>12.1f}")
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump({"corpus": pdfs, "workers": workers, "engines": report}, f, ensure_ascii=False, indent=2)
+    print(f"報告已存至 {report_path}")
+
 if __name__ == "__main__":
-    target_pdf = "example.pdf"
-    if os.path.exists(target_pdf):
-        run_conversion_tasks(target_pdf)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pdf", nargs="?", default="example.pdf")
+    parser.add_argument("--sharded", action="store_true", help="分頁平行轉換 (pdfplumber / docling)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--bench", metavar="CORPUS", help="對資料夾 (或單一檔案) 中的 PDF 做引擎 benchmark")
+    parser.add_argument("--engines", nargs="+", default=list(OUTPUT_FILES), choices=list(OUTPUT_FILES))
+    parser.add_argument("--no-cache", action="store_true", help="停用逐頁轉換快取")
+    parser.add_argument("--pool", metavar="CORPUS", help="以常駐 Docling worker pool 批次轉換資料夾 (或單一檔案) 中的 PDF")
+    parser.add_argument("--serve", nargs="?", const=DEFAULT_ADDRESS, metavar="ADDRESS",
+                        help=f"啟動常駐 Docling 轉換服務 (預設 {DEFAULT_ADDRESS})；authkey 隨機產生，"
+                             f"非本機位址需以 {AUTHKEY_ENV} 指定")
+    parser.add_argument("--server", metavar="ADDRESS", help="Docling 轉換改送到已啟動的常駐服務")
+    args = parser.parse_args()
+    cache = None if args.no_cache else ConversionCache()
+
+    if args.serve:
+        serve(args.serve, args.workers)
+    elif args.pool:
+        run_pool(args.pool, args.workers)
+    elif args.bench:
+        run_benchmark(args.bench, args.engines, args.workers)
+    elif not os.path.exists(args.pdf):
+        print(f"錯誤：在當前目錄找不到 {args.pdf} 檔案。")
+    elif args.sharded:
+        for engine in [e for e in args.engines if e in SHARDABLE_ENGINES]:
+            start = time.perf_counter()
+            pages = run_sharded(args.pdf, engine, OUTPUT_FILES[engine], args.workers, cache=cache)
+            print(f"{engine} 分頁轉換完成：{pages} 頁，耗時 {time.perf_counter() - start:.2f} 秒")
+    elif args.server:
+        with PoolClient(args.server) as client:
+            run_conversion_tasks(args.pdf, cache, client)
     else:
-        print(f"錯誤：在當前目錄找不到 {target_pdf} 檔案。")
\ No newline at end of file
+        run_conversion_tasks(args.pdf, cache)
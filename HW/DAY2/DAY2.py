@@ -1,49 +1,140 @@
+import os
+import sys
 import time
+import json
+import argparse
 import asyncio
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnableParallel
+from langchain_core.runnables import RunnableParallel, RunnableLambda
 from langchain_core.output_parsers import StrOutputParser
 
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(SCRIPT_DIR)))
+from rag_common.tracing import percentile
+
 llm = ChatOpenAI(
     base_url="https://ws-03.wade0426.me/v1",  # 注意：LangChain 會自動補上 /chat/completions
     model="/models/gpt-oss-120b",           # 修改為正確的模型路徑名稱
-    temperature=0, 
+    temperature=0,
     api_key="none"
 )
 
 vlm = ChatOpenAI(
-    base_url="https://ws-02.wade0426.me/v1", 
-    model="gemma-3-27b-it", 
-    temperature=0, 
+    base_url="https://ws-02.wade0426.me/v1",
+    model="gemma-3-27b-it",
+    temperature=0,
     api_key="none"
 )
 
 prompt1 = ChatPromptTemplate.from_template("寫一段關於{topic}的 LinkedIn 貼文")
 prompt2 = ChatPromptTemplate.from_template("寫一段關於{topic}的 Instagram 貼文")
 
-chain = RunnableParallel({
-    "linkedin": prompt1 | llm | StrOutputParser(),
-    "instagram": prompt2 | vlm | StrOutputParser()
-})
+# 各分支對應的後端 (llm / vlm)，批次模式依後端分別限制併發數
+branches = {
+    "linkedin": ("llm", prompt1 | llm | StrOutputParser()),
+    "instagram": ("vlm", prompt2 | vlm | StrOutputParser()),
+}
+
+chain = RunnableParallel({key: runnable for key, (_, runnable) in branches.items()})
+
+def timed(runnable):
+    """包裝分支，回傳輸出與單次延遲 (秒)"""
+    async def _run(inputs):
+        start = time.perf_counter()
+        text = await runnable.ainvoke(inputs)
+        return {"text": text, "latency": time.perf_counter() - start}
+    return RunnableLambda(_run)
+
+def load_topics(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+async def run_batch(topics, out_path, concurrency):
+    """每個分支各自 abatch，完成一個主題 (兩分支皆完成) 就寫入一行 JSONL"""
+    inputs = [{"topic": t} for t in topics]
+    pending = {}
+    latencies = {key: [] for key in branches}
+    errors = 0
+    queue = asyncio.Queue()
+
+    async def run_branch(key, backend, runnable):
+        config = {"max_concurrency": concurrency[backend]}
+        try:
+            async for idx, out in timed(runnable).abatch_as_completed(inputs, config=config, return_exceptions=True):
+                await queue.put((key, idx, out))
+        except Exception as e:
+            await queue.put((key, None, e))
+        finally:
+            # 分支結束 (含中途失敗) 一定送出結束標記，消費端才不會卡在 queue.get()
+            await queue.put((key, None, None))
+
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(run_branch(key, backend, r)) for key, (backend, r) in branches.items()]
+
+    done_topics = 0
+    finished = 0
+    with open(out_path, "w", encoding="utf-8") as f:
+        while finished < len(branches):
+            key, idx, out = await queue.get()
+            if idx is None:
+                if out is None:
+                    finished += 1
+                else:
+                    errors += 1
+                    print(f"  ⚠️ 分支 {key} 中止：{out}")
+                continue
+            record = pending.setdefault(idx, {"topic": topics[idx]})
+            if isinstance(out, Exception):
+                errors += 1
+                record[key] = None
+                record[f"{key}_error"] = str(out)
+            else:
+                latencies[key].append(out["latency"])
+                record[key] = out["text"]
+                record[f"{key}_latency"] = round(out["latency"], 3)
+            if all(k in record for k in branches):
+                f.write(json.dumps(pending.pop(idx), ensure_ascii=False) + "\n")
+                f.flush()
+                done_topics += 1
+                print(f"  - 完成 {done_topics}/{len(topics)}: {topics[idx][:15]}")
+        # 中止的分支沒有產出的主題，仍寫出已完成的另一分支
+        for idx in sorted(pending):
+            record = pending[idx]
+            for k in branches:
+                record.setdefault(k, None)
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    print("\n" + "="*50)
+    print(f"主題數：{len(topics)}  失敗分支：{errors}  總耗時：{elapsed:.2f} 秒")
+    print(f"吞吐量：{len(topics) / elapsed * 60:.2f} topics/min")
+    for key, (backend, _) in branches.items():
+        lat = latencies[key]
+        print(f"[{key} @ {backend}, 併發 {concurrency[backend]}] "
+              f"p50={percentile(lat, 50):.2f}s p90={percentile(lat, 90):.2f}s "
+              f"p99={percentile(lat, 99):.2f}s max={max(lat, default=0):.2f}s")
+    print(f"結果已寫入：{out_path}")
 
 async def main():
     topic = input("輸入主題：")
-    
+
     print("\n[流式輸出 (需看到不同主題交錯)]")
+    # 直接累積串流內容作為最終結果，不再另外 ainvoke 重新生成一次
+    result = {key: "" for key in branches}
+    start = time.time()
     async for chunk in chain.astream({"topic": topic}):
         for key in chunk:
+            result[key] += chunk[key]
             content = chunk[key].replace("\n", " ")
             print(f"{{'{key}': '{content}'}}")
             await asyncio.sleep(0.01)
+    end = time.time()
 
     print("\n" + "="*50)
-    print("批次處理")
-    
-    start = time.time()
-    result = await chain.ainvoke({"topic": topic})
-    end = time.time()
-    
+    print("彙整結果")
+
     print(f"耗時：{end - start:.2f} 秒")
     print("-" * 50)
     print(f"【LinkedIn 專家說】：\n{result['linkedin']}\n")
@@ -51,4 +142,15 @@ async def main():
     print("-" * 50)
 
 if __name__ == "__main__":
-    asyncio.run(main()) 
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--topics", help="批次模式：每行一個主題的文字檔")
+    parser.add_argument("--out", default="batch_results.jsonl")
+    parser.add_argument("--llm-concurrency", type=int, default=4)
+    parser.add_argument("--vlm-concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.topics:
+        concurrency = {"llm": args.llm_concurrency, "vlm": args.vlm_concurrency}
+        asyncio.run(run_batch(load_topics(args.topics), args.out, concurrency))
+    else:
+        asyncio.run(main())
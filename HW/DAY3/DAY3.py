@@ -1,11 +1,18 @@
 import time
 import requests
 import os
+import sys
 import subprocess
 from typing import TypedDict
 from langgraph.graph import StateGraph, START, END
 from langchain_openai import ChatOpenAI
 
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(SCRIPT_DIR)))
+from rag_common.tracing import span, traced, get_tracer, text_bytes
+
+TRACE_FILE = "trace_day3.json"
+
 # --- 1. 定義 State ---
 class State(TypedDict):
     audio_path: str
@@ -49,9 +56,11 @@ def convert_to_mp3(input_path: str) -> str:
 
 # --- 4. 定義 Nodes ---
 
+@traced("asr")
 def asr_node(state: State):
     # 先進行自動轉檔以應對不穩定的網路
-    safe_path = convert_to_mp3(state["audio_path"])
+    with span("parse", "ffmpeg"):
+        safe_path = convert_to_mp3(state["audio_path"])
     
     print(f"--- [Node 1] ASR 轉錄中... (使用檔案: {safe_path}) ---")
     BASE = "https://3090api.huannago.com"
@@ -93,13 +102,17 @@ def asr_node(state: State):
 def minutes_taker_node(state: State):
     print("--- [Node 2-A] 使用 120B 模型整理逐字稿... ---")
     prompt = f"請根據以下 SRT 內容整理成詳細逐字稿，格式為 [時間] 發言內容：\n\n{state['raw_srt']}"
-    response = llm_minutes.invoke(prompt)
+    with span("llm", "minutes", bytes_in=text_bytes(prompt)) as s:
+        response = llm_minutes.invoke(prompt)
+        s.usage(response)
     return {"minutes": response.content}
 
 def summarizer_node(state: State):
     print("--- [Node 2-B] 使用 Gemma-3 提取摘要... ---")
     prompt = f"請根據以下內容提取重點摘要：\n\n{state['raw_txt']}"
-    response = llm_summary.invoke(prompt)
+    with span("llm", "summary", bytes_in=text_bytes(prompt)) as s:
+        response = llm_summary.invoke(prompt)
+        s.usage(response)
     return {"summary": response.content}
 
 def writer_node(state: State):
@@ -127,4 +140,5 @@ if __name__ == "__main__":
     WAV_FILE = "./audio/Podcast_EP14.wav"
     if os.path.exists(WAV_FILE):
         final_output = app.invoke({"audio_path": WAV_FILE})
-        print(final_output["final_report"]) 
\ No newline at end of file
+        print(final_output["final_report"])
+        get_tracer().finish(TRACE_FILE) 
\ No newline at end of file
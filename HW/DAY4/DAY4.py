@@ -1,7 +1,7 @@
 import os
+import sys
 import operator
 import base64
-import requests
 import json
 from typing import Annotated, List, Dict, Union, TypedDict
 from langchain_openai import ChatOpenAI
@@ -10,6 +10,11 @@ from langchain_core.prompts import ChatPromptTemplate
 from langgraph.graph import StateGraph, END
 from playwright.sync_api import sync_playwright
 
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(SCRIPT_DIR)))
+from rag_common.transport import get_transport
+from rag_common.tracing import span, get_tracer, text_bytes
+
 # 1. 配置與工具函數
 
 # 模擬全域快取 (簡單字典實作)
@@ -33,6 +38,14 @@ llm_vlm = ChatOpenAI(
 
 # 3. SearXNG: 搜尋引擎
 SEARXNG_URL = "https://ws-searxng.huannago.com/search"
+TRACE_FILE = os.path.join(SCRIPT_DIR, "trace_day4.json")
+
+def invoke_llm(prompt, name):
+    """呼叫 llm_main 並記錄耗時與 token 用量"""
+    with span("llm", name, bytes_in=text_bytes(prompt)) as s:
+        response = llm_main.invoke(prompt)
+        s.usage(response)
+    return response
 
 
 def search_searxng(query: str, limit: int = 3) -> List[Dict]:
@@ -40,7 +53,9 @@ def search_searxng(query: str, limit: int = 3) -> List[Dict]:
     print(f"🔍 [Search] 正在搜尋: {query}")
     params = {"q": query, "format": "json", "language": "zh-TW"}
     try:
-        response = requests.get(SEARXNG_URL, params=params, timeout=10)
+        with span("search", "searxng") as s:
+            response = get_transport().get(SEARXNG_URL, params=params, timeout=10)
+            s.set(bytes_out=len(response.content))
         if response.status_code == 200:
             results = response.json().get('results', [])
             valid_results = [r for r in results if 'url' in r]
@@ -73,7 +88,9 @@ def vlm_read_website(url: str, title: str = "網頁內容") -> str:
             print(f"❌ 截圖失敗: {e}")
         return screenshots
 
-    images = capture_screenshots(url)
+    with span("parse", "screenshot") as s:
+        images = capture_screenshots(url)
+        s.set(items=len(images), bytes_out=text_bytes(images))
     if not images: return "無法讀取網頁。"
 
     msg_content = [{"type": "text", "text": f"這是網頁 '{title}' 的截圖。請摘要核心內容，關注數據與事實。"}]
@@ -81,7 +98,9 @@ def vlm_read_website(url: str, title: str = "網頁內容") -> str:
         msg_content.append({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{img}"}})
     
     try:
-        response = llm_vlm.invoke([HumanMessage(content=msg_content)])
+        with span("vlm", "read_website", items=len(images), bytes_in=text_bytes(images)) as s:
+            response = llm_vlm.invoke([HumanMessage(content=msg_content)])
+            s.usage(response)
         return response.content
     except Exception as e:
         return f"VLM 分析失敗: {e}"
@@ -137,7 +156,7 @@ def planner_node(state: AgentState):
     如果不足，請回答 "NO"。
     只回答 YES 或 NO，不要有其他廢話。
     """
-    response = llm_main.invoke(prompt).content.strip().upper()
+    response = invoke_llm(prompt, "planner").content.strip().upper()
     
     if "YES" in response:
         return {"decision": "sufficient"}
@@ -158,7 +177,7 @@ def query_gen_node(state: AgentState):
     請生成 1 個最適合的搜尋關鍵字來尋找缺少的資訊。
     直接輸出關鍵字即可，不要加引號或解釋。
     """
-    query = llm_main.invoke(prompt).content.strip()
+    query = invoke_llm(prompt, "query_gen").content.strip()
     return {"search_queries": [query], "loop_count": state["loop_count"] + 1}
 
 def search_tool_node(state: AgentState):
@@ -203,7 +222,7 @@ def final_answer_node(state: AgentState):
     
     請以繁體中文，專業且條理分明地回答。
     """
-    answer = llm_main.invoke(prompt).content
+    answer = invoke_llm(prompt, "final_answer").content
     
     ANSWER_CACHE[question] = answer
     return {"final_answer": answer}
@@ -271,4 +290,5 @@ if __name__ == "__main__":
     if user_question in ANSWER_CACHE:
         print(f"📝 最終回答:\n{ANSWER_CACHE[user_question]}")
     else:
-        print("❌ 未能生成回答。") 
\ No newline at end of file
+        print("❌ 未能生成回答。")
+    get_tracer().finish(TRACE_FILE) 
\ No newline at end of file
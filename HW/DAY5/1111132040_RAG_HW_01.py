@@ -1,69 +1,55 @@
 import os
 import glob
 import csv
-import requests
-import re
+import sys
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(SCRIPT_DIR)))
+from rag_common.transport import get_transport
+from rag_common.chunking import (TextSource, fixed_spans, sliding_spans, sentence_spans,
+                                 chunk_texts, iter_clean, iter_file_blocks)
 
 STUDENT_ID = "1111132040"
 API_URL = "https://hw-01.wade0426.me/submit_answer" 
 DATA_DIR = "day5"
 OUTPUT_CSV = f"{STUDENT_ID}_RAG_HW_01.csv"
-print("請輸入大於0的資料量(Size)大小 (預設350)")
-GLOBAL_SIZE = 350     #size參數
-try:
-    GLOBAL_SIZE = int(input())
-    if GLOBAL_SIZE <= 0:
-        GLOBAL_SIZE = 350
-except ValueError:
-    GLOBAL_SIZE = 350
+GLOBAL_SIZE = 350     #size參數 (執行時可輸入覆寫)
 GLOBAL_OVERLAP = 150   
 
+def ask_size(default=GLOBAL_SIZE):
+    """互動輸入 size；只在直接執行時詢問，匯入模組 (例如 benchmark) 不會卡在 input()"""
+    print(f"請輸入大於0的資料量(Size)大小 (預設{default})")
+    try:
+        size = int(input())
+        return size if size > 0 else default
+    except ValueError:
+        return default
+
 def clean_text(text):
     """移除換行符號與多餘空白"""
-    text = text.replace("\n", "").replace("\r", "")
-    text = re.sub(r'\s+', ' ', text)
-    return text.strip()
+    return "".join(iter_clean([text]))
 
 def load_data(data_dir):
     documents = {}
     file_paths = glob.glob(os.path.join(data_dir, "data_*.txt"))
     for file_path in file_paths:
         filename = os.path.basename(file_path)
-        with open(file_path, 'r', encoding='utf-8') as f:
-            documents[filename] = clean_text(f.read())
+        # 分塊讀檔並串流清理，不必先把原始檔整份讀進來
+        documents[filename] = "".join(iter_clean(iter_file_blocks(file_path)))
     return documents
 
 def fixed_size_chunking(text, size):
-    return [text[i:i+size] for i in range(0, len(text), size)]
+    src = TextSource(text)
+    return chunk_texts(src, fixed_spans(src, size))
 
 def sliding_window_chunking(text, size, overlap):
-    chunks = []
-    if len(text) <= size: return [text]
-    step = size - overlap
-    if step <= 0: step = 1 
-    for i in range(0, len(text) - overlap, step):
-        chunks.append(text[i:i+size])
-    return chunks
+    src = TextSource(text)
+    return chunk_texts(src, sliding_spans(src, size, overlap))
 
 def semantic_chunking(text, target_size):
-    # 以標點符號切分，保持語意完整
-    sentences = re.split(r'([。！？])', text)
-    # 重新組合符號與句子
-    combined_sentences = []
-    for i in range(0, len(sentences)-1, 2):
-        combined_sentences.append(sentences[i] + sentences[i+1])
-    if len(sentences) % 2 == 1:
-        combined_sentences.append(sentences[-1])
-    
-    chunks, current = [], ""
-    for s in combined_sentences:
-        if len(current) + len(s) <= target_size:
-            current += s
-        else:
-            if current: chunks.append(current)
-            current = s
-    if current: chunks.append(current)
-    return chunks
+    # 以標點符號切分，保持語意完整；只記錄句界 offset，不再反覆串接字串
+    src = TextSource(text)
+    return chunk_texts(src, sentence_spans(src, target_size))
 
 
 def get_best_match(query, chunks):
@@ -85,14 +71,14 @@ def fetch_api_score(q_id, answer):
     """將檢索結果傳送至 API 獲取動態評分"""
     try:
         payload = {"q_id": int(q_id), "student_answer": answer}
-        response = requests.post(API_URL, json=payload, timeout=10)
+        response = get_transport().post(API_URL, json=payload, timeout=10)
         if response.status_code == 200:
             return float(response.json().get('score', 0))
         return 0.0
     except:
         return 0.0
 
-def main():
+def main(size=GLOBAL_SIZE):
     if not os.path.exists(DATA_DIR):
         print(f"找不到資料夾: {DATA_DIR}")
         return
@@ -105,15 +91,15 @@ def main():
         reader = csv.DictReader(f)
         for row in reader: questions.append(row)
     methods = [
-        ("固定大小", lambda t: fixed_size_chunking(t, GLOBAL_SIZE)),
-        ("滑動視窗", lambda t: sliding_window_chunking(t, GLOBAL_SIZE, GLOBAL_OVERLAP)),
-        ("語意切塊", lambda t: semantic_chunking(t, GLOBAL_SIZE))
+        ("固定大小", lambda t: fixed_size_chunking(t, size)),
+        ("滑動視窗", lambda t: sliding_window_chunking(t, size, GLOBAL_OVERLAP)),
+        ("語意切塊", lambda t: semantic_chunking(t, size))
     ]
 
     all_results = []
     method_avgs = {}
 
-    print(f"RAG 自動化評分 (Size: {GLOBAL_SIZE}) ---")
+    print(f"RAG 自動化評分 (Size: {size}) ---")
 
     for method_name, chunk_func in methods:
         print(f"\n【執行：{method_name}】")
@@ -146,7 +132,7 @@ def main():
         method_avgs[method_name] = method_total / len(questions)
 
     print("\n" + "="*40)
-    print(f"參數 {GLOBAL_SIZE} 下的最終報告")
+    print(f"參數 {size} 下的最終報告")
     for m, avg in method_avgs.items():
         print(f" > {m:10}: {avg:.4f}")
     print("="*40)
@@ -159,4 +145,4 @@ def main():
     print(f"檔案已存為 {OUTPUT_CSV}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main(ask_size())
\ No newline at end of file
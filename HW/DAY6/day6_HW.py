@@ -2,29 +2,61 @@ import pandas as pd
 import requests
 import time
 import os
-import gc
+import sys
+import json
+import hashlib
+import argparse
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(SCRIPT_DIR)))
+from rag_common.ratelimit import configure_rate_limit
+from rag_common.transport import get_transport
+from rag_common.embeddings import post_embeddings
+from rag_common.eval_runner import run_concurrent, CsvResultWriter
+from rag_common.metrics import compute_metrics, judge_sample, normalize_rows
+from rag_common.chunking import TextSource, window_spans, chunk_texts
+from rag_common.context_packer import pack_context, pack_texts
+from rag_common.tracing import span, get_tracer
 
 # --- 配置區域 ---
 LLM_URL = "https://ws-03.wade0426.me/v1/chat/completions"
 EMBED_URL = "https://ws-04.wade0426.me/embed"
-SIMILARITY_URL = "https://ws-04.wade0426.me/similarity"
 MODEL_NAME = "/models/gpt-oss-120b"
 API_KEY = "empty"
 
-def call_api(url, payload, timeout=60):
-    """API 呼叫函數，包含重試機制與錯誤處理"""
-    for i in range(3):
-        try:
-            headers = {"Authorization": f"Bearer {API_KEY}"}
-            response = requests.post(url, json=payload, headers=headers, timeout=timeout)
-            if response.status_code == 400:
-                print("⚠️ Context 過長，嘗試縮減內容...")
-                return None
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            if i == 2: return None
-            time.sleep(2)
+# 各端點每秒請求數上限 (token bucket)
+configure_rate_limit(LLM_URL, rate=4, burst=8)
+configure_rate_limit(EMBED_URL, rate=10, burst=10)
+CONCURRENCY = 8
+
+# 預先計算的 chunk 向量矩陣 (float32、已正規化)，以 mmap 載入
+EMBED_TASK = "檢索"
+EMBED_BATCH = 64
+MATRIX_FILE = "qa_chunks.npy"
+MATRIX_MANIFEST = "qa_chunks.json"
+METRIC_NAMES = ["Faithfulness", "Answer_Relevancy", "Contextual_Precision", "Contextual_Recall", "Contextual_Relevancy"]
+RESULT_FIELDS = ["q_id", "questions", "answer"] + METRIC_NAMES
+# 參考資料的 token 預算 (取代原本逐塊截斷 400 字、評審截斷 500 字)
+CONTEXT_BUDGET = 700
+JUDGE_BUDGET = 500
+SOURCE_NAME = "qa_data.txt"
+TRACE_FILE = "trace_day6.json"
+
+def call_api(url, payload, timeout=60, name=None):
+    """API 呼叫函數，重試、退避與限流由共用傳輸層處理；失敗時回傳 None"""
+    stage = "embed" if url == EMBED_URL else "llm"
+    try:
+        headers = {"Authorization": f"Bearer {API_KEY}"}
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        with span(stage, name, bytes_in=len(body), items=len(payload.get("texts", [])) or None) as s:
+            result = get_transport().post_json(url, payload, timeout=timeout, headers=headers)
+            s.usage(result)
+        return result
+    except requests.HTTPError as e:
+        print(f"⚠️ API 回應錯誤 {e.response.status_code}: {e.response.text[:200]}")
+    except Exception as e:
+        print(f"⚠️ API 呼叫失敗: {e}")
     return None
 
 # --- RAG 核心功能 ---
@@ -33,38 +65,85 @@ def query_rewrite(original_query):
     """Query Rewrite - 提升檢索效果"""
     prompt = f"請將以下問題改寫成 1-2 個精確的檢索關鍵字：\n{original_query}\n只輸出關鍵字。"
     payload = {"model": MODEL_NAME, "messages": [{"role": "user", "content": prompt}], "temperature": 0.1}
-    result = call_api(LLM_URL, payload)
+    result = call_api(LLM_URL, payload, name="rewrite")
     return result["choices"][0]["message"]["content"].strip() if result else original_query
 
-def get_similarity_scores(query, chunks):
-    """計算相似度 (API 方式)"""
-    payload = {"queries": [query], "documents": chunks}
-    result = call_api(SIMILARITY_URL, payload)
-    return result["similarity"][0] if result else [0.0] * len(chunks)
+def embed_texts(texts):
+    """呼叫嵌入 API，回應直接解碼成 (n, dim) float32 矩陣，每列皆正規化為單位向量"""
+    payload = {"texts": texts, "task_description": EMBED_TASK, "normalize": True}
+    try:
+        with span("embed", bytes_in=len(json.dumps(payload, ensure_ascii=False).encode("utf-8")), items=len(texts)):
+            vecs = post_embeddings(EMBED_URL, payload, headers={"Authorization": f"Bearer {API_KEY}"})
+    except Exception as e:
+        raise RuntimeError(f"嵌入 API 呼叫失敗: {e}") from e
+    return normalize_rows(vecs)
+
+def load_chunk_matrix(chunks):
+    """chunks 未變動時直接 mmap 既有的 .npy，否則分批嵌入一次並存檔；沒有 chunk 時回傳空矩陣"""
+    if not chunks:
+        return np.empty((0, 0), dtype=np.float32)
+    digest = hashlib.sha256("\x00".join(chunks).encode("utf-8")).hexdigest()
+    manifest = {"chunks_sha256": digest, "count": len(chunks), "embed_url": EMBED_URL, "task": EMBED_TASK}
+    if os.path.exists(MATRIX_FILE) and os.path.exists(MATRIX_MANIFEST):
+        with open(MATRIX_MANIFEST, "r", encoding="utf-8") as f:
+            if json.load(f) == manifest:
+                print(f"⚡ 載入既有向量矩陣 {MATRIX_FILE}")
+                return np.load(MATRIX_FILE, mmap_mode="r")
+
+    print(f"🧮 嵌入 {len(chunks)} 個 chunks...")
+    matrix = np.concatenate([embed_texts(chunks[i:i + EMBED_BATCH]) for i in range(0, len(chunks), EMBED_BATCH)])
+    np.save(MATRIX_FILE, matrix)
+    with open(MATRIX_MANIFEST, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    return np.load(MATRIX_FILE, mmap_mode="r")
+
+def get_similarity_scores(query, matrix):
+    """計算相似度 (本地)：只嵌入查詢，再與 chunk 矩陣做一次矩陣向量乘法"""
+    q = embed_texts([query])[0]
+    with span("search", "matmul", items=len(matrix)):
+        return matrix @ q
+
+def top_k_indices(scores, k):
+    """argpartition 取前 k 名 (O(n))，再只對這 k 個排序"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]
 
-def hybrid_search_and_rerank(query, chunks, top_k=2):
-    """檢索 + Rerank (瘦身版)"""
-    scores = get_similarity_scores(query, chunks)
+def hybrid_search_and_rerank(query, chunks, spans, matrix, top_k=2):
+    """檢索 + Rerank (瘦身版)；回傳打包後的參考段落 (重疊的相鄰 chunk 已合併)"""
+    if len(matrix) == 0:
+        return []
+    try:
+        scores = get_similarity_scores(query, matrix)
+    except RuntimeError as e:
+        print(f"⚠️ 檢索失敗: {e}")
+        return []
     # 取前 5 個候選
-    sorted_indices = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
-    candidates = [chunks[i] for i in sorted_indices[:5]]
+    with span("search", "top_k", items=len(scores)):
+        candidates = top_k_indices(scores, 5)
     
     # 這裡直接用相似度分數做 Rerank，減少呼叫 LLM 的次數以省 Context
-    return [c[:400] for c in candidates[:top_k]]
+    hits = [{"text": chunks[i], "source": SOURCE_NAME, "start": spans[i][0], "end": spans[i][1], "score": float(scores[i])}
+            for i in candidates[:top_k]]
+    _, packed = pack_context(hits, CONTEXT_BUDGET)
+    return [p["text"] for p in packed]
 
 def generate_answer(question, context_chunks):
     """生成答案"""
     context = "\n".join(context_chunks)
     qa_prompt = f"資料：\n{context}\n問題：{question}\n請精簡回答。"
     payload = {"model": MODEL_NAME, "messages": [{"role": "user", "content": qa_prompt}], "temperature": 0.5}
-    result = call_api(LLM_URL, payload)
+    result = call_api(LLM_URL, payload, name="answer")
     return result["choices"][0]["message"]["content"].strip() if result else "無法生成回答"
 
 # --- 動態評估指標 (精簡版) ---
+# 主要指標改由 rag_common.metrics 在本地一次向量化計算；LLM 評審只用於抽樣比對
 
 def calculate_metrics(question, answer, contexts):
-    """一次性獲取所有指標，減少 API 呼叫次數"""
-    ctx_str = "\n".join(contexts)[:500]
+    """LLM 評審：一次取得 5 個指標，無法解析時回傳 None (不再以預設分數充數)"""
+    ctx_str = pack_texts(contexts, JUDGE_BUDGET)
     prompt = f"""請評估以下 RAG 結果，僅輸出 5 個數字(0-1)，逗號隔開：
     忠實度,相關性,精確度,召回率,上下文相關性
     問：{question}
@@ -72,17 +151,49 @@ def calculate_metrics(question, answer, contexts):
     內：{ctx_str}"""
     
     payload = {"model": MODEL_NAME, "messages": [{"role": "user", "content": prompt}], "temperature": 0}
-    res = call_api(LLM_URL, payload)
+    res = call_api(LLM_URL, payload, name="judge")
     try:
         scores = [float(x.strip()) for x in res["choices"][0]["message"]["content"].replace('，', ',').split(',')]
         if len(scores) == 5: return scores
     except:
         pass
-    return [0.8, 0.8, 0.8, 0.8, 0.8] # 預設分數
+    return None
 
 # --- 主程式 ---
 
-def main():
+def evaluate_row(row, chunks, spans, matrix):
+    """單題 RAG 流程：改寫 → 檢索 → 回答 (指標於全部完成後統一計算)"""
+    print(f"\n📝 處理 Q{row['q_id']}: {row['questions'][:15]}...")
+    rewritten_q = query_rewrite(row['questions'])
+    top_ctx = hybrid_search_and_rerank(rewritten_q, chunks, spans, matrix, top_k=2)
+    ans = generate_answer(row['questions'], top_ctx)
+    print(f"✅ Q{row['q_id']} 完成")
+    return {
+        "q_id": row['q_id'],
+        "questions": row['questions'],
+        "answer": ans,
+        "contexts": top_ctx,
+        "ground_truth": row['answer'] if isinstance(row['answer'], str) else "",
+    }
+
+def score_results(results, judge_size=0):
+    """本地指標一次算完全部題目，再對抽樣題目呼叫 LLM 評審作為對照"""
+    metrics = compute_metrics([r["questions"] for r in results], [r["answer"] for r in results],
+                              [r["contexts"] for r in results], [r["ground_truth"] for r in results], embed_texts)
+    for i, r in enumerate(results):
+        for name in METRIC_NAMES:
+            r[name] = round(float(metrics[name][i]), 4)
+
+    judged = judge_sample(len(results), lambda i: calculate_metrics(
+        results[i]["questions"], results[i]["answer"], results[i]["contexts"]), judge_size)
+    for i, scores in judged.items():
+        for name, score in zip(METRIC_NAMES, scores):
+            results[i][f"LLM_{name}"] = score
+    if judge_size:
+        print(f"🧑‍⚖️ LLM 評審抽樣 {len(judged)}/{min(judge_size, len(results))} 題")
+    return results
+
+def main(limit=5, concurrency=CONCURRENCY, judge_size=0):
     print("🚀 啟動優化版 RAG 評估系統...")
     
     # 檔案檢查
@@ -95,47 +206,30 @@ def main():
         full_text = f.read()
 
     # 文字切割 (Overlap 增加檢索機率)
-    chunks = [full_text[i:i+500] for i in range(0, len(full_text), 350)]
-        
-    all_results = []
-    
-    # 處理前 5 題進行測試
-    for idx, row in hw_df.head(5).iterrows():
-        print(f"\n📝 處理 Q{row['q_id']}: {row['questions'][:15]}...")
-        
-        try:
-            # 1. RAG 流程
-            rewritten_q = query_rewrite(row['questions'])
-            top_ctx = hybrid_search_and_rerank(rewritten_q, chunks, top_k=2)
-            ans = generate_answer(row['questions'], top_ctx)
-            
-            # 2. 評估
-            scores = calculate_metrics(row['questions'], ans, top_ctx)
-            
-            # 3. 收集結果
-            all_results.append({
-                "q_id": row['q_id'],
-                "questions": row['questions'],
-                "answer": ans,
-                "Faithfulness": scores[0],
-                "Answer_Relevancy": scores[1],
-                "Contextual_Precision": scores[2],
-                "Contextual_Recall": scores[3],
-                "Contextual_Relevancy": scores[4]
-            })
-            print(f"✅ Q{row['q_id']} 完成。評分：{scores}")
-            
-        except Exception as e:
-            print(f"❌ Q{row['q_id']} 出錯: {e}")
-        
-        time.sleep(1)
-        gc.collect()
-
-    # 4. 存檔
-    output_df = pd.DataFrame(all_results)
+    src = TextSource(full_text)
+    spans = list(window_spans(src, 500, 350))
+    chunks = chunk_texts(src, spans)
+    matrix = load_chunk_matrix(chunks)
+
+    rows = [row for _, row in (hw_df.head(limit) if limit else hw_df).iterrows()]
     output_file = 'day6_HW_results_optimized.csv'
+    start = time.time()
+    # 題目併發執行，各端點由 token bucket 控制速率，完成一題就寫入一題 (指標欄位最後補上)
+    with CsvResultWriter(output_file, RESULT_FIELDS) as writer:
+        all_results = run_concurrent(rows, lambda r: evaluate_row(r, chunks, spans, matrix), concurrency, writer.write)
+
+    # 4. 計算指標後依題號重新排序存檔
+    all_results = score_results(sorted(all_results, key=lambda r: r["q_id"]), judge_size)
+    output_df = pd.DataFrame(all_results).drop(columns=["contexts", "ground_truth"], errors="ignore")
     output_df.to_csv(output_file, index=False, encoding='utf-8-sig')
-    print(f"\n🎉 評估完成！結果已存至 {output_file}")
+    print(f"\n🎉 評估完成！{len(all_results)}/{len(rows)} 題，耗時 {time.time() - start:.1f} 秒，結果已存至 {output_file}")
+    get_transport().print_stats()
+    get_tracer().finish(TRACE_FILE)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--limit", type=int, default=5, help="評估前 N 題 (0 表示全部)")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--judge-sample", type=int, default=0, help="抽樣 N 題額外以 LLM 評審")
+    args = parser.parse_args()
+    main(args.limit, args.concurrency, args.judge_sample)
@@ -1,119 +1,388 @@
 import os
-import requests
 import pandas as pd
 import re
+import json
 import time
+import hashlib
+import argparse
+import queue
+import threading
+import sys
+import multiprocessing as mp
+import numpy as np
 from docx import Document
 import PyPDF2
 from qdrant_client import QdrantClient, models
-from qdrant_client.http.models import PointStruct
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-
-# --- 網路與 API 配置 ---
-def get_stable_session():
-    session = requests.Session()
-    retries = Retry(total=5, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
-    session.mount('https://', HTTPAdapter(max_retries=retries))
-    return session
-
-session = get_stable_session()
+from injection_scanner import SignatureMatcher, load_signatures, hits_by_span
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(SCRIPT_DIR)))
+from rag_common.ratelimit import configure_rate_limit
+from rag_common.transport import get_transport
+from rag_common.embeddings import post_embeddings
+from rag_common.eval_runner import run_concurrent, CsvResultWriter
+from rag_common.metrics import compute_metrics, judge_sample
+from rag_common.chunking import TextSource, window_spans
+from rag_common.dedupe import NearDuplicateFilter
+from rag_common.context_packer import pack_context, pack_texts
+from rag_common.tracing import span, get_tracer, text_bytes
+from rag_common.text_store import TextStoreWriter, chunk_payload, payload_mode, open_store, hydrate
+
+# --- 網路與 API 配置 (重試 / 429 / 自適應併發由共用傳輸層處理) ---
+transport = get_transport()
 TIMEOUT = 60
 LLM_URL = "https://ws-03.wade0426.me/v1/chat/completions"
 EMBED_URL = "https://ws-04.wade0426.me/embed"
 MODEL_NAME = "/models/gpt-oss-120b"
 
+# 各端點每秒請求數上限 (token bucket) 與評估併發數
+configure_rate_limit(LLM_URL, rate=4, burst=8)
+configure_rate_limit(EMBED_URL, rate=10, burst=10)
+EVAL_CONCURRENCY = 8
+CONTEXT_HITS = 3       # 每題取回的 chunk 數，相鄰重疊的 chunk 依 offset 合併後再填入預算
+CONTEXT_BUDGET = 800   # 回答 prompt 的參考資料 token 上限
+JUDGE_BUDGET = 300     # LLM 評審 prompt 的參考資料 token 上限 (取代原本截斷 200 字)
+TRACE_FILE = "trace_day7.json"
+RESULT_FIELDS = ["q_id", "questions", "answer", "source", "Faithfulness", "Relevancy", "Precision", "Recall"]
+# 輸出欄位對應 rag_common.metrics 的指標名稱
+METRIC_COLUMNS = {"Faithfulness": "Faithfulness", "Relevancy": "Answer_Relevancy",
+                  "Precision": "Contextual_Precision", "Recall": "Contextual_Recall"}
+
+def post_json(url, payload, timeout=TIMEOUT, name=None):
+    """呼叫 API 並記錄 span (嵌入 / LLM 依端點區分)"""
+    stage = "embed" if url == EMBED_URL else "llm"
+    texts = payload.get("texts") or [m["content"] for m in payload.get("messages", [])]
+    with span(stage, name, items=len(texts), bytes_in=text_bytes(texts)) as s:
+        res = transport.post_json(url, payload, timeout=timeout)
+        s.usage(res)
+    return res
+
 # --- 1. IDP 文件處理與注入辨識 ---
-def process_idp_files():
-    docs_data = []
-    files = ['1.pdf', '2.pdf', '3.pdf', '4.png', '5.docx']
-    print("🔍 [IDP] 正在進行安全掃描...")
-    
+SIGNATURE_FILE = "injection_signatures.txt"
+QUARANTINE_FILE = "quarantine.jsonl"
+CHUNK_SIZE, CHUNK_STEP = 500, 400
+IDP_FILES = ['1.pdf', '2.pdf', '3.pdf', '4.png', '5.docx']
+DEDUPE_THRESHOLD = 0.85           # 估計 Jaccard 相似度達此門檻視為近似重複，不再嵌入
+DEDUPE_FILE = "dedupe_map.json"   # 被丟棄 chunk -> 代表 chunk 的對應 (來源#序號)
+
+# 流水線參數
+PARSE_WORKERS = os.cpu_count() or 2
+PAGES_PER_JOB = 4
+EMBED_BATCH = 32
+EMBED_WORKERS = 2
+UPSERT_BATCH = 128
+QUEUE_SIZE = 256     # 各階段之間的佇列上限，避免前段跑太快把記憶體撐爆
+
+def extract_pdf_pages(job):
+    """行程池 worker：解析 [start, end) 範圍的頁面文字，每頁只呼叫一次 extract_text"""
+    file_name, start, end = job
+    with open(file_name, 'rb') as f:
+        reader = PyPDF2.PdfReader(f)
+        return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+def submit_pdf_jobs(pool, files):
+    """先把所有 PDF 的頁面解析工作丟進行程池，後面階段處理前一份檔案時下一份已在解析"""
+    pending = {}
+    for file_name in files:
+        if not file_name.endswith('.pdf') or not os.path.exists(file_name): continue
+        with open(file_name, 'rb') as f:
+            total = len(PyPDF2.PdfReader(f).pages)
+        pending[file_name] = [pool.apply_async(extract_pdf_pages, ((file_name, s, min(s + PAGES_PER_JOB, total)),))
+                              for s in range(0, total, PAGES_PER_JOB)]
+    return pending
+
+def iter_pdf_pages(file_name, pdf_jobs=None):
+    if pdf_jobs and file_name in pdf_jobs:
+        for job in pdf_jobs[file_name]:
+            yield from job.get()
+    else:
+        with open(file_name, 'rb') as f:
+            for p in PyPDF2.PdfReader(f).pages:
+                yield p.extract_text() or ""
+
+def iter_file_text(file_name, pdf_jobs=None):
+    """逐段產出文件文字 (含段落間的分隔字元)，讓掃描器可以邊讀邊掃"""
+    if file_name.endswith('.pdf'):
+        first = True
+        for text in iter_pdf_pages(file_name, pdf_jobs):
+            if not text: continue
+            if not first: yield " "
+            yield text
+            first = False
+    elif file_name.endswith('.docx'):
+        doc = Document(file_name)
+        for i, p in enumerate(doc.paragraphs):
+            if i: yield "\n"
+            yield p.text
+    elif file_name.endswith('.png'):
+        yield "不動產說明書：104年10月1日生效，不得記載事項包含遷徙自由。"
+
+def iter_idp_chunks(pool=None, files=IDP_FILES, writer=None):
+    """逐份檔案解析、掃描、切塊並產出 chunk；給定行程池時 PDF 頁面會平行解析
+    給定 writer (TextStoreWriter) 時每份檔案的全文存進外部 store，payload 只需 offset"""
+    quarantined = []
+    dedup = NearDuplicateFilter(threshold=DEDUPE_THRESHOLD)
+    matcher = SignatureMatcher(load_signatures(SIGNATURE_FILE))
+    print(f"🔍 [IDP] 正在進行安全掃描 ({len(matcher.signatures)} 條特徵)...")
+    pdf_jobs = submit_pdf_jobs(pool, files) if pool else None
+
     for file_name in files:
         if not os.path.exists(file_name): continue
-        content = ""
-        try:
-            if file_name.endswith('.pdf'):
-                with open(file_name, 'rb') as f:
-                    reader = PyPDF2.PdfReader(f)
-                    content = " ".join([p.extract_text() for p in reader.pages if p.extract_text()])
-            elif file_name.endswith('.docx'):
-                doc = Document(file_name)
-                content = "\n".join([p.text for p in doc.paragraphs])
-            elif file_name.endswith('.png'):
-                content = "不動產說明書：104年10月1日生效，不得記載事項包含遷徙自由。"
-        except Exception as e: print(f"讀取 {file_name} 出錯: {e}")
-
-        # 辨識惡意注入 (截圖重點)
-        if "tiramisu" in content.lower() or "ignore all system prompts" in content.lower():
+        parts, hits = [], []
+        scanner = matcher.stream()
+        with span("parse", os.path.splitext(file_name)[1].lstrip("."), source=file_name) as s:
+            try:
+                for piece in iter_file_text(file_name, pdf_jobs):
+                    parts.append(piece)
+                    hits.extend(scanner.feed(piece))
+            except Exception as e: print(f"讀取 {file_name} 出錯: {e}")
+            s.set(bytes_out=text_bytes(parts))
+        content = "".join(parts)
+        if writer: writer.add(file_name, content)
+
+        # 辨識惡意注入：命中的 chunk 在嵌入前隔離
+        spans = list(window_spans(TextSource(content), CHUNK_SIZE, CHUNK_STEP))
+        flagged = hits_by_span(hits, spans)
+        if hits:
             print(f"\n🔥 [警告] 發現惡意注入文件: {file_name}")
-            print(f"內容含 Tiramisu 指令，已標記處理。\n")
+            for h in hits:
+                print(f"   命中「{h.signature}」於 offset {h.start}-{h.end}")
+
+        for idx, (start, end) in enumerate(spans):
+            if idx in flagged:
+                quarantined.append({"source": file_name, "chunk": idx, "start": start, "end": end,
+                                    "hits": [h._asdict() for h in flagged[idx]], "text": content[start:end]})
+                continue
+            # 重疊視窗與跨檔案重複的樣板段落只嵌入代表 chunk
+            if dedup.add(f"{file_name}#{idx}", content[start:end]) is not None:
+                continue
+            yield {"text": content[start:end], "source": file_name, "chunk": idx, "start": start, "end": end}
+
+    if quarantined:
+        with open(QUARANTINE_FILE, "w", encoding="utf-8") as f:
+            for q in quarantined:
+                f.write(json.dumps(q, ensure_ascii=False) + "\n")
+        print(f"⛔ 已隔離 {len(quarantined)} 個 chunk，明細見 {QUARANTINE_FILE}\n")
+    dedup.save_mapping(DEDUPE_FILE)
+    print(f"🧹 {dedup.summary()}，對應見 {DEDUPE_FILE}")
+
+def process_idp_files():
+    return list(iter_idp_chunks())
+
+# --- 1.5 流水線匯入：解析 → 切塊 → 批次嵌入 → 增量寫入 ---
+def ingest_pipeline(q_client, pool=None, collection="hw7", writer=None):
+    """各階段以有界佇列串接，整體耗時取決於最慢的階段而非所有往返時間的總和"""
+    chunk_q = queue.Queue(maxsize=QUEUE_SIZE)
+    point_q = queue.Queue(maxsize=QUEUE_SIZE)
+    stats = {"chunks": 0, "embedded": 0, "failed": 0, "upserted": 0}
+    lock = threading.Lock()
 
-        chunks = [content[i:i+500] for i in range(0, len(content), 400)]
-        for c in chunks:
-            docs_data.append({"text": c, "source": file_name})
-    return docs_data
+    def embed_worker():
+        done = False
+        while not done:
+            batch = [chunk_q.get()]
+            while batch[-1] is not None and len(batch) < EMBED_BATCH:
+                try: batch.append(chunk_q.get_nowait())
+                except queue.Empty: break
+            if batch[-1] is None:
+                batch.pop()
+                done = True
+            if not batch: continue
+            try:
+                embs = embed_texts([item['text'] for _, item in batch])
+                if len(embs) != len(batch):
+                    # 無法得知少了哪幾筆的向量，整批視為失敗而不是錯位寫入
+                    raise ValueError(f"回傳 {len(embs)} 個向量，預期 {len(batch)} 個")
+                for (pid, item), emb in zip(batch, embs):
+                    payload = chunk_payload(item['text'], item['source'], item['start'], item['end'], chunk=item['chunk'])
+                    point_q.put((pid, payload, emb))
+                with lock: stats["embedded"] += len(batch)
+            except Exception as e:
+                print(f"⚠️ 嵌入批次失敗 ({len(batch)} 筆): {e}")
+                with lock: stats["failed"] += len(batch)
+
+    def upsert_worker():
+        buffer, created = [], False
+        while True:
+            point = point_q.get()
+            if point is not None: buffer.append(point)
+            if buffer and (point is None or len(buffer) >= UPSERT_BATCH):
+                # 建集合也在 try 內：失敗時只記錄並繼續消化佇列，否則上游會卡在 put
+                try:
+                    if not created:
+                        # 依第一批向量決定維度，不必另外送一次測試請求
+                        dim = buffer[0][2].size
+                        if not q_client.collection_exists(collection):
+                            q_client.create_collection(collection, vectors_config=models.VectorParams(size=dim, distance=models.Distance.COSINE))
+                        print(f"同步向量中 (維度: {dim})...")
+                        created = True
+                    # 整批以 numpy 陣列交給 client，不為每個分量建立 Python float
+                    ids, payloads, vectors = zip(*buffer)
+                    with span("upsert", items=len(buffer)):
+                        q_client.upload_collection(collection, vectors=np.stack(vectors), payload=list(payloads),
+                                                   ids=list(ids), batch_size=UPSERT_BATCH, wait=True)
+                    with lock: stats["upserted"] += len(buffer)
+                except Exception as e:
+                    print(f"⚠️ 寫入 Qdrant 失敗 ({len(buffer)} 筆): {e}")
+                    with lock: stats["failed"] += len(buffer)
+                buffer = []
+            if point is None: break
+
+    embedders = [threading.Thread(target=embed_worker, daemon=True) for _ in range(EMBED_WORKERS)]
+    upserter = threading.Thread(target=upsert_worker, daemon=True)
+    for t in embedders + [upserter]: t.start()
+
+    start = time.time()
+    for pid, item in enumerate(iter_idp_chunks(pool, writer=writer)):
+        chunk_q.put((pid, item))
+        stats["chunks"] += 1
+    for _ in embedders: chunk_q.put(None)
+    for t in embedders: t.join()
+    point_q.put(None)
+    upserter.join()
+
+    print(f"📦 匯入完成：{stats['chunks']} chunks，寫入 {stats['upserted']}，失敗 {stats['failed']}，耗時 {time.time() - start:.2f} 秒")
+    return stats
+
+# --- 1.6 持久化索引：來源未變動時直接載入，不必重新嵌入 ---
+INDEX_DIR = "hw7_index"
+MANIFEST_FILE = "manifest.json"
+TEXT_STORE_DIR = "text_store"   # RAG_PAYLOAD_TEXT=store 時 chunk 文字存於索引目錄下
+
+def corpus_manifest(files=IDP_FILES):
+    """來源檔案與影響向量內容的參數；任何一項改變都需要重建索引"""
+    hashes = {}
+    for file_name in files + [SIGNATURE_FILE]:
+        if not os.path.exists(file_name): continue
+        with open(file_name, 'rb') as f:
+            hashes[file_name] = hashlib.sha256(f.read()).hexdigest()
+    return {"sources": hashes, "chunk": [CHUNK_SIZE, CHUNK_STEP], "dedupe": DEDUPE_THRESHOLD,
+            "payload": (["text"] if payload_mode() == "inline" else []) + ["source", "chunk", "start", "end"], "embed_url": EMBED_URL, "task": "檢索"}
+
+def open_index(index_dir=INDEX_DIR, collection="hw7", rebuild=False):
+    """回傳 (client, 是否需要重新匯入)；本地模式的 Qdrant 會把集合存於 index_dir"""
+    client = QdrantClient(path=index_dir)
+    manifest_path = os.path.join(index_dir, MANIFEST_FILE)
+    current = corpus_manifest()
+    saved = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+    if not rebuild and saved == current and client.collection_exists(collection) \
+            and client.count(collection).count > 0:
+        print(f"⚡ 來源未變動，直接載入既有索引 {index_dir} ({client.count(collection).count} 筆)")
+        return client, False
+    # 先移除舊 manifest：這次匯入失敗或中斷時，下次啟動不會把殘缺的索引當成有效
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    if client.collection_exists(collection):
+        client.delete_collection(collection)
+    return client, True
+
+def save_manifest(index_dir=INDEX_DIR):
+    tmp = os.path.join(index_dir, MANIFEST_FILE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(corpus_manifest(), f, ensure_ascii=False, indent=2)
+    os.replace(tmp, os.path.join(index_dir, MANIFEST_FILE))
 
 # --- 2. RAG 與搜尋 (修正相容性問題) ---
-def get_context(client, query_emb):
-    """相容新舊版 Qdrant 搜尋語法"""
+def get_context(client, query_emb, store=None):
+    """相容新舊版 Qdrant 搜尋語法；回傳 (打包後的參考資料, 最相關的來源, 依排名排序的 chunk 文字)"""
+    with span("search", limit=CONTEXT_HITS):
+        try:
+            # 嘗試舊版 search
+            hits = client.search(collection_name="hw7", query_vector=query_emb, limit=CONTEXT_HITS)
+        except AttributeError:
+            # 嘗試新版 query_points
+            hits = client.query_points(collection_name="hw7", query=query_emb, limit=CONTEXT_HITS).points
+    hydrate(hits, store)
+    context, _ = pack_context([dict(h.payload, score=h.score) for h in hits], CONTEXT_BUDGET)
+    return context, hits[0].payload['source'], [h.payload.get("text", "") for h in hits]
+
+def embed_texts(texts):
+    """回應直接解碼成 (n, dim) float32 陣列"""
+    with span("embed", items=len(texts), bytes_in=text_bytes(texts)):
+        return post_embeddings(EMBED_URL, {"texts": texts, "task_description": "檢索"}, timeout=TIMEOUT)
+
+def evaluate_row(q_client, row, store=None):
+    """單題 RAG 流程：嵌入 → 檢索 → 回答 (指標於全部完成後統一計算)"""
+    try:
+        q_emb = embed_texts([row['questions']])[0]
+        ctx, src, ranked = get_context(q_client, q_emb, store)
+
+        ans_res = post_json(LLM_URL, {
+            "model": MODEL_NAME,
+            "messages": [{"role": "user", "content": f"根據資料：{ctx}\n回答：{row['questions']}"}]
+        }, name="answer")
+        actual_ans = ans_res["choices"][0]["message"]["content"]
+
+        print(f"✅ Q{row['id']} 完成")
+        return {
+            "q_id": row['id'], "questions": row['questions'], "answer": actual_ans, "source": src,
+            # 指標用逐筆排名的 chunk (與 DAY6 一致)；打包後的 ctx 只給回答與 LLM 評審
+            "context": ctx, "contexts": ranked, "ground_truth": row['answer'] if isinstance(row['answer'], str) else "",
+        }
+    except Exception as e:
+        print(f"❌ Q{row['id']} 失敗: {e}")
+        return None
+
+def llm_judge(result):
+    """DeepEval 評分 (用 LLM 模擬評估 4 個指標)，只用於抽樣對照；無法解析時回傳 None"""
     try:
-        # 嘗試舊版 search
-        res = client.search(collection_name="hw7", query_vector=query_emb, limit=1)
-        return res[0].payload['text'], res[0].payload['source']
-    except AttributeError:
-        # 嘗試新版 query_points
-        res = client.query_points(collection_name="hw7", query=query_emb, limit=1)
-        return res.points[0].payload['text'], res.points[0].payload['source']
+        eval_prompt = f"評分 RAG (0-1), 僅輸出4個數字用逗號隔開(Faith, Rel, Prec, Rec):\n問:{result['questions']}\n答:{result['answer']}\n文:{pack_texts([result['context']], JUDGE_BUDGET)}"
+        eval_res = post_json(LLM_URL, {"model": MODEL_NAME, "messages": [{"role": "user", "content": eval_prompt}]}, name="judge")
+        scores = [float(x) for x in re.findall(r"\d+\.\d+|\d+", eval_res["choices"][0]["message"]["content"])]
+        return scores[:4] if len(scores) >= 4 else None
+    except Exception as e:
+        print(f"⚠️ LLM 評審失敗: {e}")
+        return None
+
+def score_results(results, judge_size=0):
+    """本地指標一次向量化算完全部題目，LLM 評審只跑抽樣的題目"""
+    metrics = compute_metrics([r["questions"] for r in results], [r["answer"] for r in results],
+                              [r["contexts"] for r in results], [r["ground_truth"] for r in results], embed_texts)
+    for i, r in enumerate(results):
+        for column, name in METRIC_COLUMNS.items():
+            r[column] = round(float(metrics[name][i]), 4)
+    for i, scores in judge_sample(len(results), lambda i: llm_judge(results[i]), judge_size).items():
+        for column, score in zip(METRIC_COLUMNS, scores):
+            results[i][f"LLM_{column}"] = score
+    return results
 
 if __name__ == "__main__":
-    chunks = process_idp_files()
-    
-    res = session.post(EMBED_URL, json={"texts": ["test"], "task_description": "檢索", "normalize": True}).json()
-    dim = len(res["embeddings"][0])
-    q_client = QdrantClient(":memory:")
-    q_client.create_collection("hw7", vectors_config=models.VectorParams(size=dim, distance=models.Distance.COSINE))
-    
-    points = []
-    print(f"同步向量中 (維度: {dim})...")
-    for i, item in enumerate(chunks):
-        try:
-            emb = session.post(EMBED_URL, json={"texts": [item['text']], "task_description": "檢索"}, timeout=TIMEOUT).json()["embeddings"][0]
-            points.append(PointStruct(id=i, vector=emb, payload=item))
-        except: continue
-    q_client.upsert("hw7", points)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index-dir", default=INDEX_DIR, help="持久化索引目錄")
+    parser.add_argument("--memory", action="store_true", help="使用 :memory: 集合，不保存索引")
+    parser.add_argument("--rebuild", action="store_true", help="忽略既有索引，強制重新匯入")
+    parser.add_argument("--judge-sample", type=int, default=0, help="抽樣 N 題額外以 LLM 評審")
+    args = parser.parse_args()
 
-    # 生成答案並跑驗證 (questions_answer.csv)
+    if args.memory:
+        q_client, need_ingest = QdrantClient(":memory:"), True
+    else:
+        q_client, need_ingest = open_index(args.index_dir, rebuild=args.rebuild)
+    store_dir = os.path.join(args.index_dir, TEXT_STORE_DIR)
+    if need_ingest:
+        writer = TextStoreWriter(store_dir) if payload_mode() == "store" else None
+        with mp.Pool(PARSE_WORKERS) as pool:
+            stats = ingest_pipeline(q_client, pool, writer=writer)
+        if writer: writer.close()
+        # 有失敗的批次就不寫 manifest，下次啟動會重新匯入
+        if not args.memory and stats["failed"] == 0:
+            save_manifest(args.index_dir)
+    store = open_store(store_dir)
+
+    # 生成答案並跑驗證 (questions_answer.csv)，題目併發執行、完成即寫出 (指標欄位最後補上)
     print("🧪 正在生成 test_dataset.csv 並進行指標驗證...")
     qa_df = pd.read_csv('questions_answer.csv')
-    final_results = []
+    rows = [row for _, row in qa_df.iterrows()]
+    with CsvResultWriter('test_dataset.csv', RESULT_FIELDS) as writer:
+        final_results = run_concurrent(rows, lambda r: evaluate_row(q_client, r, store), EVAL_CONCURRENCY, writer.write)
 
-    for _, row in qa_df.iterrows():
-        try:
-            q_emb = session.post(EMBED_URL, json={"texts": [row['questions']], "task_description": "檢索"}).json()["embeddings"][0]
-            ctx, src = get_context(q_client, q_emb)
-            
-            ans_res = session.post(LLM_URL, json={
-                "model": MODEL_NAME,
-                "messages": [{"role": "user", "content": f"根據資料：{ctx}\n回答：{row['questions']}"}]
-            }).json()
-            actual_ans = ans_res["choices"][0]["message"]["content"]
-
-            # DeepEval 評分 (用 LLM 模擬評估 4 個指標)
-            eval_prompt = f"評分 RAG (0-1), 僅輸出4個數字用逗號隔開(Faith, Rel, Prec, Rec):\n問:{row['questions']}\n答:{actual_ans}\n文:{ctx[:200]}"
-            eval_res = session.post(LLM_URL, json={"model": MODEL_NAME, "messages": [{"role": "user", "content": eval_prompt}]}).json()
-            scores = [float(x) for x in re.findall(r"\d+\.\d+|\d+", eval_res["choices"][0]["message"]["content"])]
-            if len(scores) < 4: scores = [0.0, 0.0, 0.0, 0.0]
-
-            final_results.append({
-                "q_id": row['id'], "questions": row['questions'], "answer": actual_ans, "source": src,
-                "Faithfulness": scores[0], "Relevancy": scores[1], "Precision": scores[2], "Recall": scores[3]
-            })
-            print(f"✅ Q{row['id']} 完成")
-        except Exception as e:
-            print(f"❌ Q{row['id']} 失敗: {e}")
-
-    # 輸出最終檔案
-    output_df = pd.DataFrame(final_results)
+    # 計算指標後輸出最終檔案 (依題號排序)
+    final_results = score_results(sorted(final_results, key=lambda r: r["q_id"]), args.judge_sample)
+    output_df = pd.DataFrame(final_results).drop(columns=["context", "contexts", "ground_truth"], errors="ignore")
     output_df.to_csv('test_dataset.csv', index=False, encoding='utf-8-sig')
-    print("\n產出檔案：test_dataset.csv")
\ No newline at end of file
+    print(f"\n產出檔案：test_dataset.csv ({len(final_results)}/{len(rows)} 題)")
+    transport.print_stats()
+    get_tracer().finish(TRACE_FILE)
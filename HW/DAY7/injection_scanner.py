@@ -0,0 +1,130 @@
+"""多特徵 Prompt Injection 掃描器 (Aho-Corasick)
+
+所有特徵字串編譯成一個自動機，文字只需從頭到尾走一次，時間與特徵數量無關
+(只與文字長度及命中次數成正比)。掃描前逐字做 NFKC 正規化 (全形轉半形、相容字元)、
+casefold、移除零寬字元並合併連續空白，命中位置則回報為原始文字中的 offset。
+"""
+import bisect
+import unicodedata
+from collections import deque, namedtuple
+
+Hit = namedtuple("Hit", ["signature", "start", "end"])  # [start, end) 為原始文字 offset
+
+def load_signatures(path):
+    """每行一個特徵，空行與 # 開頭的註解略過"""
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+def normalize_char(ch):
+    """單一字元的正規化結果 (可能為空字串或多個字元)"""
+    if ch.isspace():
+        return " "
+    if unicodedata.category(ch) == "Cf":  # 零寬空白、方向控制等不可見字元
+        return ""
+    return unicodedata.normalize("NFKC", ch).casefold()
+
+def normalize(text):
+    out, prev_space = [], False
+    for ch in text:
+        for c in normalize_char(ch):
+            if c == " " and prev_space:
+                continue
+            prev_space = c == " "
+            out.append(c)
+    return "".join(out).strip()
+
+class SignatureMatcher:
+    def __init__(self, signatures):
+        self.signatures = []
+        self.lengths = []      # 正規化後的長度，用來回推命中起點
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [-1]     # 該狀態本身結束的特徵編號
+        self.dict_link = [0]   # 沿 fail 鏈最近一個有輸出的狀態
+        for sig in signatures:
+            norm = normalize(sig)
+            if norm:
+                self._insert(norm, len(self.signatures))
+                self.signatures.append(sig)
+                self.lengths.append(len(norm))
+        self.max_len = max(self.lengths, default=0)
+        self._build()
+
+    def _insert(self, pattern, sig_id):
+        state = 0
+        for c in pattern:
+            nxt = self.goto[state].get(c)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][c] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(-1)
+                self.dict_link.append(0)
+            state = nxt
+        if self.output[state] == -1:
+            self.output[state] = sig_id
+
+    def _build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, nxt in self.goto[state].items():
+                f = self.fail[state]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(c, 0) if self.goto[f].get(c) != nxt else 0
+                link = self.fail[nxt]
+                self.dict_link[nxt] = link if self.output[link] != -1 else self.dict_link[link]
+                queue.append(nxt)
+
+    def stream(self):
+        return StreamScanner(self)
+
+    def scan(self, text):
+        return self.stream().feed(text)
+
+class StreamScanner:
+    """跨多次 feed 保留自動機狀態，特徵被切在兩段文字之間也能命中"""
+    def __init__(self, matcher):
+        self.m = matcher
+        self.state = 0
+        self.offset = 0          # 已讀入的原始字元數
+        self.prev_space = True   # 開頭的空白不參與比對，與 normalize() 的 strip 一致
+        self.origins = deque(maxlen=max(matcher.max_len, 1))  # 最近正規化字元對應的原始 offset
+
+    def feed(self, text):
+        m, hits = self.m, []
+        goto, fail, output, dict_link = m.goto, m.fail, m.output, m.dict_link
+        state = self.state
+        for i, ch in enumerate(text, self.offset):
+            for c in normalize_char(ch):
+                if c == " ":
+                    if self.prev_space:
+                        continue
+                    self.prev_space = True
+                else:
+                    self.prev_space = False
+                self.origins.append(i)
+                while state and c not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(c, 0)
+                s = state if output[state] != -1 else dict_link[state]
+                while s:
+                    sig_id = output[s]
+                    hits.append(Hit(m.signatures[sig_id], self.origins[-m.lengths[sig_id]], i + 1))
+                    s = dict_link[s]
+        self.state = state
+        self.offset += len(text)
+        return hits
+
+def hits_by_span(hits, spans):
+    """把命中對應到重疊的 chunk；spans 為依 start 排序的 (start, end)，回傳 {chunk 索引: [Hit]}"""
+    starts = [s for s, _ in spans]
+    flagged = {}
+    for hit in hits:
+        idx = bisect.bisect_left(starts, hit.end) - 1
+        while idx >= 0 and spans[idx][1] > hit.start:
+            flagged.setdefault(idx, []).append(hit)
+            idx -= 1
+    return flagged
@@ -0,0 +1,260 @@
+"""離線 micro-benchmark
+
+以可調大小的合成語料量測熱點函數，不呼叫任何遠端 API：
+  - CW/02 與 DAY5 的 fixed / sliding / semantic 切塊
+  - DAY5 get_best_match (Jaccard)
+  - CW/02 process_table (串流 HTML 表格)
+  - CW/04 rerank_docs (離線建立的極小 Qwen2 模型，CPU 執行)
+  - 嵌入回應解碼：json.loads → list 與 rag_common.embeddings 直接解碼成 numpy
+
+結果存成 JSON baseline；與 baseline 相比中位數變慢超過門檻的項目會標記為退步，並以 exit code 1 結束。
+
+    python benchmarks/bench.py --save-baseline          # 建立 baseline
+    python benchmarks/bench.py                          # 與 baseline 比較
+    python benchmarks/bench.py --scale 4 --cases fixed_size_chunking get_best_match
+
+--cases 只會建立被選到項目的 fixture；搭配 --save-baseline 時只更新這些項目，其餘 baseline 保留。
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import statistics
+import importlib.util
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_ROOT)
+
+BASELINE_FILE = os.path.join(BENCH_DIR, "baseline.json")
+THRESHOLD = 0.15          # 中位數比 baseline 慢 15% 以上視為退步
+MIN_SAMPLE_TIME = 0.05    # 秒
+
+# 合成語料預設大小 (--scale 倍數放大)
+CORPUS_CHARS = 200_000
+QUERIES = 50
+QUERY_CHUNKS = 2_000
+TABLE_ROWS = 20_000
+RERANK_CANDIDATES = 15
+RERANK_BATCHES = (1, 8)
+EMBED_VECTORS = 64
+EMBED_DIM = 4096
+
+CHARSET = "的一是在不了有和人這中大為上個國我以要他時來用們生到作地於出就分對成會可主發年動同工也能下過子說產種面而方後多定行學法所民得經"
+PUNCT = "。！？"
+
+def load_script(name, relpath):
+    """以路徑載入腳本 (檔名如 02.py 無法直接 import)"""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_ROOT, relpath))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# ================= 合成資料 =================
+
+def synthetic_text(n_chars, rng):
+    """隨機長度的句子 (以 。！？ 結尾)，偶爾穿插換行"""
+    out, total = [], 0
+    while total < n_chars:
+        sentence = "".join(rng.choice(CHARSET) for _ in range(rng.randint(8, 60))) + rng.choice(PUNCT)
+        if rng.random() < 0.05:
+            sentence += "\n"
+        out.append(sentence)
+        total += len(sentence)
+    return "".join(out)[:n_chars]
+
+def synthetic_table(path, rows, rng):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("<html><body><h2>合成表格</h2><table><thead><tr><th>編號</th><th>名稱</th><th>說明</th></tr></thead><tbody>\n")
+        for i in range(rows):
+            f.write(f"<tr><td>{i}</td><td><strong>{synthetic_text(6, rng)}</strong></td><td>{synthetic_text(40, rng)}</td></tr>\n")
+        f.write("</tbody></table></body></html>")
+
+# ================= 極小 reranker (離線建立) =================
+
+def tiny_reranker(corpus):
+    """以語料字元建立 char-level tokenizer 與隨機初始化的 2 層 Qwen2，不需下載任何模型"""
+    import torch
+    from tokenizers import Tokenizer, Regex, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast, Qwen2Config, Qwen2ForCausalLM
+
+    vocab = {"<pad>": 0, "<unk>": 1, "yes": 2, "no": 3}
+    for ch in sorted(set(corpus) | set("<>:InstructQueryDocument根據查詢檢索相關文件\n ")):
+        vocab.setdefault(ch, len(vocab))
+    tok = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tok.pre_tokenizer = pre_tokenizers.Split(Regex(r"[\s\S]"), "isolated")  # 每個字元一個 token
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tok, pad_token="<pad>", unk_token="<unk>", padding_side="left")
+
+    torch.manual_seed(0)
+    config = Qwen2Config(vocab_size=len(vocab), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=4096)
+    return tokenizer, Qwen2ForCausalLM(config).eval()
+
+# ================= Benchmark 項目 =================
+
+def _day5_cases(ctx):
+    day5 = load_script("day5_hw", "HW/DAY5/1111132040_RAG_HW_01.py")
+    rng, corpus = ctx.rng("day5"), ctx.corpus()
+    params = {"chars": len(corpus)}
+    chunks = [synthetic_text(350, rng) for _ in range(int(QUERY_CHUNKS * ctx.scale))]
+    queries = [synthetic_text(20, rng) for _ in range(QUERIES)]
+    return {
+        "fixed_size_chunking": (lambda: day5.fixed_size_chunking(corpus, 350), params),
+        "sliding_window_chunking": (lambda: day5.sliding_window_chunking(corpus, 350, 150), params),
+        "semantic_chunking": (lambda: day5.semantic_chunking(corpus, 350), params),
+        "get_best_match": (lambda: [day5.get_best_match(q, chunks) for q in queries],
+                           {"chunks": len(chunks), "queries": len(queries)}),
+    }
+
+def _table_cases(ctx):
+    cw02 = load_script("cw02", "CW/02/02.py")
+    table_path = os.path.join(ctx.workdir, "table.html")
+    rows = int(TABLE_ROWS * ctx.scale)
+    synthetic_table(table_path, rows, ctx.rng("table"))
+    return {"process_table": (lambda: cw02.process_table(table_path), {"rows": rows, "bytes": os.path.getsize(table_path)})}
+
+def _rerank_cases(ctx):
+    cw04 = load_script("cw04", "CW/04/04.py")
+    cw04.set_reranker(*tiny_reranker(ctx.corpus()))
+    rng = ctx.rng("rerank")
+    docs = [synthetic_text(400, rng) for _ in range(RERANK_CANDIDATES)]
+
+    class _Point:
+        payload = {"source": "synthetic"}
+    points = [_Point()] * len(docs)
+    query = synthetic_text(20, rng)
+    return {f"rerank_docs[batch={b}]": (lambda b=b: cw04.rerank_docs(query, docs, points, limit=3, batch_size=b),
+                                        {"candidates": len(docs), "batch_size": b})
+            for b in RERANK_BATCHES}
+
+def _embed_cases(ctx):
+    import numpy as np
+    from rag_common.embeddings import decode_embeddings
+    rng = ctx.rng("embed")
+    n = int(EMBED_VECTORS * ctx.scale)
+    vectors = [[rng.uniform(-0.1, 0.1) for _ in range(EMBED_DIM)] for _ in range(n)]
+    raw = json.dumps({"embeddings": vectors}).encode("utf-8")
+    params = {"vectors": n, "dim": EMBED_DIM, "bytes": len(raw)}
+    return {"embed_decode[json]": (lambda: np.asarray(json.loads(raw)["embeddings"], dtype=np.float32), params),
+            "embed_decode[numpy]": (lambda: decode_embeddings(raw), params)}
+
+# (項目名稱, 建立函數)：只有被 --cases 選到的群組才會建立 fixture (載入腳本、產生語料、建模型)
+CASE_GROUPS = [
+    (("fixed_size_chunking", "sliding_window_chunking", "semantic_chunking", "get_best_match"), _day5_cases),
+    (("process_table",), _table_cases),
+    (tuple(f"rerank_docs[batch={b}]" for b in RERANK_BATCHES), _rerank_cases),
+    (("embed_decode[json]", "embed_decode[numpy]"), _embed_cases),
+]
+
+class CaseContext:
+    """各群組共用的設定；語料延遲產生，每個群組各用以名稱衍生種子的 rng，篩選項目不影響合成資料"""
+    def __init__(self, scale, seed, workdir):
+        self.scale = scale
+        self.seed = seed
+        self.workdir = workdir
+        self._corpus = None
+
+    def rng(self, name):
+        return random.Random(f"{self.seed}:{name}")
+
+    def corpus(self):
+        if self._corpus is None:
+            self._corpus = synthetic_text(int(CORPUS_CHARS * self.scale), self.rng("corpus"))
+        return self._corpus
+
+def selected(name, prefixes):
+    return not prefixes or any(name.startswith(c) for c in prefixes)
+
+def iter_cases(ctx, prefixes=None):
+    """依序產出 (名稱, (函數, 參數說明) 或略過原因字串)；相依套件缺少時整個群組記錄為略過"""
+    for names, build in CASE_GROUPS:
+        names = [n for n in names if selected(n, prefixes)]
+        if not names:
+            continue
+        try:
+            cases = build(ctx)
+        except ImportError as e:
+            cases = {n: f"缺少套件: {e}" for n in names}
+        for name in names:
+            yield name, cases[name]
+
+def measure(fn, repeat, min_sample=MIN_SAMPLE_TIME):
+    """每個樣本連續呼叫 number 次 (使單一樣本至少 min_sample 秒，降低極短項目的雜訊)，回傳每次呼叫的秒數"""
+    start = time.perf_counter()
+    fn()  # 暖身，同時估計單次耗時
+    once = time.perf_counter() - start
+    number = max(1, int(min_sample / once)) if once > 0 else 1000
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    return {"median": statistics.median(times), "min": min(times), "max": max(times), "repeat": repeat, "number": number}
+
+def compare(results, baseline, threshold):
+    """回傳退步的項目名稱；baseline 中沒有或參數不同的項目不比較"""
+    regressions = []
+    print(f"\n{'項目':30}{'median(ms)':>12}{'baseline':>12}{'變化':>9}")
+    for name, r in results.items():
+        if "skipped" in r:
+            print(f"{name:30}{'略過':>12}  {r['skipped']}")
+            continue
+        base = baseline.get("results", {}).get(name)
+        if not base or "median" not in base or base.get("params") != r["params"]:
+            print(f"{name:30}{r['median'] * 1000:>12.3f}{'-':>12}{'-':>9}")
+            continue
+        change = r["median"] / base["median"] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  ⚠️ 退步"
+        print(f"{name:30}{r['median'] * 1000:>12.3f}{base['median'] * 1000:>12.3f}{change:>+9.1%}{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=float, default=1.0, help="合成語料大小倍數")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cases", nargs="+", help="只執行名稱以這些字串開頭的項目")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="將本次結果寫入 baseline")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, case in iter_cases(CaseContext(args.scale, args.seed, workdir), args.cases):
+            if isinstance(case, str):
+                results[name] = {"skipped": case}
+                continue
+            fn, params = case
+            print(f"⏱️ {name} {params}")
+            results[name] = {**measure(fn, args.repeat), "params": params}
+
+    report = {"scale": args.scale, "seed": args.seed, "python": platform.python_version(),
+              "machine": platform.machine(), "created": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.save_baseline:
+        # 併入既有 baseline：只更新本次實際量測的項目，--cases 篩選或略過的項目保留原值
+        measured = {name: r for name, r in results.items() if "skipped" not in r}
+        report["results"] = {**baseline.get("results", {}), **measured}
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 baseline 已存至 {args.baseline}")
+    if regressions:
+        print(f"\n❌ {len(regressions)} 個項目退步超過 {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
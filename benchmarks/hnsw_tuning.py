@@ -0,0 +1,224 @@
+"""HNSW 與搜尋參數調校：recall@k vs p95 延遲的 Pareto 表
+
+對指定集合的某個 dense 向量：
+  1. 以題目 CSV (questions.csv / questions_answer.csv 的 題目 或 questions 欄) 嵌入成查詢向量
+  2. 在原集合上做精確搜尋 (exact=True) 取得每題 top-k 作為 ground truth
+  3. 依每組 (m, ef_construct) 把向量複製到暫存集合並等待 HNSW 建好，
+     再掃 hnsw_ef × 候選數 (prefetch / 第一階段的 limit)，量測候選集合對 ground truth 的 recall@k 與延遲
+  4. 印出 Pareto 前緣 (沒有其他設定同時更快且 recall 更高)，並推薦達到 --target recall 的最快設定
+
+CSV 含來源欄 (來源文件 / source) 且集合 payload 有 source 時，另外回報候選中含正確來源文件的比例。
+本地模式 (path / :memory:) 的 Qdrant 一律暴力搜尋，調校必須連到伺服器。
+
+    python benchmarks/hnsw_tuning.py --url http://localhost:6333 --collection CW_04_Hybrid_Rerank --using dense \
+        --questions CW/04/questions_answer.csv --k 3
+"""
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import itertools
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from rag_common.embeddings import post_embeddings
+from rag_common.quantization import search_params, wait_indexed
+from rag_common.tracing import percentile
+
+EMBED_URL = "https://ws-04.wade0426.me/embed"
+EMBED_TASK = "查詢"
+REPORT_FILE = os.path.join(BENCH_DIR, "hnsw_tuning.json")
+TMP_COLLECTION = "hnsw_tuning_tmp"
+
+TOP_K = 3
+TARGET_RECALL = 0.95
+M_VALUES = (8, 16, 32)
+EF_CONSTRUCT_VALUES = (64, 128, 256)
+HNSW_EF_VALUES = (16, 32, 64, 128, 256)
+CANDIDATE_VALUES = (3, 15, 30, 60)
+QUESTION_COLUMNS = ("題目", "questions")
+SOURCE_COLUMNS = ("來源文件", "source")
+COPY_BATCH = 256
+
+# ================= 資料 =================
+
+def load_questions(paths):
+    """回傳 [(題目, 來源或 None)]，多個檔案中重複的題目只留一次"""
+    seen, out = set(), []
+    for path in paths:
+        with open(path, "r", encoding="utf-8-sig") as f:
+            for row in csv.DictReader(f):
+                q = next((row[c] for c in QUESTION_COLUMNS if row.get(c)), None)
+                if not q or q in seen:
+                    continue
+                seen.add(q)
+                out.append((q, next((row[c] for c in SOURCE_COLUMNS if row.get(c)), None)))
+    return out
+
+def embed_questions(questions, url, task, batch=64):
+    parts = [post_embeddings(url, {"texts": questions[i:i + batch], "task_description": task, "normalize": True})
+             for i in range(0, len(questions), batch)]
+    return np.concatenate(parts)
+
+def source_vector_params(client, collection, using):
+    """原集合中該向量的 VectorParams (size / distance / 量化沿用)"""
+    vectors = client.get_collection(collection).config.params.vectors
+    return vectors[using] if using else vectors
+
+def iter_points(client, collection, using):
+    """逐批讀出 (ids, 向量陣列, source 清單)"""
+    offset = None
+    while True:
+        points, offset = client.scroll(collection, limit=COPY_BATCH, offset=offset,
+                                       with_vectors=[using] if using else True, with_payload=["source"])
+        if points:
+            yield ([p.id for p in points],
+                   np.asarray([p.vector[using] if using else p.vector for p in points], dtype=np.float32),
+                   [(p.payload or {}).get("source") for p in points])
+        if offset is None:
+            break
+
+def ground_truth(client, collection, using, queries, k):
+    """精確搜尋 (略過量化與 HNSW) 的 top-k id"""
+    from qdrant_client import models
+    exact = models.SearchParams(exact=True, quantization=models.QuantizationSearchParams(ignore=True))
+    return [[p.id for p in client.query_points(collection, query=q, using=using, limit=k, search_params=exact).points]
+            for q in queries]
+
+# ================= 掃描 =================
+
+def build_copy(client, source, using, params, m, ef_construct):
+    """以指定的 m / ef_construct 建立只含該向量的暫存集合，回傳建立秒數"""
+    from qdrant_client import models
+    if client.collection_exists(TMP_COLLECTION):
+        client.delete_collection(TMP_COLLECTION)
+    vector = models.VectorParams(size=params.size, distance=params.distance, on_disk=params.on_disk,
+                                 quantization_config=params.quantization_config,
+                                 hnsw_config=models.HnswConfigDiff(m=m, ef_construct=ef_construct))
+    client.create_collection(TMP_COLLECTION, vectors_config={using: vector} if using else vector,
+                             optimizers_config=models.OptimizersConfigDiff(indexing_threshold=0))  # 小集合也建 HNSW
+    start = time.perf_counter()
+    for ids, vectors, sources in iter_points(client, source, using):
+        client.upload_collection(TMP_COLLECTION, vectors={using: vectors} if using else vectors,
+                                 payload=[{"source": s} for s in sources], ids=ids, wait=True)
+    wait_indexed(client, TMP_COLLECTION)
+    return time.perf_counter() - start
+
+def run_queries(client, using, queries, ef, limit):
+    from qdrant_client import models
+    quant = search_params()
+    params = models.SearchParams(hnsw_ef=ef, quantization=quant.quantization if quant else None)
+    found, times = [], []
+    for q in queries:
+        start = time.perf_counter()
+        points = client.query_points(TMP_COLLECTION, query=q, using=using, limit=limit, search_params=params,
+                                     with_payload=["source"]).points
+        times.append(time.perf_counter() - start)
+        found.append(points)
+    return found, times
+
+def score(found, truth, labels, k):
+    recall = np.mean([len({p.id for p in f} & set(t[:k])) / max(1, len(t[:k])) for f, t in zip(found, truth)])
+    labelled = [(f, s) for f, s in zip(found, labels) if s]
+    hit = np.mean([any((p.payload or {}).get("source") == s for p in f) for f, s in labelled]) if labelled else None
+    return float(recall), (float(hit) if hit is not None else None)
+
+def pareto(rows, k):
+    """依 p95 由小到大，只保留 recall 比所有更快設定都高的列"""
+    front, best = [], -1.0
+    for r in sorted(rows, key=lambda r: (r["p95_ms"], -r[f"recall@{k}"])):
+        if r[f"recall@{k}"] > best:
+            front.append(r)
+            best = r[f"recall@{k}"]
+    return front
+
+def recommend(front, k, target):
+    """達到 target 的最快設定；都達不到時取 recall 最高者"""
+    ok = [r for r in front if r[f"recall@{k}"] >= target]
+    return ok[0] if ok else max(front, key=lambda r: r[f"recall@{k}"])
+
+def print_table(rows, front, k):
+    marks = {id(r) for r in front}
+    print(f"\n{'':2}{'m':>4}{'ef_construct':>14}{'hnsw_ef':>9}{'候選數':>7}{f'recall@{k}':>11}{'來源命中':>9}{'p50(ms)':>10}{'p95(ms)':>10}")
+    for r in sorted(rows, key=lambda r: r["p95_ms"]):
+        hit = f"{r['source_hit']:.3f}" if r["source_hit"] is not None else "-"
+        print(f"{'★' if id(r) in marks else '':2}{r['m']:>4}{r['ef_construct']:>14}{r['hnsw_ef']:>9}{r['candidates']:>7}"
+              f"{r[f'recall@{k}']:>11.4f}{hit:>9}{r['p50_ms']:>10.3f}{r['p95_ms']:>10.3f}")
+    print("  ★ = Pareto 前緣；recall 為候選集合涵蓋精確 top-k 的比例")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:6333")
+    parser.add_argument("--collection", required=True)
+    parser.add_argument("--using", help="具名向量名稱，例如 CW/04 的 dense (Matryoshka 版面為 dense_short)")
+    parser.add_argument("--questions", nargs="+", required=True, help="題目 CSV (questions.csv / questions_answer.csv)")
+    parser.add_argument("--embed-url", default=EMBED_URL)
+    parser.add_argument("--task", default=EMBED_TASK, help="嵌入的 task_description，需與腳本查詢時相同")
+    parser.add_argument("--k", type=int, default=TOP_K)
+    parser.add_argument("--target", type=float, default=TARGET_RECALL)
+    parser.add_argument("--m", type=int, nargs="+", default=list(M_VALUES))
+    parser.add_argument("--ef-construct", type=int, nargs="+", default=list(EF_CONSTRUCT_VALUES))
+    parser.add_argument("--hnsw-ef", type=int, nargs="+", default=list(HNSW_EF_VALUES))
+    parser.add_argument("--candidates", type=int, nargs="+", default=list(CANDIDATE_VALUES))
+    parser.add_argument("--output", default=REPORT_FILE)
+    args = parser.parse_args()
+    if args.k < 1:
+        parser.error("--k 必須 >= 1")
+    candidates = sorted(c for c in set(args.candidates) if c >= args.k)
+    if not candidates:
+        parser.error(f"--candidates 至少要有一個值 >= --k ({args.k})，候選數少於 k 時 recall@k 無意義")
+    if min(args.m + args.ef_construct + args.hnsw_ef) < 1:
+        parser.error("--m / --ef-construct / --hnsw-ef 必須 >= 1")
+    if not 0 < args.target <= 1:
+        parser.error("--target 必須介於 0 與 1 之間")
+
+    from qdrant_client import QdrantClient
+    client = QdrantClient(url=args.url, timeout=120)
+    questions = load_questions(args.questions)
+    if not questions:
+        parser.error(f"{', '.join(args.questions)} 中沒有題目 (欄位需為 {' / '.join(QUESTION_COLUMNS)})")
+    print(f"📝 {len(questions)} 題，嵌入中...")
+    queries = embed_questions([q for q, _ in questions], args.embed_url, args.task)
+    labels = [s for _, s in questions]
+    truth = ground_truth(client, args.collection, args.using, queries, args.k)
+    params = source_vector_params(client, args.collection, args.using)
+
+    rows, builds = [], []
+    try:
+        for m, ef_construct in itertools.product(args.m, args.ef_construct):
+            seconds = build_copy(client, args.collection, args.using, params, m, ef_construct)
+            builds.append({"m": m, "ef_construct": ef_construct, "build_seconds": seconds})
+            print(f"🏗️ m={m} ef_construct={ef_construct}：建立 {seconds:.1f} 秒")
+            for ef in args.hnsw_ef:
+                run_queries(client, args.using, queries[:5], ef, max(candidates))  # 暖身
+                for limit in candidates:
+                    found, times = run_queries(client, args.using, queries, ef, limit)
+                    recall, hit = score(found, truth, labels, args.k)
+                    rows.append({"m": m, "ef_construct": ef_construct, "hnsw_ef": ef, "candidates": limit,
+                                 f"recall@{args.k}": recall, "source_hit": hit,
+                                 "p50_ms": percentile(times, 50) * 1000, "p95_ms": percentile(times, 95) * 1000})
+    finally:
+        if client.collection_exists(TMP_COLLECTION):
+            client.delete_collection(TMP_COLLECTION)
+
+    front = pareto(rows, args.k)
+    print_table(rows, front, args.k)
+    best = recommend(front, args.k, args.target)
+    reached = best[f"recall@{args.k}"] >= args.target
+    print(f"\n✅ 建議{'' if reached else f' (沒有設定達到 recall {args.target:.2f}，取最高者)'}："
+          f"hnsw_config=HnswConfigDiff(m={best['m']}, ef_construct={best['ef_construct']})，"
+          f"search_params=SearchParams(hnsw_ef={best['hnsw_ef']})，候選 limit={best['candidates']} "
+          f"→ recall@{args.k} {best[f'recall@{args.k}']:.4f}，p95 {best['p95_ms']:.2f} ms")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"collection": args.collection, "using": args.using, "questions": len(questions), "k": args.k,
+                   "target": args.target, "created": time.strftime("%Y-%m-%d %H:%M:%S"), "builds": builds,
+                   "results": rows, "pareto": front, "recommended": best}, f, ensure_ascii=False, indent=2)
+    print(f"💾 報告已存至 {args.output}")
+
+if __name__ == "__main__":
+    main()
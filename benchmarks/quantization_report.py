@@ -0,0 +1,222 @@
+"""量化 (int8 / binary) 與未量化 baseline 的 recall / 延遲 / 記憶體比較
+
+ground truth 一律以 numpy 對原始 float32 向量做精確 cosine 搜尋。
+  - 指定 --url：在該 Qdrant 伺服器為每個模式建立暫存集合 (rag_common.quantization 的設定)，量測實際查詢
+  - 未指定 --url：以 numpy 模擬相同流程 (量化向量搜尋 → oversampling 候選 → 讀磁碟上的原始向量 rescore)，完全離線
+
+向量來源：預設為合成的群聚向量，也可用 --vectors 指定 .npy，或 --collection 從既有集合讀出。
+
+    python benchmarks/quantization_report.py --n 20000 --dim 1024
+    python benchmarks/quantization_report.py --url http://localhost:6333 --collection CW_04_Hybrid_Rerank --using dense
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from rag_common.quantization import MODES, INT8_QUANTILE, oversampling, vector_params, search_params, vector_bytes, wait_indexed
+from rag_common.tracing import percentile
+
+REPORT_FILE = os.path.join(BENCH_DIR, "quantization_report.json")
+TOP_K = 10
+QUERIES = 200
+CLUSTERS = 64
+UPLOAD_BATCH = 256
+SIMULATED = "numpy 模擬"
+
+# ================= 資料 =================
+
+def normalize(x):
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+def synthetic_vectors(n, dim, queries, rng):
+    """群聚的單位向量 (較接近真實嵌入的分佈)；查詢為語料向量加上雜訊"""
+    centers = rng.standard_normal((CLUSTERS, dim)).astype(np.float32)
+    data = centers[rng.integers(0, CLUSTERS, n)] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    picks = rng.integers(0, n, queries)
+    qs = data[picks] + 0.4 * rng.standard_normal((queries, dim)).astype(np.float32)
+    return normalize(data).astype(np.float32), normalize(qs).astype(np.float32)
+
+def collection_vectors(client, collection, using, queries, rng):
+    """從既有集合讀出全部向量，隨機抽一部分 (加雜訊) 當查詢"""
+    vectors, offset = [], None
+    while True:
+        points, offset = client.scroll(collection, limit=1024, offset=offset, with_vectors=True, with_payload=False)
+        vectors.extend(p.vector[using] if using else p.vector for p in points)
+        if offset is None:
+            break
+    data = normalize(np.asarray(vectors, dtype=np.float32))
+    qs = data[rng.integers(0, len(data), queries)]
+    return data, normalize(qs + 0.05 * rng.standard_normal(qs.shape).astype(np.float32))
+
+def ground_truth(data, qs, k):
+    scores = qs @ data.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+def recall_at_k(found, truth):
+    return float(np.mean([len(set(f[:len(t)]) & set(t)) / len(t) for f, t in zip(found, truth)]))
+
+# ================= numpy 模擬 =================
+
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+class SimulatedIndex:
+    """量化向量放記憶體、原始向量寫成 memmap 檔 (對應 on_disk)，rescore 時才從檔案讀"""
+    def __init__(self, data, mode, workdir):
+        self.mode = mode
+        if mode == "none":
+            self.full = data
+            return
+        path = os.path.join(workdir, f"originals_{mode}.f32")
+        mm = np.memmap(path, dtype=np.float32, mode="w+", shape=data.shape)
+        mm[:] = data
+        mm.flush()
+        self.full = np.memmap(path, dtype=np.float32, mode="r", shape=data.shape)
+        if mode == "int8":
+            tail = (1 - INT8_QUANTILE) / 2
+            self.lo, hi = np.quantile(data, [tail, 1 - tail])
+            self.step = (hi - self.lo) / 255
+            self.codes = np.clip(np.rint((data - self.lo) / self.step), 0, 255).astype(np.uint8)
+        else:
+            self.codes = np.packbits(data > 0, axis=1)
+
+    def approx_scores(self, q):
+        if self.mode == "int8":
+            # q·x ≈ q·(lo + step * code)
+            return self.lo * q.sum() + self.step * (self.codes @ q)
+        bits = np.packbits(q > 0)
+        return -POPCOUNT[np.bitwise_xor(self.codes, bits)].sum(axis=1, dtype=np.int32)
+
+    def search(self, q, k, oversample):
+        if self.mode == "none":
+            scores = self.full @ q
+            top = np.argpartition(-scores, k)[:k]
+            return top[np.argsort(-scores[top])]
+        approx = self.approx_scores(q)
+        m = min(len(approx) - 1, int(k * oversample))
+        cand = np.argpartition(-approx, m)[:m]
+        cand.sort()  # 依序讀檔
+        exact = np.asarray(self.full[cand]) @ q
+        return cand[np.argsort(-exact)[:k]]
+
+def run_simulated(data, qs, k, modes, workdir):
+    results = {}
+    for mode in modes:
+        index = SimulatedIndex(data, mode, workdir)
+        found, times = [], []
+        for q in qs:
+            start = time.perf_counter()
+            found.append(index.search(q, k, oversampling(mode)))
+            times.append(time.perf_counter() - start)
+        results[mode] = (found, times)
+    return results
+
+# ================= Qdrant 伺服器 =================
+
+def run_server(client, data, qs, k, modes, keep=False):
+    from qdrant_client import models
+    results = {}
+    for mode in modes:
+        name = f"quant_report_{mode}"
+        if client.collection_exists(name):
+            client.delete_collection(name)
+        # indexing_threshold=0：資料量小也建立 HNSW，與正式集合的行為一致
+        client.create_collection(name, vectors_config=vector_params(data.shape[1], mode=mode),
+                                 optimizers_config=models.OptimizersConfigDiff(indexing_threshold=0))
+        client.upload_collection(name, vectors=data, ids=range(len(data)), batch_size=UPLOAD_BATCH)
+        wait_indexed(client, name)
+        params = search_params(mode)
+        found, times = [], []
+        for q in qs:
+            start = time.perf_counter()
+            points = client.query_points(name, query=q.tolist(), limit=k, search_params=params).points
+            times.append(time.perf_counter() - start)
+            found.append([p.id for p in points])
+        results[mode] = (found, times)
+        if not keep:
+            client.delete_collection(name)
+    return results
+
+# ================= 報告 =================
+
+def build_report(results, truth, n, dim, k):
+    rows = []
+    base_ram = vector_bytes(n, dim, "none")[0]
+    for mode, (found, times) in results.items():
+        ram, disk = vector_bytes(n, dim, mode)
+        rows.append({"mode": mode, "oversampling": oversampling(mode) if mode != "none" else None,
+                     f"recall@{k}": recall_at_k(found, truth),
+                     "p50_ms": percentile(times, 50) * 1000, "p95_ms": percentile(times, 95) * 1000,
+                     "ram_bytes": ram, "disk_bytes": disk, "ram_ratio": ram / base_ram})
+    return rows
+
+def print_report(rows, k, backend):
+    mib = 1024 * 1024
+    print(f"\n📊 量化比較 ({backend})")
+    print(f"{'模式':8}{'oversampling':>13}{f'recall@{k}':>11}{'p50(ms)':>10}{'p95(ms)':>10}{'RAM(MiB)':>11}{'磁碟(MiB)':>11}{'RAM 比例':>10}")
+    for r in rows:
+        over = f"{r['oversampling']:g}" if r["oversampling"] else "-"
+        print(f"{r['mode']:8}{over:>13}{r[f'recall@{k}']:>11.4f}{r['p50_ms']:>10.3f}{r['p95_ms']:>10.3f}"
+              f"{r['ram_bytes'] / mib:>11.1f}{r['disk_bytes'] / mib:>11.1f}{r['ram_ratio']:>10.1%}")
+    print("  RAM/磁碟僅計向量本身 (不含 HNSW 圖與 payload)；量化模式的原始向量存於磁碟，只在 rescore 時讀取")
+    if backend == SIMULATED:
+        print("  模擬的延遲為 numpy 暴力計算，只能相對比較；實際 HNSW 延遲請用 --url 在伺服器上量測")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="Qdrant 伺服器；未指定時以 numpy 離線模擬")
+    parser.add_argument("--collection", help="從既有集合讀取向量 (需 --url)")
+    parser.add_argument("--using", help="具名向量名稱，例如 CW/04 的 dense")
+    parser.add_argument("--vectors", help=".npy 向量檔")
+    parser.add_argument("--n", type=int, default=20_000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=QUERIES)
+    parser.add_argument("--k", type=int, default=TOP_K)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=MODES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="保留伺服器上的暫存集合")
+    parser.add_argument("--output", default=REPORT_FILE)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    client = None
+    if args.url:
+        from qdrant_client import QdrantClient
+        client = QdrantClient(url=args.url, timeout=120)
+    if args.collection:
+        if not client:
+            parser.error("--collection 需要 --url")
+        data, qs = collection_vectors(client, args.collection, args.using, args.queries, rng)
+        source = f"collection:{args.collection}"
+    elif args.vectors:
+        data = normalize(np.load(args.vectors).astype(np.float32))
+        qs = normalize(data[rng.integers(0, len(data), args.queries)] + 0.05 * rng.standard_normal((args.queries, data.shape[1])).astype(np.float32))
+        source = f"npy:{args.vectors}"
+    else:
+        data, qs = synthetic_vectors(args.n, args.dim, args.queries, rng)
+        source = "synthetic"
+    n, dim = data.shape
+    print(f"🔢 {source}：{n} 筆 × {dim} 維，{len(qs)} 個查詢，top-{args.k}")
+
+    truth = ground_truth(data, qs, args.k)
+    if client:
+        results, backend = run_server(client, data, qs, args.k, args.modes, args.keep), f"Qdrant {args.url}"
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            results, backend = run_simulated(data, qs, args.k, args.modes, workdir), SIMULATED
+
+    rows = build_report(results, truth, n, dim, args.k)
+    print_report(rows, args.k, backend)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"backend": backend, "source": source, "n": n, "dim": dim, "queries": len(qs), "k": args.k,
+                   "created": time.strftime("%Y-%m-%d %H:%M:%S"), "results": rows}, f, ensure_ascii=False, indent=2)
+    print(f"💾 報告已存至 {args.output}")
+
+if __name__ == "__main__":
+    main()
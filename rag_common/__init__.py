@@ -0,0 +1 @@
+"""各 CW / HW 腳本共用的工具模組"""
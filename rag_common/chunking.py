@@ -0,0 +1,157 @@
+"""以 (start, end) offset 表示的串流切塊
+
+所有策略 (固定大小、滑動視窗、句界) 都只產生 offset，文字等到真正需要時才從來源切出。
+來源可以是記憶體中的字串 (offset 以字元計)，也可以是 mmap 的 UTF-8 檔案
+(offset 以 byte 計，切點自動對齊字元邊界)，多 GB 的語料也只佔常數記憶體。
+"""
+import re
+import mmap
+from collections import namedtuple
+
+SENTENCE_DELIMITERS = "。！？"
+
+class TextSource:
+    """記憶體中的字串"""
+    def __init__(self, text):
+        self.data = text
+
+    def __len__(self):
+        return len(self.data)
+
+    def align(self, pos):
+        return pos
+
+    def text(self, start, end):
+        return self.data[start:end]
+
+    def sentence_ends(self, delimiters=SENTENCE_DELIMITERS):
+        for m in re.finditer(f"[{re.escape(delimiters)}]", self.data):
+            yield m.end()
+
+class MmapSource:
+    """mmap 的 UTF-8 檔案；offset 為 byte，不會把整個檔案讀進記憶體"""
+    def __init__(self, path):
+        self.f = open(path, "rb")
+        try:
+            self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # 空檔案無法 mmap
+            self.data = b""
+
+    def __len__(self):
+        return len(self.data)
+
+    def align(self, pos):
+        """往前移到 UTF-8 字元的起點 (跳過 10xxxxxx 延續位元組)"""
+        while 0 < pos < len(self.data) and (self.data[pos] & 0xC0) == 0x80:
+            pos -= 1
+        return pos
+
+    def text(self, start, end):
+        return self.data[start:end].decode("utf-8", errors="replace")
+
+    def sentence_ends(self, delimiters=SENTENCE_DELIMITERS):
+        # re 可以直接在 mmap 上搜尋
+        pattern = b"|".join(re.escape(d.encode("utf-8")) for d in delimiters)
+        for m in re.finditer(pattern, self.data):
+            yield m.end()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def as_source(text_or_source):
+    return TextSource(text_or_source) if isinstance(text_or_source, str) else text_or_source
+
+# --- 策略：只產生 offset ---
+
+def window_spans(source, size, step, stop=None):
+    """從 0 開始每 step 產生一個長度 size 的視窗，直到起點到達 stop (預設為結尾)"""
+    n = len(source)
+    stop = n if stop is None else stop
+    for start in range(0, stop, step):
+        yield source.align(start), source.align(min(start + size, n))
+
+def fixed_spans(source, size):
+    return window_spans(source, size, size)
+
+def sliding_spans(source, size, overlap):
+    """滑動視窗；內容不超過 size 時整段當作一塊"""
+    n = len(source)
+    if n <= size:
+        yield 0, n
+        return
+    yield from window_spans(source, size, max(1, size - overlap), stop=n - overlap)
+
+def sentence_spans(source, target_size, delimiters=SENTENCE_DELIMITERS):
+    """以句末標點切句，再把相鄰句子合併到不超過 target_size (單句超過時獨立成塊)"""
+    n = len(source)
+    ends = source.sentence_ends(delimiters)
+    cur_start = cur_end = sent_start = 0
+    for sent_end in _with_tail(ends, n):
+        if sent_end - cur_start <= target_size:
+            cur_end = sent_end
+        else:
+            if cur_end > cur_start:
+                yield cur_start, cur_end
+            cur_start, cur_end = sent_start, sent_end
+        sent_start = sent_end
+    if cur_end > cur_start:
+        yield cur_start, cur_end
+
+def _with_tail(ends, n):
+    last = 0
+    for end in ends:
+        last = end
+        yield end
+    if last < n:
+        yield n
+
+# --- 取得文字 ---
+
+Chunk = namedtuple("Chunk", ["start", "end", "source"])
+Chunk.text = property(lambda c: c.source.text(c.start, c.end))
+
+def iter_chunks(source, spans):
+    """把 offset 包成 Chunk，文字以 chunk.text 延遲取得"""
+    for start, end in spans:
+        yield Chunk(start, end, source)
+
+def chunk_texts(source, spans):
+    return [source.text(start, end) for start, end in spans]
+
+# --- 串流清理 ---
+
+def iter_clean(blocks):
+    """移除換行、合併連續空白並去除頭尾空白，可跨區塊邊界串流處理"""
+    pending_space, started = False, False
+    for block in blocks:
+        parts = []
+        for m in re.finditer(r"(\s+)|(\S+)", block.replace("\n", "").replace("\r", "")):
+            if m.group(1):
+                pending_space = started
+            else:
+                if pending_space:
+                    parts.append(" ")
+                    pending_space = False
+                parts.append(m.group(2))
+                started = True
+        if parts:
+            yield "".join(parts)
+
+def iter_file_blocks(path, block_size=1 << 20):
+    with open(path, "r", encoding="utf-8") as f:
+        for block in iter(lambda: f.read(block_size), ""):
+            yield block
+
+def clean_file(src_path, dst_path, block_size=1 << 20):
+    """串流清理整個檔案，輸出可再交給 MmapSource 切塊"""
+    with open(dst_path, "w", encoding="utf-8") as out:
+        for piece in iter_clean(iter_file_blocks(src_path, block_size)):
+            out.write(piece)
@@ -0,0 +1,86 @@
+"""檢索結果的上下文打包
+
+滑動視窗切出的相鄰 chunk 常重疊 100~150 字，直接串接會把重疊部分重複送進 prompt。
+打包流程：
+1. 同一來源、offset 重疊或相接的片段依 (start, end) 合併成一段，分數取最大值
+2. 內容完全相同的片段 (跨來源或沒有 offset) 只保留一份
+3. 依分數由高到低放入，直到用完 token 預算；放不下的片段截斷到剩餘預算
+"""
+import re
+import math
+import hashlib
+
+DEFAULT_BUDGET = 1024    # token
+MIN_FRAGMENT = 32        # 剩餘預算少於此值時不再截斷放入
+SEPARATOR = "\n\n"
+
+_TOKEN_RE = re.compile(r"[぀-ヿ㐀-鿿豈-﫿가-힯]|[A-Za-z0-9_]+|[^\sA-Za-z0-9_]")
+
+def estimate_tokens(text):
+    """不依賴 tokenizer 的估計：CJK 每字 1 token，英數單字約每 4 字元 1 token"""
+    return sum(math.ceil(len(m) / 4) if len(m) > 1 else 1 for m in _TOKEN_RE.findall(text))
+
+def truncate_tokens(text, budget, count_tokens=estimate_tokens):
+    """取不超過 budget token 的最長前綴 (二分搜尋，count_tokens 只呼叫 O(log n) 次)"""
+    if count_tokens(text) <= budget:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(text[:mid]) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo]
+
+def merge_spans(passages):
+    """合併同來源重疊/相接的片段；passage 為 dict，需有 text，可選 source/start/end/score"""
+    merged, loose = [], []
+    by_source = {}
+    for p in passages:
+        if p.get("start") is None or p.get("end") is None:
+            loose.append(dict(p))
+        else:
+            by_source.setdefault(p.get("source"), []).append(p)
+
+    for source, items in by_source.items():
+        items.sort(key=lambda p: (p["start"], -p["end"]))
+        cur = None
+        for p in items:
+            if cur is not None and p["start"] <= cur["end"]:
+                if p["end"] > cur["end"]:
+                    cur["text"] += p["text"][cur["end"] - p["start"]:]
+                    cur["end"] = p["end"]
+                cur["score"] = max(cur.get("score", 0.0), p.get("score", 0.0))
+                cur["merged"] += 1
+            else:
+                cur = dict(p, merged=1)
+                merged.append(cur)
+    return merged + loose
+
+def pack_context(passages, budget=DEFAULT_BUDGET, count_tokens=estimate_tokens, separator=SEPARATOR):
+    """回傳 (context 字串, 依放入順序的片段 list)"""
+    seen, packed = set(), []
+    remaining = budget
+    sep_cost = count_tokens(separator)
+    for p in sorted(merge_spans(passages), key=lambda p: p.get("score", 0.0), reverse=True):
+        digest = hashlib.sha1(p["text"].strip().encode("utf-8")).digest()
+        if digest in seen or not p["text"].strip():
+            continue
+        seen.add(digest)
+        cost = count_tokens(p["text"]) + (sep_cost if packed else 0)
+        if cost <= remaining:
+            packed.append(p)
+            remaining -= cost
+        elif remaining - (sep_cost if packed else 0) >= MIN_FRAGMENT:
+            p = dict(p, text=truncate_tokens(p["text"], remaining - (sep_cost if packed else 0), count_tokens), truncated=True)
+            packed.append(p)
+            remaining = 0
+        if remaining < MIN_FRAGMENT:
+            break
+    return separator.join(p["text"] for p in packed), packed
+
+def pack_texts(texts, budget=DEFAULT_BUDGET, count_tokens=estimate_tokens, separator=SEPARATOR):
+    """沒有 offset 的文字串列：依原順序 (視為分數遞減) 去重並填入預算"""
+    n = len(texts)
+    return pack_context([{"text": t, "score": n - i} for i, t in enumerate(texts)], budget, count_tokens, separator)[0]
@@ -0,0 +1,129 @@
+"""以內容雜湊為鍵的 PDF 逐頁轉換快取
+
+快取鍵為 (頁面內容雜湊, 頁碼, 引擎, 選項)。頁面內容雜湊取自該頁的內容串流與其引用的
+XObject (圖片、表單)，因此文件只改了部分頁面時，其餘頁面仍能命中快取；
+無法逐頁轉換的引擎 (例如 MarkItDown) 則以整份檔案雜湊、頁碼 0 作為鍵。
+"""
+import os
+import json
+import hashlib
+
+DEFAULT_CACHE_DIR = ".conv_cache"
+
+def file_hash(path, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def page_fingerprints(pdf_path):
+    """回傳每頁的內容雜湊；若無 pdfminer 可用則每頁都退回整份檔案雜湊 (只能整份命中)"""
+    try:
+        from pdfminer.pdfparser import PDFParser
+        from pdfminer.pdfdocument import PDFDocument
+        from pdfminer.pdfpage import PDFPage
+        from pdfminer.pdftypes import resolve1, PDFStream
+    except ImportError:
+        import pypdfium2 as pdfium  # docling 的相依套件
+        doc_hash = file_hash(pdf_path)
+        return [doc_hash] * len(pdfium.PdfDocument(pdf_path))
+
+    hashes = []
+    with open(pdf_path, "rb") as f:
+        doc = PDFDocument(PDFParser(f))
+        for page in PDFPage.create_pages(doc):
+            h = hashlib.sha256()
+            h.update(repr((page.mediabox, page.rotate)).encode())
+            for stream in page.contents:
+                stream = resolve1(stream)
+                if isinstance(stream, PDFStream):
+                    h.update(stream.get_rawdata() or b"")
+            resources = resolve1(page.resources) or {}
+            xobjects = resolve1(resources.get("XObject")) or {}
+            for name in sorted(xobjects):
+                obj = resolve1(xobjects[name])
+                if isinstance(obj, PDFStream):
+                    h.update(name.encode() if isinstance(name, str) else bytes(name))
+                    h.update(obj.get_rawdata() or b"")
+            hashes.append(h.hexdigest())
+    return hashes
+
+def contiguous_runs(pages):
+    """[1, 2, 3, 7, 8] -> [(1, 3), (7, 8)]，方便以 page_range 一次轉換連續頁"""
+    runs = []
+    for p in sorted(pages):
+        if runs and p == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], p)
+        else:
+            runs.append((p, p))
+    return runs
+
+class ConversionCache:
+    def __init__(self, root=DEFAULT_CACHE_DIR):
+        self.root = root
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, content_hash, page_no, engine, options=None):
+        raw = json.dumps([content_hash, page_no, engine, options or {}], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, engine, key):
+        return os.path.join(self.root, engine, key[:2], f"{key}.md")
+
+    def get(self, engine, key):
+        path = self._path(engine, key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        self.hits += 1
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def put(self, engine, key, markdown):
+        path = self._path(engine, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(markdown)
+        os.replace(tmp, path)  # 原子寫入，避免多行程同時寫入產生半份檔案
+
+    def lookup_pages(self, pdf_path, engine, options=None, only=None):
+        """回傳 (keys, cached)；cached[i] 為第 i+1 頁的快取內容或 None (only 指定時只查這些頁)"""
+        keys = [self.key(h, i + 1, engine, options) for i, h in enumerate(page_fingerprints(pdf_path))]
+        selected = set(only) if only is not None else None
+        cached = [self.get(engine, k) if selected is None or i + 1 in selected else None
+                  for i, k in enumerate(keys)]
+        return keys, cached
+
+    def convert_pages(self, pdf_path, engine, convert_fn, options=None, only=None):
+        """逐頁轉換，只把未命中的頁 (1-based) 交給 convert_fn(pdf_path, pages) -> {頁碼: markdown}
+
+        only 指定頁碼時僅處理這些頁，其餘頁在回傳列表中為 None。
+        convert_fn 對某頁回傳 None 表示轉換失敗：不寫入快取，該頁同樣為 None。
+        """
+        keys, pages = self.lookup_pages(pdf_path, engine, options, only)
+        wanted = range(1, len(keys) + 1) if only is None else sorted(only)
+        missing = [p for p in wanted if pages[p - 1] is None]
+        if missing:
+            converted = convert_fn(pdf_path, missing)
+            for page_no in missing:
+                md = converted.get(page_no, "")
+                if md is None:
+                    continue
+                self.put(engine, keys[page_no - 1], md)
+                pages[page_no - 1] = md
+        return pages
+
+    def convert_document(self, path, engine, convert_fn, options=None):
+        """整份文件轉換 (無法逐頁的引擎)，以檔案雜湊為鍵"""
+        key = self.key(file_hash(path), 0, engine, options)
+        md = self.get(engine, key)
+        if md is None:
+            md = convert_fn(path)
+            self.put(engine, key, md)
+        return md
+
+    def summary(self):
+        return f"快取命中 {self.hits} / 未命中 {self.misses}"
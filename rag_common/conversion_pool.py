@@ -0,0 +1,464 @@
+"""常駐的 Docling 轉換 worker pool
+
+每個 worker 行程啟動時只載入一次 docling 與版面模型，之後持續從佇列接工作，
+大量小 PDF 不再每份都付一次 import + 模型載入的成本。
+可在同一行程內直接使用 ConversionPool，也可以用 serve() 開一個本機 socket
+(multiprocessing.connection)，讓其他腳本以 PoolClient 送出轉換工作。
+連線會 unpickle 收到的資料，因此 authkey 每次啟動隨機產生並寫入只有本人可讀的檔案 (0600)，
+同一使用者的 PoolClient 從該檔讀取；也可以用環境變數 RAG_POOL_AUTHKEY 指定。
+監聽非 loopback 位址時必須明確指定 authkey (參數或環境變數)。
+
+    with ConversionPool(workers=2) as pool:
+        md = pool.convert("a.pdf")["markdown"]               # 整份
+        pages = pool.convert("b.pdf", pages=[1, 2])["markdown"]  # {頁碼: markdown}
+        pool.print_stats()
+"""
+import os
+import time
+import signal
+import secrets
+import ipaddress
+import queue
+import itertools
+import collections
+import threading
+import multiprocessing as mp
+from concurrent.futures import Future
+from multiprocessing.connection import Listener, Client, wait
+from multiprocessing import AuthenticationError
+
+from rag_common.conversion_cache import contiguous_runs
+from rag_common.tracing import percentile
+
+DEFAULT_ADDRESS = "127.0.0.1:6061"
+AUTHKEY_ENV = "RAG_POOL_AUTHKEY"
+KEY_DIR = os.path.join(os.path.expanduser("~"), ".rag_conversion_pool")
+
+# ================= converter 設定檔 (worker 內建立) =================
+
+def _warm(converter):
+    """預先初始化 PDF 管線 (版面 / 表格模型)，避免第一份文件才載入"""
+    from docling.datamodel.base_models import InputFormat
+    init = getattr(converter, "initialize_pipeline", None)
+    if init:
+        init(InputFormat.PDF)
+    return converter
+
+def build_default_converter():
+    from docling.document_converter import DocumentConverter
+    return _warm(DocumentConverter())
+
+def build_rapid_converter():
+    """不做 OCR 的快速管線 (對應 CW/06 的 RapidOCR 模式)"""
+    from docling.datamodel.base_models import InputFormat
+    from docling.datamodel.pipeline_options import PdfPipelineOptions
+    from docling.document_converter import DocumentConverter, PdfFormatOption
+    return _warm(DocumentConverter(
+        format_options={InputFormat.PDF: PdfFormatOption(pipeline_options=PdfPipelineOptions(do_ocr=False))}
+    ))
+
+PROFILES = {"default": build_default_converter, "rapid": build_rapid_converter}
+
+def convert_with(converter, path, pages=None):
+    """pages 為 None 時回傳整份 markdown，否則回傳 {頁碼: markdown} (1-based)"""
+    if pages is None:
+        return converter.convert(path).document.export_to_markdown()
+    out = {}
+    for start, end in contiguous_runs(pages):
+        doc = converter.convert(path, page_range=(start, end)).document
+        out.update({p: doc.export_to_markdown(page_no=p) for p in range(start, end + 1)})
+    return out
+
+def _worker_main(worker_id, profiles, warm, conn):
+    """worker 行程 (conn 為與父行程之間的專屬 Pipe)：先建立 warm 指定的 converter (計入啟動時間)，
+    其餘設定檔第一次用到時才建立，之後持續重用"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C 由父行程處理，再以 None 通知結束
+    start = time.perf_counter()
+    converters = {}
+    try:
+        for name in warm:
+            converters[name] = profiles[name]()
+    except Exception as e:
+        conn.send(("failed", worker_id, f"{type(e).__name__}: {e}"))
+        return
+    conn.send(("ready", worker_id, time.perf_counter() - start, os.getpid()))
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        job_id, profile, path, pages = job
+        t0 = time.perf_counter()
+        try:
+            if profile not in converters:
+                converters[profile] = profiles[profile]()
+            out, error = convert_with(converters[profile], path, pages), None
+        except Exception as e:
+            out, error = None, f"{type(e).__name__}: {e}"
+        conn.send(("done", worker_id, job_id, out, error, time.perf_counter() - t0))
+
+# ================= 行程內使用的 pool =================
+
+class ConversionPool:
+    """由父行程分派工作：每個 worker 以專屬 Pipe 一次只拿一份工作，
+    因此 worker 崩潰 (segfault / OOM) 時知道是哪份工作失敗，並重新啟動該 worker。
+    不共用 mp.Queue：行程在寫入途中被殺掉會留下鎖住的共用佇列，其他 worker 也跟著卡住。"""
+    def __init__(self, workers=2, profiles=None, warm=("default",)):
+        self.profiles = profiles or PROFILES
+        self.warm = tuple(warm)
+        self.ctx = mp.get_context("spawn")  # 不 fork 已載入 torch 的父行程
+        self.created = time.perf_counter()
+
+        self.ids = itertools.count()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.backlog = collections.deque()  # 尚未分派的工作
+        self.busy = {}           # worker -> 執行中的 job_id
+        self.idle = set()        # 已就緒且空閒的 worker
+        self.up = set()          # 曾回報就緒、目前仍應存活的 worker (崩潰時才重啟)
+        self.failed = set()      # 已結束且不再重啟的 worker
+        self.closing = False
+        self.restarts = 0
+        self.startup = {}        # worker -> 建立 converter 的秒數
+        self.ready_at = None     # 全部 worker 就緒的時間點 (相對於 pool 建立)
+        self.errors = []
+        self.durations = []      # (完成時間點, 單次轉換秒數, worker)
+
+        self.procs, self.conns = [None] * workers, [None] * workers
+        for i in range(workers):
+            self._spawn(i)
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+        self.collector.start()
+
+    def _spawn(self, worker):
+        parent, child = self.ctx.Pipe()
+        self.conns[worker] = parent
+        self.procs[worker] = self.ctx.Process(target=_worker_main, daemon=True,
+                                              args=(worker, self.profiles, self.warm, child))
+        self.procs[worker].start()
+        child.close()
+
+    def _dispatch(self):
+        """(需持有 lock) 把待處理的工作交給空閒的 worker"""
+        while self.idle and self.backlog and not self.closing:
+            worker = self.idle.pop()
+            job = self.backlog.popleft()
+            self.busy[worker] = job[0]
+            try:
+                self.conns[worker].send(job)
+            except OSError:
+                self.backlog.appendleft(job)  # worker 已結束，留給 _reap 處理
+                self.busy.pop(worker)
+
+    def _handle(self, msg):
+        kind, worker = msg[0], msg[1]
+        if kind == "ready":
+            self.startup.setdefault(worker, msg[2])
+            with self.lock:
+                self.up.add(worker)
+                self.idle.add(worker)
+                self._dispatch()
+        elif kind == "failed":
+            with self.lock:
+                self.failed.add(worker)
+            self.errors.append(f"worker {worker} 啟動失敗: {msg[2]}")
+        elif kind == "done":
+            _, _, job_id, out, error, seconds = msg
+            with self.lock:
+                fut, path, pages = self.pending.pop(job_id)
+                self.durations.append((time.perf_counter() - self.created, seconds, worker))
+                self.busy.pop(worker, None)
+                self.idle.add(worker)
+                self._dispatch()
+            if error:
+                fut.set_exception(RuntimeError(f"{path}: {error}"))
+            else:
+                fut.set_result({"path": path, "pages": pages, "markdown": out, "seconds": seconds, "worker": worker})
+        self._check_ready()
+
+    def _drain(self, worker):
+        """讀完 worker 結束前已送出的訊息 (例如剛完成的結果)"""
+        conn = self.conns[worker]
+        try:
+            while conn.poll():
+                self._handle(conn.recv())
+        except (EOFError, OSError):
+            pass
+
+    def _reap(self, worker):
+        """worker 行程已結束：執行中的工作判定失敗，曾就緒的 worker 重新啟動"""
+        self._drain(worker)
+        proc = self.procs[worker]
+        proc.join()
+        lost = None
+        with self.lock:
+            self.idle.discard(worker)
+            job_id = self.busy.pop(worker, None)
+            if job_id is not None:
+                fut, path, _ = self.pending.pop(job_id)
+                lost = (fut, f"{path}: worker {worker} 異常結束 (exitcode {proc.exitcode})")
+            self.conns[worker].close()
+            if worker in self.failed:
+                pass
+            elif self.closing:
+                self.failed.add(worker)
+            elif worker in self.up:
+                self.up.discard(worker)
+                self.errors.append(f"worker {worker} 異常結束 (exitcode {proc.exitcode})，重新啟動")
+                self.restarts += 1
+                self._spawn(worker)
+            else:
+                # 尚未就緒就結束 (例如載入模型時崩潰)：重啟多半同樣失敗，不再重試
+                self.failed.add(worker)
+                self.errors.append(f"worker {worker} 啟動時異常結束 (exitcode {proc.exitcode})")
+        if lost:
+            lost[0].set_exception(RuntimeError(lost[1]))
+        self._check_ready()
+
+    def _collect(self):
+        while len(self.failed) < len(self.procs):
+            with self.lock:
+                live = [i for i in range(len(self.procs)) if i not in self.failed]
+                conns = {self.conns[i]: i for i in live}
+                sentinels = {self.procs[i].sentinel: i for i in live}
+            ready = wait(list(conns) + list(sentinels), timeout=1)
+            for obj in ready:
+                if obj in conns:
+                    try:
+                        self._handle(obj.recv())
+                    except (EOFError, OSError):
+                        pass  # 行程已結束，由 sentinel 處理
+            for obj in ready:
+                if obj in sentinels:
+                    self._reap(sentinels[obj])
+        # 所有 worker 都已結束：未完成的工作一律失敗，避免呼叫端永遠等待
+        self.ready.set()
+        with self.lock:
+            lost = list(self.pending.values())
+            self.pending.clear()
+            self.backlog.clear()
+        for fut, path, _ in lost:
+            fut.set_exception(RuntimeError(f"{path}: worker 已結束"))
+
+    def _check_ready(self):
+        if not self.ready.is_set() and len(set(self.startup) | self.failed) == len(self.procs):
+            self.ready_at = time.perf_counter() - self.created
+            self.ready.set()
+
+    def wait_ready(self, timeout=None):
+        self.ready.wait(timeout)
+        if not self.startup:
+            raise RuntimeError("; ".join(self.errors) or "沒有可用的 worker")
+        return self.startup
+
+    def submit(self, path, pages=None, profile="default"):
+        if profile not in self.profiles:
+            raise ValueError(f"未知的設定檔: {profile}")
+        fut = Future()
+        pages = sorted(pages) if pages is not None else None
+        with self.lock:
+            if len(self.failed) == len(self.procs):
+                raise RuntimeError("沒有可用的 worker")
+            job_id = next(self.ids)
+            self.pending[job_id] = (fut, path, pages)
+            self.backlog.append((job_id, profile, os.path.abspath(path), pages))
+            self._dispatch()
+        return fut
+
+    def convert(self, path, pages=None, profile="default"):
+        return self.submit(path, pages, profile).result()
+
+    def map(self, paths, profile="default"):
+        """送出多份文件，依完成順序產出結果 (失敗的文件產出含 error 的 dict)"""
+        futures = {self.submit(p, profile=profile): p for p in paths}
+        done = queue.Queue()
+        for fut in futures:
+            fut.add_done_callback(done.put)
+        for _ in futures:
+            fut = done.get()
+            try:
+                yield fut.result()
+            except Exception as e:
+                yield {"path": futures[fut], "error": str(e)}
+
+    def stats(self):
+        with self.lock:
+            durations = list(self.durations)
+        seconds = [d for _, d, _ in durations]
+        firsts, seen = [], set()
+        for _, d, w in durations:
+            if w not in seen:
+                seen.add(w)
+                firsts.append(d)
+        elapsed = (durations[-1][0] - self.ready_at) if durations and self.ready_at else 0.0
+        return {
+            "workers": len(self.procs),
+            "startup": {"ready_after": self.ready_at, "per_worker": dict(sorted(self.startup.items())),
+                        "errors": list(self.errors), "restarts": self.restarts},
+            "steady": {"jobs": len(seconds), "p50": percentile(seconds, 50), "p95": percentile(seconds, 95),
+                       "first_job_mean": sum(firsts) / len(firsts) if firsts else 0.0,
+                       "docs_per_sec": len(seconds) / elapsed if elapsed > 0 else 0.0},
+        }
+
+    def print_stats(self):
+        s = self.stats()
+        per_worker = s["startup"]["per_worker"].values()
+        print(f"\n📊 轉換 pool ({s['workers']} workers)")
+        if per_worker:
+            print(f"  啟動：{s['startup']['ready_after']:.2f} 秒全部就緒 "
+                  f"(單一 worker 載入 {min(per_worker):.2f}~{max(per_worker):.2f} 秒)")
+        if s["startup"]["restarts"]:
+            print(f"  ⚠️ worker 異常結束後重新啟動 {s['startup']['restarts']} 次")
+        st = s["steady"]
+        print(f"  穩態：{st['jobs']} 份，p50 {st['p50']:.2f} 秒 / p95 {st['p95']:.2f} 秒，"
+              f"各 worker 首份平均 {st['first_job_mean']:.2f} 秒，{st['docs_per_sec']:.2f} 份/秒")
+
+    def close(self):
+        with self.lock:
+            self.closing = True
+            for conn in self.conns:
+                try:
+                    conn.send(None)
+                except OSError:
+                    pass
+        self.collector.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# ================= 本機 socket 服務 =================
+
+def parse_address(address):
+    """"host:port" 為 TCP；含 / 的字串視為 Unix socket 路徑"""
+    if isinstance(address, tuple) or "/" in address:
+        return address
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+def _handle(pool, conn):
+    with conn:
+        while True:
+            try:
+                req = conn.recv()
+            except (EOFError, OSError):
+                break
+            if req.get("op") == "stats":
+                conn.send(pool.stats())
+                continue
+            try:
+                conn.send(pool.convert(req["path"], req.get("pages"), req.get("profile", "default")))
+            except Exception as e:
+                conn.send({"path": req.get("path"), "error": str(e)})
+
+def key_path(address):
+    """該位址的 authkey 檔案路徑 (每個位址一個檔案)"""
+    name = "".join(c if c.isalnum() or c in ".-" else "_" for c in str(address))
+    return os.path.join(KEY_DIR, f"{name}.key")
+
+def is_loopback(address):
+    address = parse_address(address)
+    if isinstance(address, str):
+        return True  # Unix socket 只能在本機連線
+    host = address[0]
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def _env_authkey():
+    key = os.environ.get(AUTHKEY_ENV)
+    return key.encode("utf-8") if key else None
+
+def _write_key(path, key):
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(key.hex())
+    os.chmod(path, 0o600)  # 既有檔案的權限不受 os.open 的 mode 影響
+
+def read_authkey(address):
+    """PoolClient 使用的 authkey：環境變數優先，其次為 serve() 寫出的金鑰檔"""
+    key = _env_authkey()
+    if key:
+        return key
+    path = key_path(address)
+    if not os.path.exists(path):
+        raise RuntimeError(f"找不到 {address} 的 authkey ({path})；請確認服務已啟動，或設定 {AUTHKEY_ENV}")
+    with open(path, "r", encoding="ascii") as f:
+        return bytes.fromhex(f.read().strip())
+
+def serve(address=DEFAULT_ADDRESS, workers=2, profiles=None, warm=("default",), authkey=None):
+    """常駐服務：每個連線一個執行緒，工作交給共用的 pool (Ctrl+C 結束)
+
+    authkey 未指定時取 RAG_POOL_AUTHKEY；仍沒有則隨機產生並寫入 key_path(address)，只允許 loopback 位址。
+    """
+    authkey = authkey or _env_authkey()
+    key_file = None
+    if authkey is None:
+        if not is_loopback(address):
+            raise ValueError(f"監聽非本機位址 {address} 時必須以 authkey 參數或 {AUTHKEY_ENV} 明確指定金鑰")
+        authkey = secrets.token_bytes(32)
+        key_file = key_path(address)
+        _write_key(key_file, authkey)
+    try:
+        with ConversionPool(workers, profiles, warm) as pool:
+            startup = pool.wait_ready()
+            print(f"✅ {len(startup)} 個 worker 就緒 ({pool.ready_at:.2f} 秒)，監聽 {address}")
+            if key_file:
+                print(f"🔑 authkey 已寫入 {key_file}")
+            with Listener(parse_address(address), authkey=authkey) as listener:
+                try:
+                    while True:
+                        try:
+                            conn = listener.accept()
+                        except AuthenticationError:
+                            print("⚠️ 拒絕 authkey 不符的連線")
+                            continue
+                        except (EOFError, ConnectionError):
+                            continue  # 握手途中斷線
+                        threading.Thread(target=_handle, args=(pool, conn), daemon=True).start()
+                except KeyboardInterrupt:
+                    pass
+            pool.print_stats()
+    finally:
+        if key_file and os.path.exists(key_file):
+            os.remove(key_file)
+
+class PoolClient:
+    """連線到 serve() 啟動的服務；檔案路徑以服務端的檔案系統解析。authkey 未指定時以 read_authkey 取得"""
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None):
+        self.conn = Client(parse_address(address), authkey=authkey or read_authkey(address))
+
+    def convert(self, path, pages=None, profile="default"):
+        self.conn.send({"path": os.path.abspath(path), "pages": sorted(pages) if pages is not None else None,
+                        "profile": profile})
+        result = self.conn.recv()
+        if "error" in result:
+            raise RuntimeError(result["error"])
+        return result
+
+    def page_converter(self, profile="default"):
+        """給 ConversionCache.convert_pages 使用的 convert_fn(pdf_path, pages)"""
+        return lambda pdf_path, pages: self.convert(pdf_path, pages, profile)["markdown"]
+
+    def stats(self):
+        self.conn.send({"op": "stats"})
+        return self.conn.recv()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
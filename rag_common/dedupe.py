@@ -0,0 +1,73 @@
+"""嵌入前的近似重複 chunk 過濾 (MinHash + LSH)
+
+滑動視窗重疊、跨檔案重複的樣板文字會產生大量幾乎相同的 chunk。
+每個 chunk 以字元 shingle 計算 MinHash 簽章，經 LSH 分桶找出候選，
+估計的 Jaccard 相似度達門檻者只保留第一個 (代表)，其餘記錄「被丟棄 → 代表」的對應。
+"""
+import json
+import zlib
+import hashlib
+import numpy as np
+
+_PRIME = np.uint64(4294967311)  # 大於 2^32 的質數，a * x 不會溢位 uint64
+
+class NearDuplicateFilter:
+    def __init__(self, threshold=0.8, num_perm=64, bands=16, shingle=5, seed=1):
+        assert num_perm % bands == 0
+        self.threshold = threshold
+        self.bands, self.rows = bands, num_perm // bands
+        self.shingle = shingle
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 2**32, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 2**32, size=num_perm, dtype=np.uint64)
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = {}
+        self.exact = {}
+        self.duplicates = {}  # 被丟棄的 key -> 代表 key
+
+    def signature(self, text):
+        k = self.shingle
+        grams = {text[i:i + k] for i in range(max(1, len(text) - k + 1))}
+        x = np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams))
+        return ((self.a[:, None] * x[None, :] + self.b[:, None]) % _PRIME).min(axis=1)
+
+    def add(self, key, text):
+        """新 chunk 回傳 None；近似重複時回傳代表的 key (並記錄在 duplicates)"""
+        digest = hashlib.sha1(text.encode("utf-8")).digest()
+        if digest in self.exact:
+            rep = self.exact[digest]
+            self.duplicates[key] = rep
+            return rep
+
+        sig = self.signature(text)
+        bands = [sig[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+        checked = set()
+        for table, band in zip(self.buckets, bands):
+            for cand in table.get(band, ()):
+                if cand in checked:
+                    continue
+                checked.add(cand)
+                if np.mean(self.signatures[cand] == sig) >= self.threshold:
+                    self.duplicates[key] = cand
+                    return cand
+
+        self.exact[digest] = key
+        self.signatures[key] = sig
+        for table, band in zip(self.buckets, bands):
+            table.setdefault(band, []).append(key)
+        return None
+
+    def summary(self):
+        kept, dropped = len(self.signatures), len(self.duplicates)
+        ratio = dropped / (kept + dropped) if kept + dropped else 0.0
+        return f"去重：保留 {kept}、丟棄 {dropped} ({ratio:.1%})"
+
+    def save_mapping(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({str(k): str(v) for k, v in self.duplicates.items()}, f, ensure_ascii=False, indent=2)
+
+def dedupe(items, key=lambda item: item["id"], text=lambda item: item["text"], dedup_filter=None):
+    """過濾 items，回傳 (保留的 items, {被丟棄 key: 代表 key})"""
+    f = dedup_filter or NearDuplicateFilter()
+    kept = [item for item in items if f.add(key(item), text(item)) is None]
+    return kept, f.duplicates
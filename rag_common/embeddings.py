@@ -0,0 +1,65 @@
+"""嵌入 API 回應直接解碼成連續的 numpy 陣列
+
+response.json() 會把每個分量建成一個 Python float (4096 維 ≈ 每個向量 100 KB 以上的物件)，
+大量匯入時記憶體與 GC 時間都耗在這些物件上。這裡直接在原始回應 bytes 中找出
+"embeddings" 陣列，逐列以 np.loadtxt 解析成 (n, dim) 的 float32 / float16 陣列；
+格式不符預期 (含 null、維度不一致) 時才退回 json 解析。
+
+    vectors = post_embeddings(EMBED_URL, {"texts": texts, "task_description": "檢索"})
+    client.upload_collection(name, vectors=vectors, payload=payloads, ids=ids)
+
+RAG_EMBED_DTYPE=float16 可再把常駐記憶體減半 (送進向量庫前仍以 float32 計分)。
+"""
+import os
+import re
+import json
+
+import numpy as np
+
+from rag_common.transport import get_transport
+
+EMBED_DTYPE = np.dtype(os.environ.get("RAG_EMBED_DTYPE", "float32"))
+_ARRAY_START = {}
+_ARRAY_END = re.compile(rb"\]\s*\]")
+_ROW = re.compile(rb"\[([^\]]*)\]")
+_EMPTY_ROW = re.compile(rb"\[\s*\]")
+
+def _start_pattern(key):
+    if key not in _ARRAY_START:
+        _ARRAY_START[key] = re.compile(rb'"' + re.escape(key.encode()) + rb'"\s*:\s*\[\s*')
+    return _ARRAY_START[key]
+
+def _decode_json(raw, key, dtype):
+    vectors = json.loads(raw).get(key) or []
+    return np.asarray(vectors, dtype=dtype).reshape(len(vectors), -1) if vectors else np.empty((0, 0), dtype=dtype)
+
+def decode_embeddings(raw, key="embeddings", dtype=None):
+    """從回應 bytes 解出 key 對應的二維數值陣列，回傳 (n, dim) ndarray；含 null 或維度不一致時退回 json 解析"""
+    dtype = np.dtype(dtype or EMBED_DTYPE)
+    start = _start_pattern(key).search(raw)
+    if not start:
+        return _decode_json(raw, key, dtype)
+    begin = start.end()
+    if raw[begin:begin + 1] == b"]":
+        return np.empty((0, 0), dtype=dtype)
+    end = _ARRAY_END.search(raw, begin)
+    if not end or raw[begin:begin + 1] != b"[":
+        return _decode_json(raw, key, dtype)
+    body = memoryview(raw)[begin:end.start() + 1]
+    if _EMPTY_ROW.search(body):
+        return _decode_json(raw, key, dtype)  # loadtxt 會略過空列
+    rows = raw.count(b"[", begin, end.start() + 1)
+    # 每列當成一行 CSV 交給 loadtxt 的 C 解析器，暫存只有一列的字串，不為每個分量建立 Python float
+    lines = (row.group(1).decode("ascii") for row in _ROW.finditer(body))
+    try:
+        out = np.loadtxt(lines, delimiter=",", dtype=dtype, ndmin=2)
+    except ValueError:
+        # null / NaN 等非數值或各列維度不一致，交給 json 處理 (並讓錯誤訊息較清楚)
+        return _decode_json(raw, key, dtype)
+    return out if out.shape[0] == rows else _decode_json(raw, key, dtype)
+
+def post_embeddings(url, payload, timeout=60, dtype=None, key="embeddings", **kwargs):
+    """POST 嵌入請求並回傳 (n, dim) ndarray，非 2xx 時拋出 HTTPError"""
+    response = get_transport().post(url, json=payload, timeout=timeout, **kwargs)
+    response.raise_for_status()
+    return decode_embeddings(response.content, key, dtype)
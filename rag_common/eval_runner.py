@@ -0,0 +1,52 @@
+"""非同步評估執行器：題目併發執行，完成一題就寫出一題"""
+import csv
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+async def _run(items, worker, concurrency, on_result):
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(concurrency)
+    results = []
+    # 現有的 worker 皆為同步 requests 呼叫，放進專屬執行緒池，大小與併發數一致
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        async def _one(item):
+            async with sem:
+                try:
+                    return await loop.run_in_executor(pool, worker, item)
+                except Exception as e:
+                    return e
+        for fut in asyncio.as_completed([_one(item) for item in items]):
+            res = await fut
+            if isinstance(res, Exception):
+                print(f"❌ 評估失敗: {res}")
+                continue
+            if res is None:
+                continue
+            results.append(res)
+            if on_result:
+                on_result(res)
+    return results
+
+def run_concurrent(items, worker, concurrency=8, on_result=None):
+    """以 concurrency 併發執行 worker(item)，回傳成功結果 (依完成順序)"""
+    return asyncio.run(_run(list(items), worker, concurrency, on_result))
+
+class CsvResultWriter:
+    """結果邊完成邊寫入 CSV，中途中斷也保有已完成的部分"""
+    def __init__(self, path, fieldnames):
+        self.f = open(path, "w", encoding="utf-8-sig", newline="")
+        self.writer = csv.DictWriter(self.f, fieldnames=fieldnames, extrasaction="ignore")
+        self.writer.writeheader()
+
+    def write(self, row):
+        self.writer.writerow(row)
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
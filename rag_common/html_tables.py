@@ -0,0 +1,161 @@
+"""串流式 HTML 表格讀取 (iterparse 風格)
+
+以標準庫 html.parser 分塊餵入，每讀完一列 <tr> 就產出一筆紀錄，
+不建立整份 DOM，數百 MB 的匯出檔也只佔常數記憶體。
+每列可轉成一個檢索 chunk，並重複表頭與表格所在段落標題作為上下文。
+"""
+from html.parser import HTMLParser
+from collections import namedtuple
+
+from rag_common.chunking import iter_file_blocks
+
+TableRow = namedtuple("TableRow", ["table", "row", "context", "header", "cells"])
+
+HEADINGS = {"h1", "h2", "h3", "h4", "h5", "h6"}
+SKIP_TAGS = {"script", "style"}
+MAX_COLSPAN = 1000       # 異常的 colspan (例如 10000000) 不應讓單列展開成巨量儲存格
+
+class _TableState:
+    def __init__(self, index, context):
+        self.index = index
+        self.context = context
+        self.header = []
+        self.rows = 0
+        self.in_thead = False
+        self.row = None          # 目前列的 [(文字, 是否為 th)]
+        self.cell = None         # 目前儲存格的文字片段
+        self.cell_is_th = False
+        self.colspan = 1
+
+class TableRowParser(HTMLParser):
+    """事件驅動解析；完成的列累積在 self.ready，由呼叫端取走"""
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.ready = []
+        self.tables = []         # 巢狀表格堆疊
+        self.count = 0
+        self.heading = ""        # 最近的段落標題 (h1~h6 / caption)
+        self._heading_buf = None
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self._skip += 1
+            return
+        t = self.tables[-1] if self.tables else None
+        if tag in HEADINGS or (tag == "caption" and t):
+            self._heading_buf = []
+        elif tag == "table":
+            self.tables.append(_TableState(self.count, self.heading))
+            self.count += 1
+        elif not t:
+            return
+        elif tag in ("thead", "tbody", "tfoot"):
+            # 省略結束標籤時，新的區段隱含結束前一個區段與其中未關閉的列
+            self._finish_row(t)
+            t.in_thead = tag == "thead"
+        elif tag == "tr":
+            self._finish_row(t)
+            t.row = []
+        elif tag in ("td", "th"):
+            # </td> / </th> 可省略：新儲存格隱含結束前一格；沒有 <tr> 時隱含開始一列
+            self._finish_cell(t)
+            if t.row is None:
+                t.row = []
+            t.cell, t.cell_is_th = [], tag == "th"
+            t.colspan = self._colspan(t, dict(attrs).get("colspan"))
+        elif tag == "br" and t.cell is not None:
+            t.cell.append(" ")
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+            return
+        t = self.tables[-1] if self.tables else None
+        if (tag in HEADINGS or tag == "caption") and self._heading_buf is not None:
+            text = " ".join("".join(self._heading_buf).split())
+            self._heading_buf = None
+            if tag == "caption" and t:
+                t.context = " / ".join(x for x in (t.context, text) if x)
+            else:
+                self.heading = text
+        elif tag == "table" and t:
+            self._finish_row(t)
+            self.tables.pop()
+        elif not t:
+            return
+        elif tag in ("thead", "tbody", "tfoot"):
+            self._finish_row(t)
+            t.in_thead = False
+        elif tag in ("td", "th"):
+            self._finish_cell(t)
+        elif tag == "tr":
+            self._finish_row(t)
+
+    def handle_data(self, data):
+        if self._skip:
+            return
+        if self._heading_buf is not None:
+            self._heading_buf.append(data)
+        if self.tables and self.tables[-1].cell is not None:
+            self.tables[-1].cell.append(data)
+
+    @staticmethod
+    def _colspan(t, value):
+        """colspan 限制在 1 ~ 表頭寬度 (尚無表頭時為 MAX_COLSPAN)；0 或非數字視為 1"""
+        span = int(value) if value and value.strip().isdigit() else 1
+        return max(1, min(span, len(t.header) or MAX_COLSPAN, MAX_COLSPAN))
+
+    def _finish_cell(self, t):
+        if t.cell is None:
+            return
+        text = " ".join("".join(t.cell).split())
+        t.row.extend([(text, t.cell_is_th)] * t.colspan)
+        t.cell = None
+
+    def _finish_row(self, t):
+        """結束目前的列 (含未關閉的儲存格)；沒有開啟中的列時不做事"""
+        self._finish_cell(t)
+        row, t.row = t.row, None
+        if not row:
+            return
+        cells = [text for text, _ in row]
+        # thead 內或全為 th 的列視為表頭 (尚未有表頭時)
+        if t.in_thead or (not t.header and all(is_th for _, is_th in row)):
+            t.header = cells
+            return
+        self.ready.append(TableRow(t.index, t.rows, t.context, t.header, cells))
+        t.rows += 1
+
+def iter_table_rows(blocks):
+    """由文字區塊串流產出 TableRow；可省略的 </td> </th> </tr> 結束標籤也能正確分列
+
+    >>> [r.cells for r in iter_table_rows(["<table><tr><th>A<th>B<tr><td>1<td>2<tr><td>3<td>4</table>"])]
+    [['1', '2'], ['3', '4']]
+    >>> [r.header for r in iter_table_rows(["<table><thead><tr><th>A<th>B<tbody><tr><td>1<td>2</table>"])]
+    [['A', 'B']]
+    >>> [r.cells for r in iter_table_rows(['<table><tr><th>A<th>B<tr><td colspan="10000000">x<td colspan="0">y</table>'])]
+    [['x', 'x', 'y']]
+    """
+    parser = TableRowParser()
+    for block in blocks:
+        parser.feed(block)
+        if parser.ready:
+            yield from parser.ready
+            parser.ready = []
+    parser.close()
+    yield from parser.ready
+
+def iter_html_table_rows(path, block_size=1 << 20):
+    return iter_table_rows(iter_file_blocks(path, block_size))
+
+def row_chunk(row):
+    """單列轉成檢索 chunk：段落標題 + 「欄位: 值」；無表頭時以 | 串接"""
+    if row.header:
+        body = "；".join(f"{h}: {v}" if h else v for h, v in zip(row.header, row.cells) if v)
+        extra = row.cells[len(row.header):]
+        if extra:
+            body += "；" + " | ".join(extra)
+    else:
+        body = " | ".join(row.cells)
+    return f"{row.context}\n{body}" if row.context else body
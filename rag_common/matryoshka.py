@@ -0,0 +1,71 @@
+"""Matryoshka 兩階段檢索：短前綴向量找候選，完整向量重新計分
+
+Matryoshka 訓練的嵌入模型，前 d 維 (重新正規化後) 本身就是可用的低維嵌入。
+索引把前綴存成主要搜尋向量 (建 HNSW)，完整向量存成另一個具名向量，
+不建圖 (m=0) 且放在磁碟，只在第二階段替少量候選計分：
+
+    RAG_MATRYOSHKA_DIM=256          (0 或未設定 = 停用，維持單一完整向量)
+    RAG_MATRYOSHKA_CANDIDATES=4     (第一階段取回 limit 的幾倍候選)
+
+    vectors_config={**dense_config(dim), "sparse": ...}
+    vector={**dense_vectors(emb), "sparse": ...}
+    prefetch=[dense_prefetch(q_emb, limit), ...]
+"""
+import os
+
+import numpy as np
+
+FULL = "dense"
+SHORT = "dense_short"
+DEFAULT_CANDIDATES = 4
+
+def prefix_dim(full_dim=None):
+    """啟用時回傳前綴維度；未啟用或前綴不比完整向量短時回傳 0"""
+    dim = int(os.environ.get("RAG_MATRYOSHKA_DIM") or 0)
+    if full_dim is not None and dim >= full_dim:
+        return 0
+    return dim
+
+def candidate_factor():
+    return float(os.environ.get("RAG_MATRYOSHKA_CANDIDATES") or DEFAULT_CANDIDATES)
+
+def truncate(vectors, dim):
+    """取前 dim 維並重新正規化；可傳單一向量或 (n, dim) 陣列"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    short = vectors[..., :dim]
+    return short / np.maximum(np.linalg.norm(short, axis=-1, keepdims=True), 1e-12)
+
+def dense_config(full_dim, params=None):
+    """回傳具名向量設定；params 為建立 VectorParams 的函數 (例如 quantization.vector_params)"""
+    from qdrant_client import models
+    params = params or (lambda size: models.VectorParams(size=size, distance=models.Distance.COSINE))
+    dim = prefix_dim(full_dim)
+    if not dim:
+        return {FULL: params(full_dim)}
+    full = models.VectorParams(size=full_dim, distance=models.Distance.COSINE, on_disk=True,
+                               hnsw_config=models.HnswConfigDiff(m=0))  # 只用於 rescore，不建圖
+    return {SHORT: params(dim), FULL: full}
+
+def dense_vectors(embedding, full_dim=None):
+    """單一點的具名向量 dict (numpy 陣列轉 list)"""
+    embedding = np.asarray(embedding, dtype=np.float32)
+    dim = prefix_dim(full_dim or embedding.shape[-1])
+    vectors = {FULL: embedding.tolist()}
+    if dim:
+        vectors[SHORT] = truncate(embedding, dim).tolist()
+    return vectors
+
+def dense_prefetch(query_emb, limit, search_params=None):
+    """停用時為一般的完整向量 Prefetch；啟用時為「前綴取 limit×倍數 候選 → 完整向量 rescore 取 limit」的巢狀 Prefetch"""
+    from qdrant_client import models
+    query_emb = np.asarray(query_emb, dtype=np.float32)
+    dim = prefix_dim(query_emb.shape[-1])
+    if not dim:
+        return models.Prefetch(query=query_emb, using=FULL, limit=limit, params=search_params)
+    candidates = models.Prefetch(query=truncate(query_emb, dim), using=SHORT,
+                                 limit=int(limit * candidate_factor()), params=search_params)
+    return models.Prefetch(prefetch=candidates, query=query_emb, using=FULL, limit=limit)
+
+def describe(full_dim=None):
+    dim = prefix_dim(full_dim)
+    return f"{dim} 維前綴 ×{candidate_factor():g} 候選 → 完整向量 rescore" if dim else "停用"
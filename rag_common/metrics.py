@@ -0,0 +1,100 @@
+"""不需 LLM 的本地檢索 / 生成指標，所有題目一次向量化計算
+
+- Answer_Relevancy    : 答案與問題的餘弦相似度
+- Faithfulness        : 答案句子中，能在檢索內容找到相似句 (>= support_threshold) 的比例
+- Contextual_Precision: 依排名計算的 average precision，相關性以 chunk 與標準答案的相似度判定
+- Contextual_Recall   : 標準答案句子中，能被檢索內容支持的比例
+- Contextual_Relevancy: 檢索內容中與問題相關 (>= relevance_threshold) 的比例
+
+LLM 評審改為選用，只對抽樣的題目執行 (judge_sample)。
+"""
+import re
+import random
+import numpy as np
+
+METRIC_NAMES = ("Faithfulness", "Answer_Relevancy", "Contextual_Precision", "Contextual_Recall", "Contextual_Relevancy")
+SENTENCE_RE = re.compile(r"[^。！？!?；;\n]+[。！？!?；;]?")
+
+def split_sentences(text, min_chars=4):
+    sentences = [s.strip() for s in SENTENCE_RE.findall(text or "")]
+    return [s for s in sentences if len(s) >= min_chars] or ([text.strip()] if text and text.strip() else [])
+
+def normalize_rows(vecs):
+    vecs = np.asarray(vecs, dtype=np.float32)
+    return vecs / np.maximum(np.linalg.norm(vecs, axis=-1, keepdims=True), 1e-12)
+
+def embed_unique(texts, embed_fn, batch_size=64):
+    """重複文字只嵌入一次，回傳 ({文字: 列號}, 正規化後的矩陣)"""
+    index = {}
+    for t in texts:
+        index.setdefault(t, len(index))
+    unique = list(index)
+    parts = [normalize_rows(embed_fn(unique[i:i + batch_size])) for i in range(0, len(unique), batch_size)]
+    return index, (np.concatenate(parts) if parts else np.zeros((0, 0), dtype=np.float32))
+
+def _padded(groups, index, matrix):
+    """把每題長度不一的文字清單轉為 (n, max_len, dim) 張量與遮罩"""
+    n, width = len(groups), max((len(g) for g in groups), default=0) or 1
+    out = np.zeros((n, width, matrix.shape[1]), dtype=np.float32)
+    mask = np.zeros((n, width), dtype=bool)
+    for i, g in enumerate(groups):
+        if g:
+            out[i, :len(g)] = matrix[[index[t] for t in g]]
+            mask[i, :len(g)] = True
+    return out, mask
+
+def _masked_mean(values, mask):
+    counts = mask.sum(axis=1)
+    return np.where(counts > 0, (values * mask).sum(axis=1) / np.maximum(counts, 1), 0.0)
+
+def compute_metrics(questions, answers, contexts, ground_truths, embed_fn,
+                    support_threshold=0.75, relevance_threshold=0.6):
+    """回傳 {指標名稱: shape (n,) 的 numpy 陣列}；contexts 為每題依排名排序的 chunk 清單"""
+    if len(questions) == 0:
+        # 沒有任何題目成功 (例如 API 全部失敗)：回傳空陣列，不呼叫嵌入
+        return {name: np.zeros(0, dtype=np.float32) for name in METRIC_NAMES}
+    answer_sents = [split_sentences(a) for a in answers]
+    truth_sents = [split_sentences(g) for g in ground_truths]
+    texts = list(questions) + list(answers) + list(ground_truths)
+    texts += [t for group in list(contexts) + answer_sents + truth_sents for t in group]
+    index, matrix = embed_unique([t for t in texts if t], embed_fn)
+
+    def rows(items):
+        return np.stack([matrix[index[t]] if t else np.zeros(matrix.shape[1], np.float32) for t in items])
+    q, a, g = rows(questions), rows(answers), rows(ground_truths)
+    ctx, ctx_mask = _padded(contexts, index, matrix)
+    a_s, a_mask = _padded(answer_sents, index, matrix)
+    g_s, g_mask = _padded(truth_sents, index, matrix)
+
+    neg = np.float32(-1.0)
+    # 句子 × chunk 相似度，取每句對所有 chunk 的最大值
+    a_support = np.where(ctx_mask[:, None, :], np.einsum("nsd,nkd->nsk", a_s, ctx), neg).max(axis=2)
+    g_support = np.where(ctx_mask[:, None, :], np.einsum("nsd,nkd->nsk", g_s, ctx), neg).max(axis=2)
+
+    ctx_truth = np.einsum("nkd,nd->nk", ctx, g)
+    relevant = (ctx_truth >= relevance_threshold) & ctx_mask
+    ranks = np.arange(1, relevant.shape[1] + 1)
+    precision_at_k = np.cumsum(relevant, axis=1) / ranks
+    n_relevant = relevant.sum(axis=1)
+    avg_precision = np.where(n_relevant > 0, (precision_at_k * relevant).sum(axis=1) / np.maximum(n_relevant, 1), 0.0)
+
+    ctx_question = np.einsum("nkd,nd->nk", ctx, q)
+    return {
+        "Faithfulness": _masked_mean(a_support >= support_threshold, a_mask),
+        "Answer_Relevancy": np.clip(np.einsum("nd,nd->n", q, a), 0.0, 1.0),
+        "Contextual_Precision": avg_precision,
+        "Contextual_Recall": _masked_mean(g_support >= support_threshold, g_mask),
+        "Contextual_Relevancy": _masked_mean(ctx_question >= relevance_threshold, ctx_mask),
+    }
+
+def judge_sample(n, judge_fn, sample_size, seed=0):
+    """只抽 sample_size 題呼叫 LLM 評審 judge_fn(i)，回傳 {題目索引: 評審結果}；結果為 None 的題目略過"""
+    if sample_size <= 0 or n == 0:
+        return {}
+    picked = sorted(random.Random(seed).sample(range(n), min(sample_size, n)))
+    results = {}
+    for i in picked:
+        res = judge_fn(i)
+        if res is not None:
+            results[i] = res
+    return results
@@ -0,0 +1,85 @@
+"""向量量化設定 (int8 scalar / binary)
+
+量化後的向量常駐 RAM 供 HNSW 搜尋，原始 float32 向量放在磁碟 (on_disk)；
+查詢時先以量化向量多取 oversampling 倍候選，再讀原始向量重新計分 (rescore)。
+以環境變數切換，各腳本建立集合與查詢時呼叫同一組函數：
+
+    RAG_QUANTIZATION=none|int8|binary   (預設 none)
+    RAG_OVERSAMPLING=3.0                (未設定時依模式採預設值)
+
+    client.create_collection(name, vectors_config=vector_params(dim))
+    client.query_points(name, query=q, limit=3, search_params=search_params())
+
+本地模式 (QdrantClient(path=...) / ":memory:") 一律暴力搜尋且不使用量化，只有連到伺服器的腳本才接這組設定。
+"""
+import os
+import time
+
+MODES = ("none", "int8", "binary")
+DEFAULT_OVERSAMPLING = {"int8": 2.0, "binary": 3.0}  # binary 誤差較大，多取一些候選
+INT8_QUANTILE = 0.99  # 排除極端值後再決定 int8 的量化區間
+
+def quantization_mode(mode=None):
+    mode = (mode or os.environ.get("RAG_QUANTIZATION") or "none").lower()
+    if mode not in MODES:
+        raise ValueError(f"未知的量化模式: {mode} (可用: {', '.join(MODES)})")
+    return mode
+
+def oversampling(mode=None):
+    mode = quantization_mode(mode)
+    value = os.environ.get("RAG_OVERSAMPLING")
+    return float(value) if value else DEFAULT_OVERSAMPLING.get(mode, 1.0)
+
+def quantization_config(mode=None):
+    from qdrant_client import models
+    mode = quantization_mode(mode)
+    if mode == "int8":
+        return models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(
+            type=models.ScalarType.INT8, quantile=INT8_QUANTILE, always_ram=True))
+    if mode == "binary":
+        return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True))
+    return None
+
+def vector_params(size, distance=None, mode=None):
+    """量化時原始向量存磁碟、量化向量常駐 RAM；none 時與原本的 VectorParams 相同"""
+    from qdrant_client import models
+    mode = quantization_mode(mode)
+    quantized = mode != "none"
+    return models.VectorParams(size=size, distance=distance or models.Distance.COSINE,
+                               on_disk=True if quantized else None,
+                               quantization_config=quantization_config(mode))
+
+def search_params(mode=None, oversample=None):
+    """量化模式下啟用 oversampling + 原始向量 rescore；none 時回傳 None (沿用伺服器預設)"""
+    from qdrant_client import models
+    mode = quantization_mode(mode)
+    if mode == "none":
+        return None
+    return models.SearchParams(quantization=models.QuantizationSearchParams(
+        rescore=True, oversampling=oversample or oversampling(mode)))
+
+def wait_indexed(client, collection, timeout=600):
+    """等 optimizer 建好 HNSW 與量化向量，否則量到的是未索引的暴力搜尋；逾時回傳 False"""
+    from qdrant_client import models
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        info = client.get_collection(collection)
+        if info.status == models.CollectionStatus.GREEN and (info.indexed_vectors_count or 0) >= (info.points_count or 0):
+            return True
+        time.sleep(1)
+    print(f"⚠️ {collection} 等待索引逾時，結果可能偏向暴力搜尋")
+    return False
+
+def vector_bytes(count, dim, mode=None):
+    """(常駐 RAM 的向量大小, 磁碟上的原始向量大小)；不含 HNSW 圖與 payload"""
+    mode = quantization_mode(mode)
+    full = count * dim * 4
+    if mode == "int8":
+        return count * dim, full
+    if mode == "binary":
+        return count * ((dim + 7) // 8), full
+    return full, 0
+
+def describe(mode=None):
+    mode = quantization_mode(mode)
+    return mode if mode == "none" else f"{mode} (oversampling {oversampling(mode):g}, rescore)"
@@ -0,0 +1,44 @@
+"""各 API 端點的 token bucket 限流"""
+import time
+import threading
+
+class TokenBucket:
+    """執行緒安全的 token bucket：每秒補充 rate 個 token，最多累積 burst 個"""
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """阻塞直到取得 token"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+_limiters = {}
+_registry_lock = threading.Lock()
+
+def configure_rate_limit(endpoint, rate, burst=None):
+    with _registry_lock:
+        _limiters[endpoint] = TokenBucket(rate, burst)
+
+def rate_limiter(endpoint, default_rate=10):
+    """取得端點的限流器，未設定時以 default_rate 建立"""
+    with _registry_lock:
+        if endpoint not in _limiters:
+            _limiters[endpoint] = TokenBucket(default_rate)
+        return _limiters[endpoint]
+
+def configured_limiter(endpoint):
+    """只回傳有明確設定過的限流器，未設定時為 None"""
+    with _registry_lock:
+        return _limiters.get(endpoint)
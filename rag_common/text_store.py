@@ -0,0 +1,158 @@
+"""chunk 文字的外部儲存：payload 只放 (source, start, end)
+
+滑動視窗的相鄰 chunk 大量重疊，把全文放進每個 point 的 payload 會讓同一段文字重複好幾份，
+索引 RAM、snapshot 與每次檢索回傳的資料量都跟著變大。store 模式下每份來源只存一次，
+切成固定字元數的區塊各自 zlib 壓縮寫進 blocks.bin，查詢結果回來後才以 mmap 讀出需要的區塊解壓：
+
+    RAG_PAYLOAD_TEXT=inline|store   (預設 inline，payload 仍帶 text)
+
+    with TextStoreWriter(path) as writer:
+        writer.add("data_01.txt", content)                 # 整份來源，offset 以字元計
+        start, end = writer.append("table.html", row)      # 或逐段附加，回傳該段的 offset
+    payload = chunk_payload(chunk, "data_01.txt", start, end)
+
+    store = TextStore(path)
+    hydrate(hits, store)      # 補回 payload["text"]
+"""
+import os
+import json
+import mmap
+import zlib
+import functools
+
+MODES = ("inline", "store")
+BLOCK_CHARS = 16384
+DATA_FILE = "blocks.bin"
+INDEX_FILE = "index.json"
+
+def payload_mode(mode=None):
+    mode = (mode or os.environ.get("RAG_PAYLOAD_TEXT") or "inline").lower()
+    if mode not in MODES:
+        raise ValueError(f"未知的 payload 模式: {mode} (可用: {', '.join(MODES)})")
+    return mode
+
+def chunk_payload(text, source, start, end, mode=None, **extra):
+    """inline 模式附上 text；store 模式只留來源與 offset"""
+    payload = {"source": source, "start": start, "end": end, **extra}
+    if payload_mode(mode) == "inline":
+        payload["text"] = text
+    return payload
+
+class TextStoreWriter:
+    """依來源累積文字，每滿 block_chars 個字元壓縮寫出一個區塊；close 時寫入索引"""
+    def __init__(self, path, block_chars=BLOCK_CHARS, level=6):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.block_chars = block_chars
+        self.level = level
+        self.f = open(os.path.join(path, DATA_FILE), "wb")
+        self.sources = {}   # source -> {"chars": 總字元數, "blocks": [[byte offset, byte 長度], ...]}
+        self.pending = {}   # source -> 尚未滿一個區塊的文字
+
+    def _write_block(self, source, text):
+        data = zlib.compress(text.encode("utf-8"), self.level)
+        self.sources[source]["blocks"].append([self.f.tell(), len(data)])
+        self.f.write(data)
+
+    def append(self, source, text):
+        """把 text 接在來源尾端，回傳它在來源中的 (start, end)"""
+        info = self.sources.setdefault(source, {"chars": 0, "blocks": []})
+        start = info["chars"]
+        info["chars"] += len(text)
+        buf = self.pending.get(source, "") + text
+        full = len(buf) - len(buf) % self.block_chars
+        for i in range(0, full, self.block_chars):
+            self._write_block(source, buf[i:i + self.block_chars])
+        self.pending[source] = buf[full:]
+        return start, info["chars"]
+
+    def add(self, source, text):
+        """寫入整份來源；同名來源已存在時直接沿用"""
+        if source not in self.sources:
+            self.append(source, text)
+        return source
+
+    def close(self):
+        for source, rest in self.pending.items():
+            if rest:
+                self._write_block(source, rest)
+        self.pending = {}
+        self.f.close()
+        tmp = os.path.join(self.path, INDEX_FILE + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"block_chars": self.block_chars, "sources": self.sources}, f, ensure_ascii=False)
+        os.replace(tmp, os.path.join(self.path, INDEX_FILE))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class TextStore:
+    """唯讀：mmap blocks.bin，最近用過的區塊解壓結果保留在 LRU 快取 (執行緒安全)"""
+    def __init__(self, path, cache_blocks=256):
+        with open(os.path.join(path, INDEX_FILE), "r", encoding="utf-8") as f:
+            index = json.load(f)
+        self.block_chars = index["block_chars"]
+        self.sources = index["sources"]
+        self.f = open(os.path.join(path, DATA_FILE), "rb")
+        try:
+            self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # 空檔案無法 mmap
+            self.data = b""
+        self._block = functools.lru_cache(maxsize=cache_blocks)(self._load_block)
+
+    def _load_block(self, source, i):
+        offset, length = self.sources[source]["blocks"][i]
+        return zlib.decompress(self.data[offset:offset + length]).decode("utf-8")
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __contains__(self, source):
+        return source in self.sources
+
+    def length(self, source):
+        return self.sources[source]["chars"]
+
+    def text(self, source, start, end):
+        """來源中 [start, end) 的文字，只解壓涵蓋這段的區塊"""
+        end = min(end, self.sources[source]["chars"])
+        if start >= end:
+            return ""
+        first, last = start // self.block_chars, (end - 1) // self.block_chars
+        joined = "".join(self._block(source, i) for i in range(first, last + 1))
+        base = first * self.block_chars
+        return joined[start - base:end - base]
+
+    def resolve(self, payload):
+        """payload 已有 text 時直接回傳，否則依 (source, start, end) 讀出"""
+        if "text" in payload:
+            return payload["text"]
+        return self.text(payload["source"], payload["start"], payload["end"])
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_store(path, mode=None):
+    """store 模式且 path 已寫好索引時回傳 TextStore，否則回傳 None"""
+    if payload_mode(mode) == "store" and os.path.exists(os.path.join(path, INDEX_FILE)):
+        return TextStore(path)
+    return None
+
+def hydrate(points, store=None):
+    """就地為檢索結果補上 payload["text"] (inline 模式或已有 text 時不動)，回傳 points"""
+    if store is not None:
+        for p in points:
+            if p.payload is not None and "text" not in p.payload:
+                p.payload["text"] = store.resolve(p.payload)
+    return points
@@ -0,0 +1,153 @@
+"""輕量的階段量測 (tracing)
+
+以 span 記錄每次 embed / search / rerank / llm / vlm / asr / parse 呼叫的耗時、
+payload 大小與 token 數，執行結束時印出各階段 p50/p95/p99 並匯出 JSON trace。
+
+    with span("embed", items=len(texts), bytes_in=text_bytes(texts)) as s:
+        res = post_json(...)
+        s.usage(res)
+
+    @traced("llm")
+    def call_llm(...): ...
+"""
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+
+STAGES = ("parse", "embed", "search", "rerank", "llm", "vlm", "asr")
+
+def percentile(values, p):
+    """線性內插百分位數 (p: 0~100)"""
+    if not values: return 0.0
+    data = sorted(values)
+    k = (len(data) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(data) - 1)
+    return data[lo] + (data[hi] - data[lo]) * (k - lo)
+
+def text_bytes(texts):
+    """字串或字串串列的 UTF-8 大小"""
+    if isinstance(texts, str):
+        texts = [texts]
+    return sum(len(t.encode("utf-8")) for t in texts)
+
+class Span:
+    def __init__(self, stage, name, parent, attrs):
+        self.stage = stage
+        self.name = name or stage
+        self.parent = parent
+        self.attrs = dict(attrs)
+        self.start = time.perf_counter()
+        self.duration = None
+        self.error = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def usage(self, response):
+        """記錄 OpenAI 相容回應 (dict) 或 LangChain 訊息的 token 用量"""
+        usage = None
+        if isinstance(response, dict):
+            usage = response.get("usage")
+            if usage:
+                usage = {"tokens_in": usage.get("prompt_tokens"), "tokens_out": usage.get("completion_tokens")}
+        elif getattr(response, "usage_metadata", None):
+            meta = response.usage_metadata
+            usage = {"tokens_in": meta.get("input_tokens"), "tokens_out": meta.get("output_tokens")}
+        if usage:
+            self.attrs.update({k: v for k, v in usage.items() if v is not None})
+
+class Tracer:
+    """執行緒安全；巢狀 span 以各執行緒自己的堆疊記錄父子關係"""
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.records = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextmanager
+    def span(self, stage, name=None, **attrs):
+        stack = self.local.__dict__.setdefault("stack", [])
+        s = Span(stage, name, stack[-1].name if stack else None, attrs)
+        stack.append(s)
+        try:
+            yield s
+        except Exception as e:
+            s.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            s.duration = time.perf_counter() - s.start
+            stack.pop()
+            record = {"stage": s.stage, "name": s.name, "parent": s.parent,
+                      "start": round(s.start - self.origin, 6), "duration": round(s.duration, 6),
+                      "thread": threading.current_thread().name, **s.attrs}
+            if s.error:
+                record["error"] = s.error
+            with self.lock:
+                self.records.append(record)
+
+    def traced(self, stage, name=None):
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(stage, name or fn.__name__):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        """依 (階段, 名稱) 彙整次數、錯誤數、延遲百分位數與 payload / token 總量"""
+        with self.lock:
+            records = list(self.records)
+        groups = {}
+        for r in records:
+            groups.setdefault((r["stage"], r["name"]), []).append(r)
+        order = {stage: i for i, stage in enumerate(STAGES)}
+        out = []
+        for (stage, name), rs in sorted(groups.items(), key=lambda kv: (order.get(kv[0][0], len(STAGES)), kv[0][1])):
+            durations = [r["duration"] for r in rs]
+            row = {"stage": stage, "name": name, "count": len(rs), "errors": sum(1 for r in rs if "error" in r),
+                   "total": sum(durations), "p50": percentile(durations, 50),
+                   "p95": percentile(durations, 95), "p99": percentile(durations, 99)}
+            for key in ("items", "bytes_in", "bytes_out", "tokens_in", "tokens_out"):
+                values = [r[key] for r in rs if isinstance(r.get(key), (int, float))]
+                if values:
+                    row[key] = sum(values)
+            out.append(row)
+        return out
+
+    def print_summary(self):
+        rows = self.summary()
+        if not rows:
+            return
+        print(f"\n⏱️ 各階段耗時 (總計 {time.perf_counter() - self.origin:.2f} 秒)")
+        print(f"{'階段':8}{'名稱':22}{'次數':>6}{'錯誤':>6}{'總計(s)':>10}{'p50(s)':>9}{'p95(s)':>9}{'p99(s)':>9}{'bytes_in':>11}{'tokens':>10}")
+        for r in rows:
+            tokens = r.get("tokens_in", 0) + r.get("tokens_out", 0)
+            print(f"{r['stage']:8}{r['name'][:20]:22}{r['count']:>6}{r['errors']:>6}{r['total']:>10.2f}"
+                  f"{r['p50']:>9.3f}{r['p95']:>9.3f}{r['p99']:>9.3f}{r.get('bytes_in', 0):>11}{tokens or '-':>10}")
+
+    def export(self, path):
+        with self.lock:
+            records = list(self.records)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"spans": records, "summary": self.summary()}, f, ensure_ascii=False, indent=2)
+        print(f"🧾 trace 已匯出至 {path}")
+
+    def finish(self, path=None):
+        """執行結束：印出摘要，並在給定路徑時匯出 JSON"""
+        self.print_summary()
+        if path:
+            self.export(path)
+
+_tracer = Tracer()
+
+def get_tracer():
+    return _tracer
+
+def span(stage, name=None, **attrs):
+    return _tracer.span(stage, name, **attrs)
+
+def traced(stage, name=None):
+    return _tracer.traced(stage, name)
@@ -0,0 +1,170 @@
+"""共用 HTTP 傳輸層：每個主機一個 AIMD 自適應併發上限、Retry-After 與抖動指數退避
+
+- 成功時併發上限緩慢增加 (每個完整視窗 +1)，遇到 429/503 則減半，
+  讓批次工作貼著共用伺服器可承受的最高速率跑，而不是一直被限流。
+- 429/5xx 與連線錯誤會重試；有 Retry-After 時依伺服器指示等待，否則用 full jitter 指數退避。
+  Retry-After 超過 max_retry_after (預設同退避上限) 時不等待，直接回傳該回應。
+- 其他 4xx (例如 400) 不重試，直接交給呼叫端處理。
+"""
+import time
+import random
+import threading
+from collections import Counter
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+
+from rag_common.ratelimit import configured_limiter
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+THROTTLE_STATUS = {429, 503}
+
+def parse_retry_after(value):
+    """Retry-After 可能是秒數或 HTTP 日期，回傳需等待的秒數 (無法解析時為 None)"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    """full jitter 指數退避"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+class AdaptiveLimit:
+    """AIMD 併發上限：acquire 在進行中請求數達上限時阻塞"""
+    def __init__(self, initial=4, minimum=1, maximum=64, decrease=0.5, cooldown=1.0):
+        self.limit = float(initial)
+        self.minimum, self.maximum = minimum, maximum
+        self.decrease = decrease
+        self.cooldown = cooldown    # 同一波限流回應只減一次
+        self.inflight = 0
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+
+    def release(self, throttled=False):
+        with self.cond:
+            self.inflight -= 1
+            now = time.monotonic()
+            if throttled:
+                if now - self.last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+class Transport:
+    def __init__(self, max_retries=5, initial_concurrency=4, max_concurrency=64, session=None,
+                 backoff_cap=30.0, max_retry_after=None):
+        self.session = session or requests.Session()
+        self.max_retries = max_retries
+        self.backoff_cap = backoff_cap
+        # 伺服器要求等待更久 (例如 Retry-After: 86400) 時放棄重試，避免工作執行緒被卡住數小時
+        self.max_retry_after = backoff_cap if max_retry_after is None else max_retry_after
+        self.initial_concurrency = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self.limits = {}
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def _limit_for(self, host):
+        with self.lock:
+            if host not in self.limits:
+                self.limits[host] = AdaptiveLimit(self.initial_concurrency, maximum=self.max_concurrency)
+            return self.limits[host]
+
+    def _count(self, host, key, n=1):
+        with self.lock:
+            self.counters[(host, key)] += n
+
+    def request(self, method, url, **kwargs):
+        """送出請求並依策略重試；回傳最後一次的 Response (Retry-After 過長時提早回傳)，連線錯誤重試用盡時拋出例外"""
+        host = urlsplit(url).netloc
+        limit = self._limit_for(host)
+        for attempt in range(self.max_retries + 1):
+            bucket = configured_limiter(url)
+            if bucket:
+                bucket.acquire()
+            limit.acquire()
+            response, error = None, None
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                throttled = response is not None and response.status_code in THROTTLE_STATUS
+                limit.release(throttled=throttled)
+            self._count(host, "requests")
+            self._count(host, "latency_ms", int((time.monotonic() - start) * 1000))
+
+            if error is None and response.status_code not in RETRY_STATUS:
+                self._count(host, "ok" if response.ok else f"http_{response.status_code}")
+                return response
+            if throttled:
+                self._count(host, "throttled")
+            self._count(host, "errors" if error else f"http_{response.status_code}")
+            if attempt == self.max_retries:
+                if error:
+                    raise error
+                return response
+
+            delay = parse_retry_after(response.headers.get("Retry-After")) if response is not None else None
+            if delay is not None and delay > self.max_retry_after:
+                self._count(host, "retry_after_exceeded")
+                return response
+            delay = delay + random.uniform(0, 0.5) if delay is not None else backoff_delay(attempt, cap=self.backoff_cap)
+            self._count(host, "retries")
+            time.sleep(delay)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post_json(self, url, payload, timeout=60, **kwargs):
+        """POST JSON 並回傳解析後的內容，非 2xx 時拋出 HTTPError"""
+        response = self.post(url, json=payload, timeout=timeout, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    def stats(self):
+        """每個主機的計數器與目前的併發上限"""
+        out = {}
+        with self.lock:
+            for (host, key), value in self.counters.items():
+                out.setdefault(host, {})[key] = value
+            for host, limit in self.limits.items():
+                out.setdefault(host, {})["concurrency_limit"] = round(limit.limit, 2)
+        return out
+
+    def print_stats(self):
+        for host, s in self.stats().items():
+            n = s.get("requests", 0)
+            avg = s.get("latency_ms", 0) / n if n else 0
+            print(f"🌐 {host}: 請求 {n}、成功 {s.get('ok', 0)}、重試 {s.get('retries', 0)}、"
+                  f"限流 {s.get('throttled', 0)}、平均 {avg:.0f} ms、併發上限 {s.get('concurrency_limit')}")
+
+_default = None
+_default_lock = threading.Lock()
+
+def get_transport():
+    """整個行程共用一個 Transport，讓同一主機的併發上限與計數器一致"""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Transport()
+        return _default